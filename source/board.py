@@ -7,24 +7,32 @@ import chess.svg
 import time
 import os
 
+import numpy as np
+
+# The 12 values every square gets in the positional encoding, in order: one for each piece
+# type of each color (e.g. the first one is 1 if there is a black pawn on the square)
+PIECE_PLANES = [
+    (chess.PAWN, chess.BLACK),
+    (chess.BISHOP, chess.BLACK),
+    (chess.KNIGHT, chess.BLACK),
+    (chess.ROOK, chess.BLACK),
+    (chess.QUEEN, chess.BLACK),
+    (chess.KING, chess.BLACK),
+    (chess.PAWN, chess.WHITE),
+    (chess.BISHOP, chess.WHITE),
+    (chess.KNIGHT, chess.WHITE),
+    (chess.ROOK, chess.WHITE),
+    (chess.QUEEN, chess.WHITE),
+    (chess.KING, chess.WHITE),
+]
+
+# Length of the positional encoding: 12 values for each of the 64 squares, then the turn, the 4
+# castling rights, the en passant square, the halfmove clock and the fullmove number
+ENCODING_SIZE = 12 * 8 * 8 + 8
+
 class ChessBoard:
     def __init__(self):
         self.board = chess.Board()
-        self.piece_dict = {
-            'p': [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-            'b': [0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-            'n': [0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-            'r': [0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
-            'q': [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0],
-            'k': [0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0],
-            'P': [0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0],
-            'B': [0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0],
-            'N': [0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0],
-            'R': [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0],
-            'Q': [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0],
-            'K': [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-            '.': [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        }
         self.img_location = ''
 
     def get_legal_moves(self):
@@ -58,6 +66,19 @@ class ChessBoard:
         
         self.board.push_san(move)
         return 0
+
+    def push(self, move):
+        """
+        Plays a chess.Move on this board without any string parsing. This is the fast path the 
+        search uses, and it is always paired with a call to pop() to take the move back.
+        """
+        self.board.push(move)
+
+    def pop(self):
+        """
+        Takes back the last move that was played on this board and returns it.
+        """
+        return self.board.pop()
     
     def get_fen(self):
         return self.board.fen()
@@ -88,44 +109,137 @@ class ChessBoard:
         return valid
 
     
-    def positional_encode(self):
-        # print('Board position is: ' + self.board.fen())
-        
-        # Parse the fen notation 
-        fen = self.get_fen()
-
-        pieces, move, castles, en_passant, halfmove_clock, fullmove_num = fen.split(' ')
-
-        # Parse pieces
-        pieces_arr = []        
-        rows = pieces.split('/')
-        for row in rows:
-            for spot in row:
-                if spot.isdigit():
-                    for _ in range(int(spot)):
-                        pieces_arr.extend(self.piece_dict['.'])
-                else:
-                    pieces_arr.extend(self.piece_dict[spot])
-        
-        assert len(pieces_arr) == 12 * 8 * 8 # This is making sure our pieces array has a 12-length vector for every single spot
-        
-        # Parse Move
-        move_arr = [1] if move == 'w' else [0]
-
-        # Parse castles
-        castles_arr = ['K' in castles, 'Q' in castles, 'k' in castles, 'q' in castles]
-        for idx, bool in enumerate(castles_arr):
-            if bool:
-                castles_arr[idx] = 1
-            else:
-                castles_arr[idx] = 0
-        
-        # Parse en passant
-        en_passant_arr = [0] if en_passant == '-' else [chess.parse_square(en_passant)]
-    
-        return pieces_arr + move_arr + castles_arr + en_passant_arr + [int(halfmove_clock)] + [int(fullmove_num)]
+    def positional_encode(self, out=None):
+        """
+        Encodes the board as the 776 numbers our models take as input:
+            -> 768 values for the pieces: 12 for every square (see PIECE_PLANES), with the squares 
+                in the order of the FEN (a8, b8, ..., h8, a7, ..., h1)
+            -> 1 if it is White's turn, 0 if not
+            -> 4 values for the castling rights (K, Q, k, q)
+            -> The en passant square as a python-chess square index (0 if there is none)
+            -> The halfmove clock and the fullmove number
+
+        The pieces are read straight from python-chess' bitboards, without going through the FEN.
+
+        Arguments:
+            out (np.ndarray): Optional row of 776 numbers (e.g. a row of a batch) that the encoding
+                is written into. An integer row that is too small for a number (e.g. a uint8 row and
+                a fullmove number above 255) gets the biggest number it can hold instead.
+
+        Output:
+            np.ndarray or list: out if it was given, otherwise the encoding as a list
+        """
+        if out is not None:
+            _write_encodings([_piece_masks(self.board)], [_meta_values(self.board)], out[np.newaxis])
+            return out
+        row = np.empty((1, ENCODING_SIZE), dtype=np.int64)
+        _write_encodings([_piece_masks(self.board)], [_meta_values(self.board)], row)
+        return row[0].tolist()
+
+
+def _piece_masks(board):
+    """
+    Returns the 12 piece bitboards of a chess.Board, in the order of PIECE_PLANES.
+    """
+    return [board.pieces_mask(piece_type, color) for piece_type, color in PIECE_PLANES]
+
+
+def _meta_values(board):
+    """
+    Returns the last 8 values of the encoding of a chess.Board (turn, castles, en passant, move counters).
+    """
+    return (
+        board.turn == chess.WHITE,
+        board.has_kingside_castling_rights(chess.WHITE),
+        board.has_queenside_castling_rights(chess.WHITE),
+        board.has_kingside_castling_rights(chess.BLACK),
+        board.has_queenside_castling_rights(chess.BLACK),
+        board.ep_square if board.has_legal_en_passant() else 0,
+        board.halfmove_clock,
+        board.fullmove_number,
+    )
+
+
+def _write_encodings(masks, meta, out):
+    """
+    Writes the encodings of a batch of boards into out, an (N, 776) array.
+
+    Arguments:
+        masks (list): The _piece_masks() of every board
+        meta (list): The _meta_values() of every board
+        out (np.ndarray): The array the encodings are written into
+    """
+    num_boards = len(masks)
+
+    # Every bitboard, as big-endian bytes, unpacks with the little bit order to a8, b8, ..., h1
+    masks = np.array(masks, dtype='>u8')
+    planes = np.unpackbits(masks.view(np.uint8), axis=1, bitorder='little').reshape(num_boards, 12, 64)
+    out[:, :768] = planes.transpose(0, 2, 1).reshape(num_boards, 768)
+
+    # An integer array that is too small for the move counters gets the biggest number it can hold
+    meta = np.array(meta, dtype=np.int64).reshape(num_boards, 8)
+    if out.dtype.kind in 'iu':
+        np.minimum(meta, np.iinfo(out.dtype).max, out=meta)
+    out[:, 768:] = meta
+
+
+def positional_encode_many(boards, out=None, dtype=np.float32):
+    """
+    Encodes a batch of boards at once (see ChessBoard.positional_encode() for the layout).
+
+    Arguments:
+        boards (list): The boards to encode. Each one can be our ChessBoard, a chess.Board or a FEN.
+        out (np.ndarray): Optional (N, 776) array that the encodings are written into
+        dtype: The type of the array that is returned when out is not given
+
+    Output:
+        np.ndarray: The (N, 776) array of encodings, one row per board
+    """
+    masks, meta = [], []
+    for board in boards:
+        if isinstance(board, ChessBoard):
+            board = board.board
+        elif isinstance(board, str):
+            board = chess.Board(board)
+        masks.append(_piece_masks(board))
+        meta.append(_meta_values(board))
+    return _finish_encodings(masks, meta, out, dtype)
+
+
+def positional_encode_game(moves, start_fen=chess.STARTING_FEN, out=None, dtype=np.float32):
+    """
+    Encodes every position of a game: row i is the board after moves[i] was played, the same
+    positions data_handler.convert_game_to_pos_encodings() used to encode one by one.
+
+    Arguments:
+        moves (list): The moves of the game, as SAN strings (e.g. 'e4') or chess.Move objects
+        start_fen (str): The position the game starts from
+        out (np.ndarray): Optional (N, 776) array that the encodings are written into
+        dtype: The type of the array that is returned when out is not given
+
+    Output:
+        np.ndarray: The (N, 776) array of encodings, one row per move
+    """
+    board = chess.Board(start_fen)
+    masks, meta = [], []
+    for move in moves:
+        if isinstance(move, str):
+            board.push_san(move)
+        else:
+            board.push(move)
+        masks.append(_piece_masks(board))
+        meta.append(_meta_values(board))
+    return _finish_encodings(masks, meta, out, dtype)
 
 
+def _finish_encodings(masks, meta, out, dtype):
+    if out is None:
+        out = np.empty((len(masks), ENCODING_SIZE), dtype=dtype)
+    elif out.shape != (len(masks), ENCODING_SIZE):
+        raise ValueError(f'Expected an output array of shape {(len(masks), ENCODING_SIZE)}, got {out.shape}')
+    if masks:
+        _write_encodings(masks, meta, out)
+    return out
 
 
 if __name__ == '__main__':
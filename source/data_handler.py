@@ -8,29 +8,191 @@ Date: 11/3/2022
 
 # Python imports
 from csv import writer
+import bz2
+import gzip
+import io
+import os
 import re
 import numpy as np
 import pandas as pd
 
 # Local Imports
-from board import ChessBoard
+from board import positional_encode_game, ENCODING_SIZE
+
+def open_games_file(filepath):
+    """
+    Opens a file of games for reading as text. Lichess dumps can be read as they are downloaded:
+    files ending in .zst, .bz2 or .gz are decompressed on the fly while they are read.
+
+    Arguments:
+        filepath (str): Location of the file of games
+    """
+    if filepath.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst files needs the zstandard package (pip install zstandard)')
+        fh = open(filepath, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(fh, closefd=True), encoding='utf-8')
+    if filepath.endswith('.bz2'):
+        return bz2.open(filepath, 'rt', encoding='utf-8')
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt', encoding='utf-8')
+    return open(filepath, 'r')
+
+def stream_games(filepath, only_evaluated=False):
+    """
+    Yields the game strings of a file one at a time, so the file never has to fit in memory. The file
+    can be a Lichess PGN dump (only the move lines are yielded, the headers are skipped) or a file
+    with one game string per line, like the one pull_only_stockfish_games() writes.
+
+    Arguments:
+        filepath (str): Location of the file of games (see open_games_file())
+        only_evaluated (bool): If only the games that have Stockfish evaluations are yielded
+    """
+    with open_games_file(filepath) as f:
+        for line in f:
+            if line[0] != '1':
+                continue
+            if only_evaluated and 'eval' not in line:
+                continue
+            yield line
+
+def reservoir_sample(games, num_games, rng=np.random):
+    """
+    Picks num_games games uniformly at random from a stream of games, in a single pass and only
+    holding num_games games in memory at a time (reservoir sampling). If the stream has fewer games
+    than that, all of them are returned.
+
+    Arguments:
+        games (iterable): The games to pick from, e.g. stream_games()
+        num_games (int): How many games to pick
+        rng: Where the random numbers come from. Defaults to np.random, so np.random.seed() applies.
+    """
+    reservoir = []
+    for idx, game in enumerate(games):
+        if idx < num_games:
+            reservoir.append(game)
+        else:
+            replace_idx = rng.randint(0, idx + 1)
+            if replace_idx < num_games:
+                reservoir[replace_idx] = game
+    return reservoir
 
 def pull_only_stockfish_games(in_filepath, out_filepath):
     """
     This will parse the downloaded file and get the game strings from it.
     """
     with open(out_filepath, 'w') as fw:
-        with open(in_filepath, 'r') as fr:
-            for line in fr:
-                if line[0] == '1' and ('eval' in line):
-                    fw.write(line)
+        for game in stream_games(in_filepath, only_evaluated=True):
+            fw.write(game)
 
 def pull_all_games(filepath):
     """
     This function will pull all games from our database of games and return them as an array of strings.
+    Use stream_games() instead for files that do not fit in memory.
+    """
+    return list(stream_games(filepath))
+
+# Size of the blocks a games file is read in while its index is built
+INDEX_BLOCK_SIZE = 64 * 1024 * 1024
+
+def game_index_path(filepath):
+    """
+    Returns where the index of a games file is kept: next to the file, with .idx added to its name.
     """
-    with open(filepath, 'r') as f:
-        return f.readlines()
+    return filepath + '.idx'
+
+def build_game_index(filepath):
+    """
+    Builds the index of a games file: the byte offset where every line starts, as uint64s, in the
+    .idx file next to it. The file is read in big blocks and the newlines are found with NumPy, so
+    this only has to be done once per file and never holds the whole file in memory.
+
+    Arguments:
+        filepath (str): Location of the file of games, with one game per line (not compressed)
+    """
+    with open(filepath, 'rb') as fr, open(game_index_path(filepath), 'wb') as fw:
+        position = 0
+        at_line_start = True
+        while True:
+            block = fr.read(INDEX_BLOCK_SIZE)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+
+            # A line starts at the start of the block if the last block ended with a newline, and
+            # after every newline of this block that is not the last byte of the file
+            starts = (newlines + 1 + position).astype('<u8')
+            if at_line_start:
+                starts = np.concatenate([np.array([position], dtype='<u8'), starts])
+            at_line_start = bool(len(newlines)) and newlines[-1] == len(block) - 1
+            if at_line_start:
+                starts = starts[:-1]
+            fw.write(starts.tobytes())
+            position += len(block)
+
+class GameFileReader:
+    """
+    Random access to the games (lines) of a games file by their number, in O(1) time and constant
+    memory. It seeks straight to a game with the .idx file of build_game_index(), which is built
+    the first time a file is opened (or again if the file changed since).
+
+    The reader keeps the file open until close() is called, so use it as a context manager:
+        with GameFileReader(filepath) as game_reader:
+            games = game_reader.get_games([0, 1, 2])
+    A reader that is not closed closes its file when it is garbage collected.
+
+    Arguments:
+        filepath (str): Location of the file of games, with one game per line (not compressed)
+    """
+    def __init__(self, filepath):
+        if filepath.endswith(('.zst', '.bz2', '.gz')):
+            raise ValueError(f'Can not seek in the compressed file {filepath}, decompress it first')
+
+        index_path = game_index_path(filepath)
+        if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(filepath):
+            build_game_index(filepath)
+
+        self.filepath = filepath
+        self.offsets = np.fromfile(index_path, dtype='<u8')
+        self._file = open(filepath, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, game):
+        """
+        Returns the game string on line number game (starting at 0). The game is read with a
+        positioned read, so several threads can read games at the same time.
+        """
+        start = int(self.offsets[game])
+        end = int(self.offsets[game + 1]) if game + 1 < len(self.offsets) else self._file_size
+        return os.pread(self._file.fileno(), end - start, start).decode('utf-8')
+
+    def get_games(self, games):
+        """
+        Returns the game strings of a list of line numbers.
+        """
+        return [self[game] for game in games]
+
+    def close(self):
+        """
+        Closes the file. The reader can not be used anymore afterwards.
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # The file is not there if __init__ failed before opening it
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
 
 # Max C.
 def parse_game_string_to_list(game_string):
@@ -83,23 +245,21 @@ def convert_game_to_pos_encodings(move_list):
         BoardArrayValues (list): List in the following format: 
             [(Positional Encoding 1, Stockfish Eval. 1), (Positional Encoding 2, Stockfish Eval. 2), ...]
     """
-    board = ChessBoard()
-    BoardArrayValues = []
-
-    # Skip first move, and iterate through mvoe list
-    for this_move, this_eval in move_list:
-        # Push the move
-        board.make_move(this_move)
-        
-        # Get current encoding
-        this_encoding = board.positional_encode()
+    # Encode every position of the game in one batch
+    moves = [this_move for this_move, _ in move_list]
+    encodings = positional_encode_game(moves, dtype=np.int64)
 
-        # Append this encoding and eval to arr
-        BoardArrayValues.append((this_encoding, this_eval))
-    
-    # print(BoardArrayValues)
+    BoardArrayValues = [(this_encoding, this_eval) for this_encoding, (_, this_eval) in zip(encodings.tolist(), move_list)]
     return BoardArrayValues
 
+def parse_eval(stockfish_eval):
+    """
+    Converts a Stockfish evaluation string to a number. Forced mates (e.g. '#-3') become -100 or 100.
+    """
+    if '#' in str(stockfish_eval):
+        return -100. if '-' in str(stockfish_eval) else 100.
+    return float(stockfish_eval)
+
 def save_move_list_to_csv(move_list, data_filepath):
     """
     This will save the list 'move_list' as a lot of new data points in the csv file located
@@ -113,95 +273,103 @@ def save_move_list_to_csv(move_list, data_filepath):
         None
     """
     this_game_positional_encodings = convert_game_to_pos_encodings(move_list)
-    for board_encoding, stockfish_eval in this_game_positional_encodings:
-        with open(data_filepath, 'a') as f:
-            f_writer = writer(f)
+    with open(data_filepath, 'a') as f:
+        f_writer = writer(f)
+        for board_encoding, stockfish_eval in this_game_positional_encodings:
+            f_writer.writerow(board_encoding + [parse_eval(stockfish_eval)])
 
-            if '#' in str(stockfish_eval):
-                eval = -100. if '-' in str(stockfish_eval) else 100.
-            else:
-                eval = float(stockfish_eval)
+def games_to_arrays(game_strs, dtype=np.float32):
+    """
+    Encodes a batch of games into one feature matrix. Every game is parsed first so that we know
+    how many positions there are, and then every position is encoded straight into its row of a
+    matrix that is allocated once.
 
-            f_writer.writerow(board_encoding + [eval])
+    Arguments:
+        game_strs (iterable): The game strings (see parse_game_string_to_list())
+        dtype: The type of the feature matrix
 
-def data_pipeline(path_to_games_file, num_games=None):
+    Output:
+        (np.ndarray, np.ndarray): The (positions, 776) feature matrix, and the float32 vector of
+            the Stockfish evaluation of every position (not clipped or scaled)
     """
-    This is the whole pipeline that our model will call, and this will return a dataframe of our dataset
+    move_lists = [parse_game_string_to_list(game_str) for game_str in game_strs]
+    return move_lists_to_arrays(move_lists, dtype=dtype)
+
+def move_lists_to_arrays(move_lists, dtype=np.float32):
+    """
+    The second half of games_to_arrays(), for games that were already parsed with
+    parse_game_string_to_list().
+    """
+    num_rows = sum(len(move_list) for move_list in move_lists)
+
+    x = np.empty((num_rows, ENCODING_SIZE), dtype=dtype)
+    y = np.empty(num_rows, dtype=np.float32)
+    row = 0
+    for move_list in move_lists:
+        if not move_list:
+            continue
+        moves, evals = zip(*move_list)
+        positional_encode_game(moves, out=x[row:row + len(moves)])
+        y[row:row + len(moves)] = [parse_eval(this_eval) for this_eval in evals]
+        row += len(moves)
+
+    return x, y
+
+def data_pipeline(path_to_games_file, num_games=None, only_evaluated=False, as_dataframe=True):
+    """
+    This is the whole pipeline that our model will call, and this will return a dataframe of our dataset.
+    The games file is streamed (it can be a compressed Lichess dump), and when num_games is set the
+    games are picked by reservoir sampling, so only num_games games are ever held in memory.
+
+    The dataframe has the same 777 columns as our csv files (the encoding, then the evaluation). With
+    as_dataframe=False the (features, evaluations) arrays of games_to_arrays() are returned instead.
     """
-    games = pull_all_games(path_to_games_file)
+    games = stream_games(path_to_games_file, only_evaluated=only_evaluated)
 
     # If num_games is set, choose a random subset of games from that data
     if num_games:
-        games_for_training = np.random.choice(games, size=num_games, replace=False)
+        games_for_training = reservoir_sample(games, num_games)
     else:
         games_for_training = games
     
     # Go over games and do preprocessing
     print('PREPROCESSING THE DATA.....')
-    LEN_OF_DATA = 777
-    game_dataframe = pd.DataFrame(columns=range(LEN_OF_DATA))
-    for game in games_for_training:
-        # Turn string into move + eval
-        this_move_list = parse_game_string_to_list(game)
-        # print('move list: ')
-        # print(this_move_list)
-    
-        if this_move_list != []:
-
-            # Turn move list into positional encoding list
-            this_positional_encoding_eval_list = convert_game_to_pos_encodings(this_move_list)
-            # print('pos encoding list length: ')
-            # print(len(this_positional_encoding_eval_list))
-            
+    x, y = games_to_arrays(games_for_training)
+    if not as_dataframe:
+        return x, y
 
-            # Append move list to pd dataframe
-            for board_encoding, stockfish_eval in this_positional_encoding_eval_list:
-                if '#' in str(stockfish_eval):
-                    eval = -100. if '-' in str(stockfish_eval) else 100.
-                else:
-                    eval = float(stockfish_eval)
+    game_dataframe = pd.DataFrame(x)
+    game_dataframe[ENCODING_SIZE] = y
+    return game_dataframe
 
-                row_to_add = pd.Series(board_encoding + [eval])
-                game_dataframe = game_dataframe.append(row_to_add)
-        
-        
-
-def game_to_data(game_str):
+def scale_evals(y):
     """
-    This function will take in a game string and return a batch of data that only corresponds to 
-    this specific game.
+    Clips Stockfish evaluations to [-15, 15] and scales them to [-1, 1], the range our models predict.
     """
-    # Turn string into move + eval
-    this_move_list = parse_game_string_to_list(game_str)
-
-    # Turn move list into positional encoding list
-    this_positional_encoding_eval_list = convert_game_to_pos_encodings(this_move_list)
+    return np.clip(y, -15, 15) / 15
 
-    # Go over games and do preprocessing
-    LEN_OF_DATA = 777
-    df_cols = range(LEN_OF_DATA)
-    game_dataframe = pd.DataFrame(columns=df_cols)
-
-    # Append move list to pd dataframe
-    for board_encoding, stockfish_eval in this_positional_encoding_eval_list:
-        if '#' in str(stockfish_eval):
-            eval = -100. if '-' in str(stockfish_eval) else 100.
-        else:
-            eval = float(stockfish_eval)
+def games_to_data(game_strs, as_dataframe=True):
+    """
+    This function will take in a list of game strings and return one batch of data with all of
+    their positions. The evaluations are clipped to [-15, 15] and scaled to [-1, 1].
 
-        row_to_add = pd.DataFrame(board_encoding + [eval])
-        row_to_add = row_to_add.T
-        row_to_add.columns = df_cols
-        game_dataframe = pd.concat([game_dataframe, row_to_add], ignore_index=True)
-    
-    y = game_dataframe.pop(game_dataframe.columns[-1])
+    Output:
+        (pd.DataFrame, pd.Series) or (np.ndarray, np.ndarray): The features and the evaluations
+    """
+    x, y = games_to_arrays(game_strs)
+    y = scale_evals(y)
 
-    y = y.clip(upper=15, lower=-15)
-    y = y / 15
+    if not as_dataframe:
+        return x, y
+    return pd.DataFrame(x), pd.Series(y, name=ENCODING_SIZE)
 
-    return game_dataframe, y
+def game_to_data(game_str, as_dataframe=True):
+    """
+    This function will take in a game string and return a batch of data that only corresponds to 
+    this specific game.
+    """
+    return games_to_data([game_str], as_dataframe=as_dataframe)
 
-        
 
 if __name__ == '__main__':
     data_pipeline('../data/eval_games.txt', 100)
@@ -0,0 +1,448 @@
+"""
+This script implements our binary training data format. A csv file stores every position as 777
+numbers written out as text, which takes a lot of space and has to be parsed again every time it is
+loaded. Instead, a dataset is a folder of shards, and every shard is one binary file:
+    -> A 64 byte header (see HEADER_FORMAT) with the number of positions and games in the shard
+    -> One fixed-size record per position (see record_dtype()): the 768 piece values packed into
+        96 bytes, the other 8 values of the encoding and the Stockfish evaluation
+    -> The game index: the row where every game of the shard starts, as uint64s
+
+The folder also has an index.json with the shards and how many positions and games each one holds.
+Training memory-maps the shards with np.memmap, so reading a random batch is only a copy and an
+np.unpackbits, without any parsing.
+
+Run this script to convert a file of games (anything data_handler.stream_games() reads) to a dataset,
+with the games encoded on every core:
+    python dataset_shards.py ../data/eval_games.txt ../data/eval_games_shards --workers 32
+"""
+
+# Python imports
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+# Local Imports
+from board import ENCODING_SIZE
+from data_handler import stream_games, parse_game_string_to_list, move_lists_to_arrays, reservoir_sample
+
+# Header of a shard: magic, format version, eval type ('e' for float16, 'f' for float32), number of
+# positions and number of games, padded to HEADER_SIZE bytes
+SHARD_MAGIC = b'CHSHARD\x00'
+SHARD_VERSION = 1
+HEADER_FORMAT = '<8sHcxQQ'
+HEADER_SIZE = 64
+
+INDEX_FILENAME = 'index.json'
+EVAL_DTYPES = {'float16': 'e', 'float32': 'f'}
+
+# Bits of the flags byte of a record
+FLAG_WHITE_TURN = 1
+FLAG_CASTLING = [2, 4, 8, 16]   # K, Q, k, q
+
+# How many games are encoded at a time while converting
+GAMES_PER_CHUNK = 512
+
+
+def record_dtype(eval_dtype='float16'):
+    """
+    Returns the NumPy type of one position in a shard.
+
+    Arguments:
+        eval_dtype (str): The type the evaluation is stored as, one of EVAL_DTYPES
+    """
+    return np.dtype([
+        ('pieces', np.uint8, (96,)),
+        ('flags', np.uint8),
+        ('ep_square', np.uint8),
+        ('halfmove_clock', '<u2'),
+        ('fullmove_number', '<u2'),
+        ('eval', '<' + EVAL_DTYPES[eval_dtype]),
+    ])
+
+
+def pack_records(x, y, eval_dtype='float16'):
+    """
+    Packs positional encodings and their evaluations into shard records.
+
+    Arguments:
+        x (np.ndarray): The (N, 776) positional encodings
+        y (np.ndarray): The N evaluations
+        eval_dtype (str): The type the evaluation is stored as, one of EVAL_DTYPES
+    """
+    records = np.empty(len(x), dtype=record_dtype(eval_dtype))
+    records['pieces'] = np.packbits(x[:, :768].astype(np.uint8), axis=1)
+
+    flags = x[:, 768].astype(np.uint8) * FLAG_WHITE_TURN
+    for column, flag in enumerate(FLAG_CASTLING):
+        flags |= x[:, 769 + column].astype(np.uint8) * flag
+    records['flags'] = flags
+    records['ep_square'] = x[:, 773]
+    records['halfmove_clock'] = np.minimum(x[:, 774], 65535)
+    records['fullmove_number'] = np.minimum(x[:, 775], 65535)
+    records['eval'] = y
+    return records
+
+
+def unpack_records(records, out=None, dtype=np.float32):
+    """
+    Turns shard records back into positional encodings and evaluations.
+
+    Arguments:
+        records (np.ndarray): The records, e.g. a slice of a memory-mapped shard
+        out (np.ndarray): Optional (N, 776) array the encodings are written into
+        dtype: The type of the array that is returned when out is not given
+
+    Output:
+        (np.ndarray, np.ndarray): The (N, 776) encodings, and the float32 evaluations
+    """
+    if out is None:
+        out = np.empty((len(records), ENCODING_SIZE), dtype=dtype)
+    out[:, :768] = np.unpackbits(records['pieces'], axis=1)
+
+    flags = records['flags']
+    out[:, 768] = flags & FLAG_WHITE_TURN
+    for column, flag in enumerate(FLAG_CASTLING):
+        out[:, 769 + column] = (flags & flag) != 0
+    out[:, 773] = records['ep_square']
+    out[:, 774] = records['halfmove_clock']
+    out[:, 775] = records['fullmove_number']
+    return out, records['eval'].astype(np.float32)
+
+
+class ShardWriter:
+    """
+    Writes games to one shard file. The header is written again with the final counts when the
+    shard is closed.
+
+    Arguments:
+        filepath (str): Where the shard is written
+        eval_dtype (str): The type the evaluations are stored as, one of EVAL_DTYPES
+    """
+    def __init__(self, filepath, eval_dtype='float16'):
+        if eval_dtype not in EVAL_DTYPES:
+            raise ValueError(f'Unknown eval type {eval_dtype}, expected one of {list(EVAL_DTYPES)}')
+        self.filepath = filepath
+        self.eval_dtype = eval_dtype
+        self.num_rows = 0
+        self.game_starts = []
+
+        self._file = open(filepath, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = struct.pack(HEADER_FORMAT, SHARD_MAGIC, SHARD_VERSION, EVAL_DTYPES[self.eval_dtype].encode(),
+                             self.num_rows, len(self.game_starts))
+        self._file.seek(0)
+        self._file.write(header.ljust(HEADER_SIZE, b'\x00'))
+
+    def write_records(self, records, game_lengths):
+        """
+        Appends the records of whole games to the shard.
+
+        Arguments:
+            records (np.ndarray): The records of the games, see pack_records()
+            game_lengths (list): How many records belong to each game, in order
+        """
+        for game_length in game_lengths:
+            self.game_starts.append(self.num_rows)
+            self.num_rows += game_length
+        self._file.write(records.tobytes())
+
+    def close(self):
+        """
+        Writes the game index and the final header, and closes the file.
+        """
+        self._file.write(np.asarray(self.game_starts, dtype='<u8').tobytes())
+        self._write_header()
+        self._file.close()
+        return {'file': os.path.basename(self.filepath), 'rows': self.num_rows, 'games': len(self.game_starts)}
+
+
+def read_shard_header(filepath):
+    """
+    Reads the header of a shard.
+
+    Output:
+        dict: The eval_dtype, number of rows and number of games of the shard
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    magic, version, eval_code, num_rows, num_games = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != SHARD_MAGIC:
+        raise ValueError(f'{filepath} is not a shard file')
+    if version != SHARD_VERSION:
+        raise ValueError(f'{filepath} has shard format version {version}, expected {SHARD_VERSION}')
+    eval_dtype = {code: name for name, code in EVAL_DTYPES.items()}[eval_code.decode()]
+    return {'eval_dtype': eval_dtype, 'rows': num_rows, 'games': num_games}
+
+
+def _memmap(filepath, dtype, offset, length):
+    # np.memmap can not map zero bytes
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=(length,))
+
+
+class ShardDataset:
+    """
+    A dataset folder written by convert_games(), with every shard memory-mapped. Nothing is read from
+    disk until a batch is asked for, so opening a dataset is instant no matter how big it is.
+
+    Arguments:
+        directory (str): The dataset folder
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+
+        self.directory = directory
+        self.records = []
+        self.game_starts = []
+        for shard in index['shards']:
+            filepath = os.path.join(directory, shard['file'])
+            header = read_shard_header(filepath)
+            dtype = record_dtype(header['eval_dtype'])
+            self.records.append(_memmap(filepath, dtype, HEADER_SIZE, header['rows']))
+            self.game_starts.append(_memmap(filepath, np.dtype('<u8'), HEADER_SIZE + header['rows'] * dtype.itemsize, header['games']))
+
+        self.shard_rows = np.array([len(records) for records in self.records], dtype=np.int64)
+        self.shard_games = np.array([len(game_starts) for game_starts in self.game_starts], dtype=np.int64)
+        self._row_offsets = np.concatenate([[0], np.cumsum(self.shard_rows)])
+        self._game_offsets = np.concatenate([[0], np.cumsum(self.shard_games)])
+
+    def __len__(self):
+        return int(self._row_offsets[-1])
+
+    @property
+    def num_games(self):
+        return int(self._game_offsets[-1])
+
+    def get_rows(self, rows, out=None):
+        """
+        Returns the positions at the given (dataset-wide) row numbers.
+
+        Output:
+            (np.ndarray, np.ndarray): The (N, 776) encodings, and the float32 evaluations
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        shards = np.searchsorted(self._row_offsets, rows, side='right') - 1
+        if out is None:
+            out = np.empty((len(rows), ENCODING_SIZE), dtype=np.float32)
+        y = np.empty(len(rows), dtype=np.float32)
+
+        # Read each shard's rows in one go, in file order
+        for shard in np.unique(shards):
+            positions = np.nonzero(shards == shard)[0]
+            shard_rows = rows[positions] - self._row_offsets[shard]
+            order = np.argsort(shard_rows)
+            records = self.records[shard][shard_rows[order]]
+            x_part, y_part = unpack_records(records)
+            out[positions[order]] = x_part
+            y[positions[order]] = y_part
+        return out, y
+
+    def get_game(self, game):
+        """
+        Returns every position of one game (by its dataset-wide game number).
+        """
+        shard = int(np.searchsorted(self._game_offsets, game, side='right') - 1)
+        game_in_shard = game - self._game_offsets[shard]
+        start = int(self.game_starts[shard][game_in_shard])
+        if game_in_shard + 1 < self.shard_games[shard]:
+            end = int(self.game_starts[shard][game_in_shard + 1])
+        else:
+            end = int(self.shard_rows[shard])
+        return unpack_records(self.records[shard][start:end])
+
+    def sample_batch(self, batch_size, rng=np.random):
+        """
+        Returns batch_size positions picked uniformly at random from the whole dataset.
+        """
+        return self.get_rows(rng.randint(0, len(self), size=batch_size))
+
+    def get_games(self, games):
+        """
+        Returns every position of the given games (by their dataset-wide game numbers), as one batch.
+        """
+        games = [self.get_game(game) for game in games]
+        if not games:
+            return np.empty((0, ENCODING_SIZE), dtype=np.float32), np.empty(0, dtype=np.float32)
+        return np.concatenate([x for x, _ in games]), np.concatenate([y for _, y in games])
+
+    def sample_games(self, num_games, rng=np.random):
+        """
+        Returns every position of num_games games picked at random, as one batch.
+        """
+        return self.get_games(rng.randint(0, self.num_games, size=num_games))
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_games_to_records(game_strs, eval_dtype='float16'):
+    """
+    Encodes a chunk of games into shard records.
+
+    Output:
+        (np.ndarray, list): The records, and how many records belong to each game that had data
+    """
+    move_lists = [parse_game_string_to_list(game_str) for game_str in game_strs]
+    x, y = move_lists_to_arrays(move_lists, dtype=np.uint16)
+    game_lengths = [len(move_list) for move_list in move_lists if move_list]
+    return pack_records(x, y, eval_dtype), game_lengths
+
+
+class ShardSetWriter:
+    """
+    Writes chunks of encoded games to a dataset folder, starting a new shard whenever the current one
+    is full, and writes the index.json when it is closed.
+
+    Arguments:
+        out_dir (str): The dataset folder, created if needed
+        rows_per_shard (int): Roughly how many positions go in a shard (games are never split)
+        eval_dtype (str): The type the evaluations are stored as, one of EVAL_DTYPES
+    """
+    def __init__(self, out_dir, rows_per_shard=1_000_000, eval_dtype='float16'):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.rows_per_shard = rows_per_shard
+        self.eval_dtype = eval_dtype
+        self.shards = []
+        self._writer = None
+
+    def write(self, records, game_lengths):
+        """
+        Appends the records of whole games (see encode_games_to_records()).
+        """
+        start, first_game = 0, 0
+        while first_game < len(game_lengths):
+            if self._writer is None:
+                filepath = os.path.join(self.out_dir, f'shard_{len(self.shards):05d}.bin')
+                self._writer = ShardWriter(filepath, self.eval_dtype)
+
+            # Take whole games until the shard is full
+            end, last_game = start, first_game
+            while last_game < len(game_lengths) and self._writer.num_rows + (end - start) < self.rows_per_shard:
+                end += game_lengths[last_game]
+                last_game += 1
+            self._writer.write_records(records[start:end], game_lengths[first_game:last_game])
+            start, first_game = end, last_game
+
+            if self._writer.num_rows >= self.rows_per_shard:
+                self.shards.append(self._writer.close())
+                self._writer = None
+
+    def close(self):
+        if self._writer is not None:
+            self.shards.append(self._writer.close())
+            self._writer = None
+        with open(os.path.join(self.out_dir, INDEX_FILENAME), 'w') as f:
+            json.dump({'version': SHARD_VERSION, 'eval_dtype': self.eval_dtype, 'shards': self.shards}, f, indent=2)
+        return self.shards
+
+
+def _encoded_chunks(games, eval_dtype, num_workers):
+    """
+    Yields encode_games_to_records() of every chunk of games, in order. With more than one worker the
+    chunks are encoded by a process pool, with only a few chunks per worker in flight at a time so
+    that the games are still streamed instead of all read in up front.
+    """
+    chunks = _chunks(games, GAMES_PER_CHUNK)
+    if num_workers <= 1:
+        for chunk in chunks:
+            yield encode_games_to_records(chunk, eval_dtype)
+        return
+
+    max_pending = 2 * num_workers
+    with multiprocessing.Pool(num_workers) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(encode_games_to_records, (chunk, eval_dtype)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def convert_games(games_filepath, out_dir, rows_per_shard=1_000_000, eval_dtype='float16', num_games=None,
+                  only_evaluated=True, num_workers=None):
+    """
+    Converts a file of games to a dataset folder of shards. The games are encoded by a pool of
+    worker processes, which send back packed records (about 106 bytes a position), and this
+    process writes them to the shards in the order of the games file.
+
+    Arguments:
+        games_filepath (str): The file of games (anything data_handler.stream_games() reads)
+        out_dir (str): The dataset folder
+        rows_per_shard (int): Roughly how many positions go in a shard
+        eval_dtype (str): The type the evaluations are stored as, one of EVAL_DTYPES
+        num_games (int): Optional number of games to pick at random (by reservoir sampling)
+        only_evaluated (bool): If only the games with Stockfish evaluations are converted
+        num_workers (int): How many processes encode games. Defaults to the number of cores, and 1
+            encodes everything in this process.
+
+    Output:
+        list: The shards that were written, with their number of positions and games
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    games = stream_games(games_filepath, only_evaluated=only_evaluated)
+    if num_games:
+        games = reservoir_sample(games, num_games)
+
+    start_time = time.time()
+    total_games, total_rows = 0, 0
+    shard_set = ShardSetWriter(out_dir, rows_per_shard, eval_dtype)
+    with tqdm(unit='game', total=num_games) as progress_bar:
+        progress_bar.set_description('Converting games')
+        for records, game_lengths in _encoded_chunks(games, eval_dtype, num_workers):
+            shard_set.write(records, game_lengths)
+            total_games += len(game_lengths)
+            total_rows += len(records)
+
+            elapsed = max(time.time() - start_time, 1e-9)
+            progress_bar.update(len(game_lengths))
+            progress_bar.set_postfix(games_per_s=f'{total_games / elapsed:.0f}', positions_per_s=f'{total_rows / elapsed:.0f}',
+                                     shards=len(shard_set.shards) + 1)
+    shards = shard_set.close()
+
+    elapsed = time.time() - start_time
+    print(f'Wrote {total_rows} positions from {total_games} games to {len(shards)} shards in {elapsed:.1f}s '
+          f'({total_games / max(elapsed, 1e-9):.0f} games/s, {total_rows / max(elapsed, 1e-9):.0f} positions/s, {num_workers} workers)')
+    return shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a file of games to a folder of binary training shards.')
+    parser.add_argument('games_file', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--rows-per-shard', type=int, default=1_000_000)
+    parser.add_argument('--eval-dtype', type=str, default='float16', choices=list(EVAL_DTYPES))
+    parser.add_argument('--num-games', type=int, default=None)
+    parser.add_argument('--all-games', action='store_true', help='Also convert the games without evaluations')
+    parser.add_argument('--workers', type=int, default=None, help='Number of encoding processes (default: one per core)')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.games_file):
+        print('ERROR - Did not provide a correct location to the games file.')
+        exit(-1)
+
+    convert_games(args.games_file, args.out_dir, args.rows_per_shard, args.eval_dtype, args.num_games,
+                  only_evaluated=not args.all_games, num_workers=args.workers)
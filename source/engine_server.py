@@ -0,0 +1,340 @@
+"""
+This script implements our engine daemon: a long-lived process that imports TensorFlow, loads the
+model and warms it up once, and then answers find_best_move requests over a local socket. Loading
+TensorFlow and the model takes seconds, so paying for it once instead of on every move is what
+makes find_move.py fast.
+
+The daemon listens on a Unix socket (the default, see DEFAULT_SOCKET_PATH) or on a TCP port. The
+protocol is one JSON object per line in both directions:
+    -> {"cmd": "find_best_move", "fen": "<fen>", "time_budget_ms": 1000, "quantization": "int8", "search": "mcts"}
+        <- {"move": "c2c4", "value": 0.5, "time": 0.8}
+    -> {"cmd": "ping"}       <- {"ok": true}
+    -> {"cmd": "shutdown"}   <- {"ok": true}
+Errors come back as {"error": "<message>"}.
+
+Every connection is answered on its own thread, so a ping is answered during a search. The searches
+themselves run one at a time. A daemon on a Unix socket holds a lock on <socket>.lock for as long as
+it runs, so a second daemon on the same socket exits instead of taking the socket over.
+
+Run it with:
+    python engine_server.py [--socket /tmp/ai_chess_engine.sock | --port 5005] [--model <path>.h5]
+"""
+
+# Python Imports
+import argparse
+import fcntl
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# Set tf logs
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+# Default Unix socket of the daemon
+DEFAULT_SOCKET_PATH = os.path.join('/tmp', 'ai_chess_engine.sock')
+
+# Dynamically get path to our trained neural network
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'models',
+                            'keon',
+                            'saved_models',
+                            'model_example.h5')
+
+
+class Engine:
+    """
+    The state the daemon keeps between requests: the model, and a transposition table that is kept
+    from move to move.
+
+    Arguments:
+        model_path (str): The .h5 model that evaluates positions (or a .npz exported from one, see
+            eval/numpy_model.py, which loads without TensorFlow)
+        tt_size_mb (float): The memory budget of the transposition table in MB
+        inference_socket (str): Optional socket of an inference server (see inference_server.py).
+            With one, the model (a path or a name like 'keon/model_example') is evaluated by the
+            server instead of being loaded here.
+        quantization (str): Optional 'int8' or 'float16', to search with the quantized version of
+            the model by default (see eval/quantize.py)
+        mcts_workers (int): The number of threads of the MCTS (see eval/mcts.py)
+        mcts_batch_size (int): How many leaves every MCTS thread evaluates with one call of the model
+        search_workers (int): The number of processes of the alpha-beta search. With more than one,
+            it runs as a Lazy SMP search on a transposition table in shared memory (see
+            eval/lazy_smp.py).
+    """
+    def __init__(self, model_path=MODEL_PATH, tt_size_mb=64, inference_socket=None, quantization=None,
+                 mcts_workers=1, mcts_batch_size=1, search_workers=1):
+        from eval.lazy_smp import LazySMP
+        from eval.transposition_table import TranspositionTable
+
+        if inference_socket is not None and quantization is not None:
+            raise ValueError('The inference server only serves the float models')
+        self.model_path = model_path
+        self.inference_socket = inference_socket
+        self.quantization = quantization
+        self.mcts_workers = mcts_workers
+        self.mcts_batch_size = mcts_batch_size
+        if search_workers > 1:
+            self.smp = LazySMP(search_workers, tt_size_mb)
+            self.tt = self.smp.tt
+        else:
+            self.smp = None
+            self.tt = TranspositionTable(tt_size_mb)
+
+        # The models are loaded the first time they are asked for, the default one right away
+        self.models = {}
+        self.get_model(quantization)
+
+        # The MCTS tree of every model, which is kept from move to move like the transposition table
+        self.trees = {}
+
+    def get_model(self, quantization=None):
+        """
+        Returns the float model, or its quantized version, loading it the first time.
+        """
+        if quantization not in self.models:
+            import numpy as np
+            from board import ENCODING_SIZE
+
+            if self.inference_socket is not None:
+                if quantization is not None:
+                    raise ValueError('The inference server only serves the float models')
+                from inference_server import RemoteModel
+                model = RemoteModel(self.model_path, socket_path=self.inference_socket)
+            else:
+                from eval.numpy_model import load_model
+                model = load_model(self.model_path, quantization)
+
+            # The first prediction traces the model, so do it now instead of on the first move
+            model.predict_on_batch(np.zeros((1, ENCODING_SIZE), dtype=np.float32))
+            self.models[quantization] = model
+        return self.models[quantization]
+
+    def find_best_move(self, fen, time_budget_ms=None, quantization=None, search='alpha_beta'):
+        """
+        Returns the best move of a position, its value and how long the search took.
+
+        Arguments:
+            fen (str): The FEN of the position
+            time_budget_ms (float): Optional time budget of the search in milliseconds
+            quantization (str): 'int8' or 'float16' to evaluate with a quantized model, and None for
+                the float model
+            search (str): 'alpha_beta' or 'mcts' (see eval_board.evaluate_board())
+        """
+        from board import ChessBoard
+        from eval.eval_board import evaluate_board
+        from eval.mcts import MCTS
+
+        board = ChessBoard()
+        board.set_fen(fen)
+        if not board.board.is_valid():
+            raise ValueError(f'Board is not valid: {board.board.status()}')
+        if board.game_is_done()[0]:
+            raise ValueError('The game is already over')
+
+        start_time = time.time()
+        model = self.get_model(quantization)
+        if search == 'mcts' and quantization not in self.trees:
+            self.trees[quantization] = MCTS(model, num_workers=self.mcts_workers, batch_size=self.mcts_batch_size)
+        best_move, value = evaluate_board(board, model, board.get_turn(), tt=self.tt, time_budget_ms=time_budget_ms,
+                                          search=search, mcts=self.trees.get(quantization), smp=self.smp)
+        return best_move, float(value), time.time() - start_time
+
+
+class EngineRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the requests of one connection, one JSON line at a time.
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = self.server.handle_request_json(request)
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+            if response.get('shutdown'):
+                break
+
+
+class _EngineServerMixin:
+    """
+    The request handling that the Unix and TCP servers share. Every connection is answered on its
+    own thread, but the searches run one at a time, since they all use the same model and
+    transposition table.
+    """
+    daemon_threads = True
+
+    def handle_request_json(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'find_best_move':
+            with self.search_lock:
+                move, value, search_time = self.engine.find_best_move(
+                    request['fen'], request.get('time_budget_ms'), request.get('quantization', self.engine.quantization),
+                    request.get('search', 'alpha_beta'))
+            return {'move': move, 'value': value, 'time': search_time}
+        if cmd == 'ping':
+            return {'ok': True}
+        if cmd == 'shutdown':
+            # shutdown() waits for serve_forever() to return, so it can not be called from its thread
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {'ok': True, 'shutdown': True}
+        raise ValueError(f'Unknown command {cmd}')
+
+
+class UnixEngineServer(_EngineServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, socket_path, engine):
+        self.engine = engine
+        self.search_lock = threading.Lock()
+        super().__init__(socket_path, EngineRequestHandler)
+
+
+class TCPEngineServer(_EngineServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, host, port, engine):
+        self.engine = engine
+        self.search_lock = threading.Lock()
+        super().__init__((host, port), EngineRequestHandler)
+
+
+def lock_file(path, blocking=True):
+    """
+    Opens the file (creating it if needed) and takes an exclusive lock on it. The lock is held
+    until the returned file is closed or the process exits. The file itself is never removed,
+    since a process could be waiting for the lock of the removed file.
+
+    Output:
+        file: The open file, or None if blocking is False and another process holds the lock
+    """
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1', model_path=MODEL_PATH, tt_size_mb=64,
+          inference_socket=None, quantization=None, mcts_workers=1, mcts_batch_size=1, search_workers=1):
+    """
+    Loads the engine and answers requests until a shutdown request comes in.
+
+    Arguments:
+        socket_path (str): The Unix socket to listen on (when port is None)
+        port (int): The TCP port to listen on instead of a Unix socket
+        host (str): The address the TCP port is opened on
+        model_path (str): The .h5 model that evaluates positions (or a .npz exported from one, see
+            eval/numpy_model.py, which loads without TensorFlow)
+        tt_size_mb (float): The memory budget of the transposition table in MB
+        inference_socket (str): Optional socket of the inference server that evaluates the model
+        quantization (str): Optional 'int8' or 'float16', the quantized model the daemon uses when a
+            request does not say
+        mcts_workers (int): The number of threads of the MCTS
+        mcts_batch_size (int): How many leaves every MCTS thread evaluates at a time
+        search_workers (int): The number of processes of the alpha-beta search (Lazy SMP)
+    """
+    # Only one daemon runs on a socket. Its lock is released when it exits, even if it dies.
+    daemon_lock = None
+    if port is None:
+        daemon_lock = lock_file(socket_path + '.lock', blocking=False)
+        if daemon_lock is None:
+            exit(f'Error - An engine is already running on {socket_path}')
+
+    start_time = time.time()
+    engine = Engine(model_path, tt_size_mb, inference_socket, quantization, mcts_workers, mcts_batch_size,
+                    search_workers)
+    print(f'Loaded the engine in {time.time() - start_time:.1f}s', flush=True)
+
+    if port is not None:
+        server = TCPEngineServer(host, port, engine)
+        print(f'Listening on {host}:{port}', flush=True)
+    else:
+        # We hold the lock, so a socket file that is there was left behind by a daemon that died
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixEngineServer(socket_path, engine)
+        print(f'Listening on {socket_path}', flush=True)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+        if engine.smp is not None:
+            engine.smp.close()
+        if daemon_lock is not None:
+            daemon_lock.close()
+
+
+def _connect(socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1', timeout=None):
+    if port is not None:
+        return socket.create_connection((host, port), timeout=timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(socket_path)
+    return sock
+
+
+def send_request(request, socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1', timeout=None):
+    """
+    Sends one request to the daemon and returns its response.
+
+    Raises:
+        ConnectionError: If no daemon is listening (OSError subclasses, e.g. FileNotFoundError for a
+            missing socket file, are raised as they are)
+        RuntimeError: If the daemon answered with an error
+    """
+    with _connect(socket_path, port, host, timeout) as sock:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('The engine closed the connection without answering')
+    response = json.loads(line)
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response
+
+
+def ping(socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1'):
+    """
+    Returns True if a daemon is answering on the socket or port.
+    """
+    try:
+        return send_request({'cmd': 'ping'}, socket_path, port, host, timeout=2.).get('ok', False)
+    except (OSError, ValueError, RuntimeError):
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the engine as a daemon that answers find_best_move requests.')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH, help='Unix socket to listen on')
+    parser.add_argument('--port', type=int, default=None, help='TCP port to listen on instead of a Unix socket')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--model', type=str, default=MODEL_PATH)
+    parser.add_argument('--tt-size-mb', type=float, default=64)
+    parser.add_argument('--inference-socket', type=str, default=None,
+                        help='Evaluate the model through the inference server on this socket instead of loading it')
+    parser.add_argument('--quantization', type=str, default=None, choices=['int8', 'float16'],
+                        help='Search with the quantized model (see eval/quantize.py) unless a request says otherwise')
+    parser.add_argument('--mcts-workers', type=int, default=1, help='Number of threads of the MCTS search')
+    parser.add_argument('--mcts-batch-size', type=int, default=1,
+                        help='Leaves every MCTS thread collects before evaluating them in one batch')
+    parser.add_argument('--search-workers', type=int, default=1,
+                        help='Processes of the alpha-beta search (Lazy SMP with a shared transposition table)')
+
+    args = parser.parse_args()
+
+    if args.inference_socket is None and not os.path.isfile(args.model):
+        exit(f'Error - There is no model at {args.model}')
+
+    serve(args.socket, args.port, args.host, args.model, args.tt_size_mb, args.inference_socket, args.quantization,
+          args.mcts_workers, args.mcts_batch_size, args.search_workers)
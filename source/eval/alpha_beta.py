@@ -1,6 +1,6 @@
 """
-This script will be the Monte Carlo implementation that will be the way our Chess Engine is able
-to go down potential moves and choose the best one.
+This script implements the alpha-beta search that our Chess Engine uses to go down potential moves
+and choose the best one.
 
 Author: Keon Roohparvar
 Date: 11/3/2022
@@ -11,192 +11,724 @@ import os
 import sys
 import time
 
-import tensorflow as tf
+import chess
 import numpy as np
 
 # Local imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from board import ChessBoard
-from eval.count_material import eval_material
+from eval.count_material import material_balance, PIECE_VALUES
+from eval.transposition_table import zobrist_hash, push_hashed, push_null_hashed, EXACT, LOWER, UPPER
+from eval.move_ordering import HeuristicOrderer
 
 
-def alphaBetaMax(board, alpha, beta, depth, max_depth):
+# How many nodes the search visits between two looks at the clock
+LIMIT_CHECK_INTERVAL = 256
+
+# The deepest that an iterative deepening search will go when it only has a time or node budget
+MAX_SEARCH_DEPTH = 64
+
+# The most plies the quiescence search goes below a leaf of the main search
+MAX_QUIESCENCE_DEPTH = 16
+
+# Delta pruning: a capture is not searched if even winning the captured piece (and this much more)
+# would not bring the material up to alpha (or down to beta for Black)
+DELTA_MARGIN = 2
+
+# Null-move pruning: the side to move passes, and if a search that is NULL_MOVE_REDUCTION plies
+# shallower still fails high, so would a real move. Only tried with at least NULL_MOVE_MIN_DEPTH
+# plies left to search.
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+
+# Late-move reductions: the quiet moves after the first LMR_MIN_MOVES moves of a node are searched
+# one ply shallower (two plies from the LMR_LATE_MOVES-th move on) when there are at least
+# LMR_MIN_DEPTH plies left, and only searched to full depth again if they beat alpha
+LMR_MIN_MOVES = 3
+LMR_LATE_MOVES = 8
+LMR_MIN_DEPTH = 3
+
+# The width of the null windows of the principal variation search and of null-move pruning. The
+# leaves are worth whole pawns, so a window of one pawn only asks if a move is better or not.
+NULL_WINDOW = 1
+
+
+class SearchTimeout(Exception):
     """
-    Helper function for AB-Pruning. 
+    Raised inside the search when it runs out of its time or node budget.
     """
-    
-    # BELOW IS PRINTS FOR DEBBUGING
-    # print(f'in max, depth is {depth} and board is ->')
-    # board.print_board()
-    # print(f'fen is {board.get_fen()}')
-    # print(f'ev is : {eval_material(board)}')
+    pass
 
-    # Handles game-ending situations
-    game_is_done, reason = board.game_is_done()
-    if game_is_done:
-        if reason == 'checkmate':
+
+class SearchState:
+    """
+    Book-keeping that is shared by every node of one search. The search plays moves on a single
+    board with push/pop, so anything that has to outlive a single node lives in here instead.
+
+    Arguments:
+        tt (TranspositionTable): Optional transposition table to probe and store through
+        deadline (float): Optional time.time() at which the search raises SearchTimeout
+        node_limit (int): Optional node count at which the search raises SearchTimeout
+        orderer (MoveOrderer): The move ordering of the search. Defaults to a HeuristicOrderer.
+        stop_event (threading.Event): Optional event that stops the search when it is set (e.g. by
+            the UCI "stop" command)
+        quiescence (bool): If the leaves of the search are extended with a quiescence search of the
+            captures and promotions, instead of being evaluated in the middle of an exchange
+        quiescence_checks (bool): If the first ply of the quiescence search also tries the quiet
+            moves that give check
+        null_move (bool): If the search uses null-move pruning
+        lmr (bool): If the search uses late-move reductions
+        pvs (bool): If the search uses principal variation search: after the first move of a
+            node, the other moves are searched with a null window, and only searched again with
+            the full window if they turn out to be better
+
+    nodes counts every node that was searched, and qnodes the ones of the quiescence search
+    among them.
+    """
+    def __init__(self, tt=None, deadline=None, node_limit=None, orderer=None, stop_event=None, quiescence=True,
+                 quiescence_checks=False, null_move=True, lmr=True, pvs=True):
+        self.nodes = 0
+        self.qnodes = 0
+        self.tt = tt
+        self.orderer = orderer if orderer is not None else HeuristicOrderer()
+        self.quiescence = quiescence
+        self.quiescence_checks = quiescence_checks
+        self.null_move = null_move
+        self.lmr = lmr
+        self.pvs = pvs
+        self.set_limits(deadline, node_limit, stop_event)
+
+    def set_limits(self, deadline=None, node_limit=None, stop_event=None):
+        """
+        Sets (or removes) the time and node budget of the search, and the event that stops it.
+        """
+        self.deadline = deadline
+        self.node_limit = node_limit
+        self.stop_event = stop_event
+        if deadline is None and node_limit is None and stop_event is None:
+            self.next_check = float('inf')
+        else:
+            self.next_check = self.nodes
+
+    def check_limits(self):
+        """
+        Raises SearchTimeout if the search is out of budget. The nodes call this every 
+        LIMIT_CHECK_INTERVAL nodes (see next_check) instead of looking at the clock every time.
+        """
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchTimeout()
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchTimeout()
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise SearchTimeout()
+
+        self.next_check = self.nodes + LIMIT_CHECK_INTERVAL
+        if self.node_limit is not None:
+            self.next_check = min(self.next_check, self.node_limit)
+
+
+def push_move(board, move, key, state):
+    """
+    Plays a move on the shared board, and returns the Zobrist hash of the new position if the
+    search is using a transposition table (or None if it is not).
+    """
+    if state.tt is None:
+        board.push(move)
+        return None
+    return push_hashed(board, move, key)
+
+
+def push_null_move(board, key, state):
+    """
+    Passes the turn on the shared board (see push_move()).
+    """
+    if state.tt is None:
+        board.push(chess.Move.null())
+        return None
+    return push_null_hashed(board, key)
+
+
+def can_null_move(board, in_check):
+    """
+    Checks if null-move pruning may be tried on a board. It is not tried in check (passing would be
+    illegal), right after another null move, or when the side to move only has pawns left: in such
+    endgames every move can make the position worse (zugzwang), so passing is not a fair guess of
+    the best move.
+    """
+    chess_board = board.board
+    if in_check or (chess_board.move_stack and not chess_board.move_stack[-1]):
+        return False
+    return chess_board.occupied_co[chess_board.turn] & ~(chess_board.pawns | chess_board.kings) != 0
+
+
+def late_move_reduction(board, move, move_index, depth, max_depth, in_check, state):
+    """
+    Returns how many plies shallower a move is searched (see LMR_MIN_MOVES), before it is played.
+    Captures, promotions, checks and moves out of check are never reduced.
+    """
+    if not state.lmr or in_check or move_index < LMR_MIN_MOVES or max_depth - depth < LMR_MIN_DEPTH:
+        return 0
+    chess_board = board.board
+    if move.promotion or chess_board.is_capture(move) or chess_board.gives_check(move):
+        return 0
+    reduction = 1 if move_index < LMR_LATE_MOVES else 2
+    return min(reduction, max_depth - depth - 1)
+
+
+def search_game_over(board, repetitions=2):
+    """
+    Checks if the game is over at a node of the search. This only looks for the first legal move
+    (instead of the full draw-claim check in ChessBoard.game_is_done, which plays every legal move
+    on the board), so it is cheap enough to run at every node.
+
+    A position that repeats is scored as a draw. Inside the search, the first repetition is
+    enough: if repeating was good for one side, it can repeat again, so the line is a draw anyway.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object
+        repetitions (int): How many times the position has to have occurred to be a draw. The root
+            of a search is a position of the real game, which is only drawn after 3.
+    
+    Output:
+        (bool, float): If the game is over, and the value of the board if it is
+    """
+    chess_board = board.board
+    if not any(chess_board.generate_legal_moves()):
+        if chess_board.is_check():
             # If it's checkmate and white's turn, then Black won -> -infinity
-            if board.get_turn():
-                return -1 * np.inf, depth
+            if chess_board.turn == chess.WHITE:
+                return True, -1 * np.inf
             # If it's checkmate and black's turn, then White won -> +infinity
             else:
-                return +1 * np.inf, depth
-        # Draw
-        else: 
-            return 0, depth
+                return True, +1 * np.inf
+        # Stalemate
+        return True, 0
+
+    # Fifty move rule
+    if chess_board.halfmove_clock >= 100:
+        return True, 0
+
+    # Repetition. A position can only repeat after at least 4 reversible plies
+    if chess_board.halfmove_clock >= 4 and chess_board.is_repetition(repetitions):
+        return True, 0
+
+    return False, None
+
+
+def alphaBetaMax(board, alpha, beta, depth, max_depth, state, key=None):
+    """
+    Helper function for AB-Pruning. White is to move, so this node raises alpha.
+    """
+    state.nodes += 1
+    if state.nodes >= state.next_check:
+        state.check_limits()
+
+    # Handles game-ending situations
+    game_is_done, value = search_game_over(board)
+    if game_is_done:
+        return value, depth
 
-    # If Depth is max depth, we are at the end and we'll return the evaluation of this board
+    # If Depth is max depth, we are at the end and we'll return the evaluation of this board (once
+    # the captures on it are played out)
     if depth == max_depth:
+        if state.quiescence:
+            return quiescenceMax(board, alpha, beta, depth, state)
         # this_evaluation = model.predict(np.array([board.positional_encode()]), verbose=0)[0][0]
-        this_evaluation = eval_material(board)
+        this_evaluation = material_balance(board)
         return this_evaluation, depth
 
-    # Get Possible moves
-    starter_board_fen = board.get_fen()
-    legal_moves = list(board.get_legal_moves())
-    possible_boards = []
-    for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(starter_board_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
-    
-    # Iterate over moves while updating alpha; also, we watch for a beta break
+    # If we already searched this position at least as deep, we might not have to search it again
+    tt = state.tt
+    hash_move = None
+    if tt is not None:
+        entry = tt.probe(key)
+        if entry is not None:
+            tt_depth, tt_bound, tt_score, hash_move, tt_depth_below = entry
+            if tt_depth >= max_depth - depth:
+                if tt_bound == EXACT:
+                    return tt_score, depth + tt_depth_below
+                if tt_bound == LOWER and tt_score >= beta:
+                    return beta, depth + tt_depth_below
+                if tt_bound == UPPER and tt_score <= alpha:
+                    return alpha, depth + tt_depth_below
+
+    # Null-move pruning: if White could pass and still be at least beta after a shallower search,
+    # the real moves are not worth searching
+    in_check = board.board.is_check()
+    if (state.null_move and max_depth - depth >= NULL_MOVE_MIN_DEPTH and beta != np.inf and can_null_move(board, in_check)
+            and material_balance(board) >= beta):
+        null_key = push_null_move(board, key, state)
+        null_score, _ = alphaBetaMin(board, beta - NULL_WINDOW, beta, depth+1, max_depth - NULL_MOVE_REDUCTION, state, null_key)
+        board.pop()
+        if null_score >= beta:
+            return beta, depth
+
+    # Iterate over moves while updating alpha; also, we watch for a beta break. Each move is 
+    # played on the shared board and taken back right after it is searched, so the moves after a
+    # beta break are never played at all. The best moves are tried first (see move_ordering.py)
     depth_reached = depth
-    for board in possible_boards:
-        this_board_score, this_depth_reached = alphaBetaMin(board, alpha, beta, depth+1, max_depth)
+    best_move = None
+    orderer = state.orderer
+    for move_index, legal_move in enumerate(orderer.ordered_moves(board, depth, hash_move)):
+        reduction = late_move_reduction(board, legal_move, move_index, depth, max_depth, in_check, state)
+        child_key = push_move(board, legal_move, key, state)
+        # After the first move, the others are searched with a null window (and late quiet moves
+        # less deep) first, and only searched again fully if they raise alpha
+        null_window = state.pvs and move_index > 0 and alpha != -np.inf
+        if null_window or reduction:
+            window_beta = alpha + NULL_WINDOW if null_window else beta
+            this_board_score, this_depth_reached = alphaBetaMin(board, alpha, window_beta, depth+1, max_depth - reduction, state, child_key)
+            if this_board_score > alpha and (reduction or window_beta < beta):
+                this_board_score, this_depth_reached = alphaBetaMin(board, alpha, beta, depth+1, max_depth, state, child_key)
+        else:
+            this_board_score, this_depth_reached = alphaBetaMin(board, alpha, beta, depth+1, max_depth, state, child_key)
+        board.pop()
         if this_board_score >= beta:
+            orderer.record_cutoff(board, legal_move, depth, max_depth - depth, move_index)
+            if tt is not None:
+                tt.store(key, max_depth - depth, LOWER, beta, legal_move, this_depth_reached - depth)
             return beta, this_depth_reached
         if this_board_score > alpha:
             alpha = this_board_score
             depth_reached = this_depth_reached
+            best_move = legal_move
+
+    # If no move raised alpha, we only know that this board is worth at most alpha
+    if tt is not None:
+        bound = EXACT if best_move is not None else UPPER
+        tt.store(key, max_depth - depth, bound, alpha, best_move, depth_reached - depth)
 
     return alpha, depth_reached
 
 
-def alphaBetaMin(board, alpha, beta, depth, max_depth):
+def alphaBetaMin(board, alpha, beta, depth, max_depth, state, key=None):
     """
-    Helper function for AB-Pruning. 
+    Helper function for AB-Pruning. Black is to move, so this node lowers beta.
     """
-
-    # BELOW IS PRINTS FOR DEBUGGING
-    # print(f'in min, depth is {depth} and board is ->')
-    # board.print_board()
-    # print(f'fen is {board.get_fen()}')
-    # print(f'ev is : {eval_material(board)}')
+    state.nodes += 1
+    if state.nodes >= state.next_check:
+        state.check_limits()
 
     # Handles game-ending situations
-    game_is_done, reason = board.game_is_done()
+    game_is_done, value = search_game_over(board)
     if game_is_done:
-        if reason == 'checkmate':
-            # If it's checkmate and white's turn, then Black won -> -infinity
-            if board.get_turn():
-                return -1 * np.inf, depth
-            # If it's checkmate and black's turn, then White won -> +infinity
-            else:
-                return +1 * np.inf, depth
-        # Draw
-        else: 
-            return 0, depth
+        return value, depth
 
-    # If Depth is max depth, we are at the end and we'll return the evaluation of this board
+    # If Depth is max depth, we are at the end and we'll return the evaluation of this board (once
+    # the captures on it are played out)
     if depth == max_depth:
-        this_evaluation = eval_material(board)
+        if state.quiescence:
+            return quiescenceMin(board, alpha, beta, depth, state)
+        this_evaluation = material_balance(board)
         return this_evaluation, depth
 
+    # If we already searched this position at least as deep, we might not have to search it again
+    tt = state.tt
+    hash_move = None
+    if tt is not None:
+        entry = tt.probe(key)
+        if entry is not None:
+            tt_depth, tt_bound, tt_score, hash_move, tt_depth_below = entry
+            if tt_depth >= max_depth - depth:
+                if tt_bound == EXACT:
+                    return tt_score, depth + tt_depth_below
+                if tt_bound == UPPER and tt_score <= alpha:
+                    return alpha, depth + tt_depth_below
+                if tt_bound == LOWER and tt_score >= beta:
+                    return beta, depth + tt_depth_below
+
+    # Null-move pruning: if Black could pass and still be at most alpha after a shallower search,
+    # the real moves are not worth searching
+    in_check = board.board.is_check()
+    if (state.null_move and max_depth - depth >= NULL_MOVE_MIN_DEPTH and alpha != -np.inf and can_null_move(board, in_check)
+            and material_balance(board) <= alpha):
+        null_key = push_null_move(board, key, state)
+        null_score, _ = alphaBetaMax(board, alpha, alpha + NULL_WINDOW, depth+1, max_depth - NULL_MOVE_REDUCTION, state, null_key)
+        board.pop()
+        if null_score <= alpha:
+            return alpha, depth
 
-    # Get Possible moves
-    starter_board_fen = board.get_fen()
-    legal_moves = list(board.get_legal_moves())
-    possible_boards = []
-    for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(starter_board_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
-    
     # Iterate over moves while updating beta; also, we watch for an alpha break
     depth_reached = depth
-    for board in possible_boards:
-        this_board_score, this_depth_reached = alphaBetaMax(board, alpha, beta, depth+1, max_depth)
+    best_move = None
+    orderer = state.orderer
+    for move_index, legal_move in enumerate(orderer.ordered_moves(board, depth, hash_move)):
+        reduction = late_move_reduction(board, legal_move, move_index, depth, max_depth, in_check, state)
+        child_key = push_move(board, legal_move, key, state)
+        # After the first move, the others are searched with a null window (and late quiet moves
+        # less deep) first, and only searched again fully if they lower beta
+        null_window = state.pvs and move_index > 0 and beta != np.inf
+        if null_window or reduction:
+            window_alpha = beta - NULL_WINDOW if null_window else alpha
+            this_board_score, this_depth_reached = alphaBetaMax(board, window_alpha, beta, depth+1, max_depth - reduction, state, child_key)
+            if this_board_score < beta and (reduction or window_alpha > alpha):
+                this_board_score, this_depth_reached = alphaBetaMax(board, alpha, beta, depth+1, max_depth, state, child_key)
+        else:
+            this_board_score, this_depth_reached = alphaBetaMax(board, alpha, beta, depth+1, max_depth, state, child_key)
+        board.pop()
         if this_board_score <= alpha:
+            orderer.record_cutoff(board, legal_move, depth, max_depth - depth, move_index)
+            if tt is not None:
+                tt.store(key, max_depth - depth, UPPER, alpha, legal_move, this_depth_reached - depth)
             return alpha, this_depth_reached
         if this_board_score < beta:
             beta = this_board_score
             depth_reached = this_depth_reached
+            best_move = legal_move
+
+    # If no move lowered beta, we only know that this board is worth at least beta
+    if tt is not None:
+        bound = EXACT if best_move is not None else LOWER
+        tt.store(key, max_depth - depth, bound, beta, best_move, depth_reached - depth)
     
     # print(f'returning from min with beta of {beta}')
     return beta, depth_reached
 
-def ab_pruning(turn, board, max_depth):
+
+def quiescence_moves(board, in_check, checks=False):
+    """
+    Returns the moves that the quiescence search tries on a board, with the most material each of
+    them can win (None for a move that is only tried because it gives check). In check, these are
+    all of the moves that get out of check. Otherwise they are the captures and promotions, and
+    with checks the quiet moves that give check too.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object
+        in_check (bool): If the side to move is in check
+        checks (bool): If the quiet moves that give check are tried too
+
+    Output:
+        list: (gain, move) pairs, the most valuable victim first and the least valuable attacker
+            second (MVV-LVA). Out of check, captures of a defended piece that is worth less than the
+            capturing piece are left out, since they lose material.
+    """
+    chess_board = board.board
+    if in_check:
+        moves = chess_board.generate_legal_moves()
+    else:
+        # Captures, and the promotions that do not capture
+        promotion_squares = chess.BB_BACKRANKS & ~chess_board.occupied
+        moves = list(chess_board.generate_legal_captures())
+        moves += chess_board.generate_legal_moves(chess_board.pawns, promotion_squares)
+
+    scored_moves = []
+    for move in moves:
+        victim = chess_board.piece_type_at(move.to_square)
+        if victim is None and chess_board.is_en_passant(move):
+            victim = chess.PAWN
+        gain = PIECE_VALUES.get(victim, 0)
+        if move.promotion:
+            gain += PIECE_VALUES[move.promotion] - PIECE_VALUES[chess.PAWN]
+        attacker = PIECE_VALUES.get(chess_board.piece_type_at(move.from_square), 100)
+        if not in_check and not move.promotion and gain < attacker and chess_board.is_attacked_by(not chess_board.turn, move.to_square):
+            continue
+        scored_moves.append((gain, -attacker, move))
+    scored_moves.sort(key=lambda x: x[:2], reverse=True)
+    scored_moves = [(gain, move) for gain, _, move in scored_moves]
+
+    if checks and not in_check:
+        for move in chess_board.generate_legal_moves(chess.BB_ALL, chess.BB_ALL & ~chess_board.occupied):
+            if not move.promotion and not chess_board.is_en_passant(move) and chess_board.gives_check(move):
+                scored_moves.append((None, move))
+    return scored_moves
+
+
+def quiescenceMax(board, alpha, beta, depth, state, qdepth=0):
+    """
+    Quiescence search for White, below a leaf of the main search. White can stop capturing at any
+    point, so the board is worth at least its material (stand pat), and only the captures and
+    promotions that might do better than that are searched. In check, every move out of check is
+    searched instead, since standing pat is not an option.
+    """
+    state.nodes += 1
+    state.qnodes += 1
+    if state.nodes >= state.next_check:
+        state.check_limits()
+
+    in_check = board.board.is_check()
+    moves = quiescence_moves(board, in_check, state.quiescence_checks and qdepth == 0)
+    if in_check and not moves:
+        return -1 * np.inf, depth
+
+    stand_pat = material_balance(board)
+    if not in_check:
+        if stand_pat >= beta:
+            return beta, depth
+        if stand_pat > alpha:
+            alpha = stand_pat
+    if qdepth >= MAX_QUIESCENCE_DEPTH:
+        return min(max(stand_pat, alpha), beta), depth
+
+    depth_reached = depth
+    for gain, move in moves:
+        # Delta pruning: even winning this piece for free would not be enough
+        if not in_check and gain is not None and stand_pat + gain + DELTA_MARGIN <= alpha:
+            continue
+        board.push(move)
+        this_board_score, this_depth_reached = quiescenceMin(board, alpha, beta, depth+1, state, qdepth+1)
+        board.pop()
+        if this_board_score >= beta:
+            return beta, this_depth_reached
+        if this_board_score > alpha:
+            alpha = this_board_score
+            depth_reached = this_depth_reached
+
+    return alpha, depth_reached
+
+
+def quiescenceMin(board, alpha, beta, depth, state, qdepth=0):
+    """
+    Quiescence search for Black, below a leaf of the main search (see quiescenceMax()).
+    """
+    state.nodes += 1
+    state.qnodes += 1
+    if state.nodes >= state.next_check:
+        state.check_limits()
+
+    in_check = board.board.is_check()
+    moves = quiescence_moves(board, in_check, state.quiescence_checks and qdepth == 0)
+    if in_check and not moves:
+        return +1 * np.inf, depth
+
+    stand_pat = material_balance(board)
+    if not in_check:
+        if stand_pat <= alpha:
+            return alpha, depth
+        if stand_pat < beta:
+            beta = stand_pat
+    if qdepth >= MAX_QUIESCENCE_DEPTH:
+        return max(min(stand_pat, beta), alpha), depth
+
+    depth_reached = depth
+    for gain, move in moves:
+        # Delta pruning: even winning this piece for free would not be enough
+        if not in_check and gain is not None and stand_pat - gain - DELTA_MARGIN >= beta:
+            continue
+        board.push(move)
+        this_board_score, this_depth_reached = quiescenceMax(board, alpha, beta, depth+1, state, qdepth+1)
+        board.pop()
+        if this_board_score <= alpha:
+            return alpha, this_depth_reached
+        if this_board_score < beta:
+            beta = this_board_score
+            depth_reached = this_depth_reached
+
+    return beta, depth_reached
+
+def search_root_moves(turn, board, root_moves, max_depth, state, key=None):
+    """
+    Searches every root move with a full window, so that each of them gets its exact value.
+
+    If the search runs out of budget, the board is put back in its original position before
+    SearchTimeout is raised again.
+
+    Arguments:
+        turn (str): Either 'W' or 'B', the side to move on the board
+        board (ChessBoard): Our ChessBoard object
+        root_moves (list): The moves to search, in the order to search them
+        max_depth (int): The maximum depth our algorithm should iterate too
+        state (SearchState): The search book-keeping
+        key (int): The Zobrist hash of the board, if the search is using a transposition table
+
+    Output:
+        (list, list): The value and depth reached of every root move
+    """
+    values = []
+    depths_reached = []
+    stack_size = len(board.board.move_stack)
+    try:
+        for legal_move in root_moves:
+            child_key = push_move(board, legal_move, key, state)
+            if turn == 'W':
+                this_value, this_depth_reached = alphaBetaMin(board, alpha=-1*np.inf, beta=np.inf, depth=1, max_depth=max_depth, state=state, key=child_key)
+            elif turn == 'B':
+                this_value, this_depth_reached = alphaBetaMax(board, alpha=-1*np.inf, beta=np.inf, depth=1, max_depth=max_depth, state=state, key=child_key)
+            board.pop()
+
+            # print(f'this val: {this_value}')
+            values.append(this_value)
+            depths_reached.append(this_depth_reached)
+    except SearchTimeout:
+        while len(board.board.move_stack) > stack_size:
+            board.pop()
+        raise
+
+    return values, depths_reached
+
+
+def hash_move_first(board, legal_moves, state, key):
+    """
+    Moves the best move that the transposition table has for this board (e.g. from the previous
+    iteration of iterative deepening) to the front of the move list.
+    """
+    if state.tt is None:
+        return legal_moves
+    entry = state.tt.probe(key)
+    if entry is None or entry[3] not in legal_moves:
+        return legal_moves
+    hash_move = entry[3]
+    return [hash_move] + [move for move in legal_moves if move != hash_move]
+
+
+def principal_variation(board, state, first_move, max_length=MAX_SEARCH_DEPTH):
+    """
+    Returns the line the search expects after first_move, by following the best moves that the
+    transposition table has for each position. The board is back in its original position when
+    this returns.
+    """
+    pv = [first_move]
+    if state.tt is None:
+        return pv
+
+    key = push_hashed(board, first_move, zobrist_hash(board))
+    seen = {key}
+    while len(pv) < max_length:
+        entry = state.tt.probe(key)
+        if entry is None or entry[3] is None or not board.board.is_legal(entry[3]):
+            break
+        key = push_hashed(board, entry[3], key)
+        pv.append(entry[3])
+        if key in seen:
+            break
+        seen.add(key)
+    for _ in pv:
+        board.pop()
+    return pv
+
+
+def ab_pruning(turn, board, max_depth, state=None):
     """
     The main implementation for AB-Pruning. This will utilize the AB-Pruning algorithm to look
     through the move tree to find the best move for White or Black, pruning branches that result
     in too high of a loss of material.
 
+    The whole search runs on the board that is passed in: moves are pushed and popped on it, and
+    it is back in its original position when this returns.
+
     Arguments:
         turn (str): Either 'W' or 'B', for White or Black, respectively
         board (ChessBoard) : Our ChessBoard object
         max_depth (int): The maximum depth our algorithm should iterate too
+        state (SearchState): Optional search book-keeping (e.g. to read the node count afterwards,
+            or to search with a transposition table)
     """
-
-    # BELOW IS PRINTS FOR DEBUGGING
-    # print(f'\n----ROOT-----\nTurn is {turn}, board is ->')
-    # board.print_board()
-    # print(f'fen is {board.get_fen()}')
-    # ev = eval_material(board)
-    # print(f'ev is : {ev}')
-    # print('\n--\n')
+    if state is None:
+        state = SearchState()
 
     # Handles Draws/Stalemates
-    game_is_done, reason = board.game_is_done()
+    game_is_done, value = search_game_over(board, repetitions=3)
     if game_is_done:
-        if reason == 'checkmate':
-            # If it's checkmate and white's turn, then Black won -> -infinity
-            if board.get_turn():
-                return None, -1 * np.inf, 1
-            # If it's checkmate and black's turn, then White won -> +infinity
-            else:
-                return None, +1 * np.inf, 1
-        # Draw
-        else: 
-            return None, 0, 1
-
-    # Get all possible boards from this point
-    original_fen = board.get_fen()
-    legal_moves = list(board.get_legal_moves())
-    possible_boards = []
-    for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(original_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
-
-    # Go through possibilities and do alpha beta pruning
-    values = []
-    times = []
-    depths_reached = []
-    for board in possible_boards:
-        starttime = time.time()
-        if turn == 'W':
-            this_value, this_depth_reached = alphaBetaMin(board, alpha=-1*np.inf, beta=np.inf, depth=1, max_depth=max_depth)
-        elif turn == 'B':
-            this_value, this_depth_reached = alphaBetaMax(board, alpha=-1*np.inf, beta=np.inf, depth=1, max_depth=max_depth)
-
-        endtime = time.time()
-        times.append(endtime - starttime)
-
-        # print(f'this val: {this_value}')
-        values.append(this_value)
-        depths_reached.append(this_depth_reached)
+        return None, value, 1
+
+    # If this exact position was already searched deep enough, we can reuse its best move
+    tt = state.tt
+    key = None
+    if tt is not None:
+        key = zobrist_hash(board)
+        entry = tt.probe(key)
+        if entry is not None:
+            tt_depth, tt_bound, tt_score, tt_move, tt_depth_below = entry
+            if tt_depth >= max_depth and tt_bound == EXACT and tt_move is not None and board.board.is_legal(tt_move):
+                return tt_move, tt_score, tt_depth_below
+
+    # Go through possibilities and do alpha beta pruning, starting with the best move we know of
+    legal_moves = hash_move_first(board, list(board.get_legal_moves()), state, key)
+    values, depths_reached = search_root_moves(turn, board, legal_moves, max_depth, state, key)
     
     # Choose the board that yields the highest value
     if turn == 'W':
-        best_move = legal_moves[np.argmax(values)]
-        # print(f'Best move: {best_move}\n----\n')
-        return best_move, np.max(values), depths_reached[np.argmax(values)]
+        best_ind = np.argmax(values)
     else:
-        best_move = legal_moves[np.argmin(values)]
-        # print(f'Best move: {best_move}\n----\n')
-        return best_move, np.min(values), depths_reached[np.argmin(values)]
-        
\ No newline at end of file
+        best_ind = np.argmin(values)
+    best_move = legal_moves[best_ind]
+    # print(f'Best move: {best_move}\n----\n')
+
+    if tt is not None:
+        tt.store(key, max_depth, EXACT, values[best_ind], best_move, depths_reached[best_ind])
+
+    return best_move, values[best_ind], depths_reached[best_ind]
+
+
+def iterative_deepening(turn, board, state, max_depth=None, time_budget_ms=None, node_budget=None, stop_event=None,
+                        on_iteration=None, start_depth=1, root_moves=None):
+    """
+    Searches the board to depth 1, then 2, then 3, ... until max_depth or until the time or node
+    budget runs out, and returns the results of the deepest iteration that finished. The first
+    iteration always finishes, so there is always a move to play.
+
+    Every iteration searches the root moves in the order of the previous iteration's values (best
+    first), and every position keeps its best move in the transposition table, so each iteration
+    starts with the line the previous one found.
+
+    Arguments:
+        turn (str): Either 'W' or 'B', for White or Black, respectively
+        board (ChessBoard): Our ChessBoard object
+        state (SearchState): The search book-keeping (usually with a transposition table)
+        max_depth (int): The deepest iteration. Defaults to MAX_SEARCH_DEPTH.
+        time_budget_ms (float): Optional wall-clock budget of the whole search in milliseconds
+        node_budget (int): Optional node budget of the whole search
+        stop_event (threading.Event): Optional event that stops the search once it is set (after
+            the first iteration, like the budgets)
+        on_iteration (function): Optional function that is called after every finished iteration
+            with the iteration's depth, the root moves, values and depths reached (best first) and
+            the state
+        start_depth (int): The depth of the first iteration
+        root_moves (list): Optional order of the root moves in the first iteration. Defaults to
+            the legal moves with the transposition table's best move first.
+
+    Output:
+        (list, list, list, int): The root moves sorted best first, their values, their depths
+            reached and the depth of the iteration they came from
+    """
+    start_time = time.time()
+    if max_depth is None:
+        max_depth = MAX_SEARCH_DEPTH
+
+    start_nodes = state.nodes
+    key = zobrist_hash(board) if state.tt is not None else None
+    if root_moves is None:
+        root_moves = hash_move_first(board, list(board.get_legal_moves()), state, key)
+    values, depths_reached, completed_depth = [], [], 0
+    if not root_moves:
+        return root_moves, values, depths_reached, completed_depth
+
+    for search_depth in range(start_depth, max_depth + 1):
+        try:
+            these_values, these_depths_reached = search_root_moves(turn, board, root_moves, search_depth, state, key)
+        except SearchTimeout:
+            break
+
+        # Sort the root moves best first, so the next iteration starts with this iteration's best
+        order = sorted(range(len(root_moves)), key=lambda i: these_values[i], reverse=(turn == 'W'))
+        root_moves = [root_moves[i] for i in order]
+        values = [these_values[i] for i in order]
+        depths_reached = [these_depths_reached[i] for i in order]
+        completed_depth = search_depth
+
+        if state.tt is not None:
+            state.tt.store(key, search_depth, EXACT, values[0], root_moves[0], depths_reached[0])
+        if on_iteration is not None:
+            on_iteration(search_depth, root_moves, values, depths_reached, state)
+
+        # A forced checkmate will not get any better by searching deeper
+        if values[0] == (np.inf if turn == 'W' else -1 * np.inf):
+            break
+
+        # The budget only starts counting after the first iteration. If half of the time is gone, 
+        # the next iteration would not finish anyway
+        if time_budget_ms is not None:
+            elapsed_ms = (time.time() - start_time) * 1000
+            if elapsed_ms >= time_budget_ms / 2:
+                break
+            state.set_limits(deadline=start_time + time_budget_ms / 1000, node_limit=state.node_limit, stop_event=state.stop_event)
+        if node_budget is not None:
+            state.set_limits(deadline=state.deadline, node_limit=start_nodes + node_budget, stop_event=state.stop_event)
+        if stop_event is not None:
+            if stop_event.is_set():
+                break
+            state.set_limits(deadline=state.deadline, node_limit=state.node_limit, stop_event=stop_event)
+
+    # Leave the state without limits for whoever uses it next
+    state.set_limits()
+
+    return root_moves, values, depths_reached, completed_depth
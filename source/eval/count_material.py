@@ -8,18 +8,44 @@ import os
 import sys
 import time
 
-import tensorflow as tf
+import chess
 import numpy as np
 
-def eval_material(board):
-    fen = board.get_fen()
+# Value of each piece type, from White's point of view (Kings do not change the value)
+PIECE_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 10,
+}
+
+def material_balance(board):
+    """
+    Returns White's material minus Black's material, without checking whether the game is over.
+    This counts the bits of python-chess' piece bitboards instead of parsing the FEN, so it is
+    cheap enough to call at every leaf of the search.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object
+    """
+    chess_board = board.board
+
+    this_sum = 0
+    for piece_type, value in PIECE_VALUES.items():
+        num_white = chess.popcount(chess_board.pieces_mask(piece_type, chess.WHITE))
+        num_black = chess.popcount(chess_board.pieces_mask(piece_type, chess.BLACK))
+        this_sum += value * (num_white - num_black)
 
+    return this_sum
+
+def eval_material(board):
     # Handles end game boards
     game_is_done, reason = board.game_is_done()
     if game_is_done:
         if reason == 'checkmate':
             # If it's checkmate and white's turn, then Black won -> -infinity
-            if board.get_turn():
+            if board.get_turn() == 'W':
                 return -1 * np.inf
             # If it's checkmate and black's turn, then White won -> +infinity
             else:
@@ -28,25 +54,4 @@ def eval_material(board):
         else: 
             return 0
 
-
-    piece_dict = {
-        'p':-1,
-        'n':-3,
-        'b':-3,
-        'r':-5,
-        'q':-10,
-        'k':0, # Black King does not change val
-        'P':1,
-        'N':3,
-        'B':3,
-        'R':5,
-        'Q':10,
-        'K': 0 # White King does not change val
-    }
-
-    this_sum = 0
-    for c in fen.split(' ')[0]:
-        if c in piece_dict.keys():
-            this_sum += piece_dict[c]
-
-    return this_sum
+    return material_balance(board)
@@ -9,97 +9,152 @@ import os
 import sys
 import time
 
-import tensorflow as tf
 import numpy as np
 
 # Local imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from board import ChessBoard
-from eval.alpha_beta import ab_pruning
+from eval.alpha_beta import iterative_deepening, search_game_over, SearchState, MAX_SEARCH_DEPTH
+from eval.transposition_table import TranspositionTable
+from eval.leaf_evaluator import LeafEvaluator
+from eval.mcts import MCTS
+from eval.lazy_smp import LazySMP
 
-def evaluate_board(board: ChessBoard, model: tf.keras.Model, turn: str, print_boards: bool = False):
+# How deep we search when there is no time or node budget (our move, and then 3 more plies)
+DEFAULT_SEARCH_DEPTH = 4
+
+SEARCH_ALGORITHMS = ('alpha_beta', 'mcts')
+
+def evaluate_board(board: ChessBoard, model, turn: str, print_boards: bool = False, tt: TranspositionTable = None,
+                   time_budget_ms: float = None, node_budget: int = None, max_depth: int = None, stop_event=None,
+                   on_iteration=None, search: str = 'alpha_beta', mcts: MCTS = None, smp: LazySMP = None):
     """
     The high-level function that is able to take in a board and find the best move for White or Black. 
 
+    The search deepens one ply at a time (iterative deepening), so with a time or node budget it
+    plays the best move of the deepest search that finished within the budget.
+
     Arguments:
         board (ChessBoard): Our board object
-        model (tf.keras.Model): The model object who is responsible for this turn
+        model (tf.keras.Model or NumpyModel): The model object who is responsible for this turn
         turn (str): Either 'W' or 'B' for white or black, respectively 
         print_board (bool): A tool for debugging, it prints the intermediate boards and their guessed evals
+        tt (TranspositionTable): The transposition table the search probes and stores through. Pass
+            in the same table on every move of a game to keep what was learned on earlier moves.
+        time_budget_ms (float): Optional time budget for this move, in milliseconds
+        node_budget (int): Optional budget of search nodes for this move
+        max_depth (int): The deepest the search goes. Defaults to DEFAULT_SEARCH_DEPTH without a
+            budget, and to no limit with one.
+        stop_event (threading.Event): Optional event that stops the search when it is set
+        on_iteration (function): Optional function called after every finished iteration of the
+            search (see iterative_deepening())
+        search (str): 'alpha_beta', or 'mcts' for Monte Carlo Tree Search (see mcts.py). MCTS uses
+            the node budget as its number of playouts, and ignores max_depth and on_iteration.
+        mcts (MCTS): The tree MCTS searches with. Pass in the same tree on every move of a game to
+            reuse the part of it below the new position.
+        smp (LazySMP): Optional pool of processes to run the alpha-beta search on (see
+            lazy_smp.py). The search then uses the pool's shared transposition table instead of tt.
+
+    The model is only used to break ties between the best moves. Without a model (None), the
+    first of the tied moves is played.
+
+    If the game is already over (there is no legal move), the move is None.
     """
     
     # Time logging for eval board
     start_time = time.time()
 
-    # Save other person's turn
-    other_turn = 'B' if turn == 'W' else 'W'
-
-    # Get Possible moves
-    starter_board_fen = board.get_fen()
-    legal_moves = list(board.get_legal_moves())
-    # legal_moves = [list(board.get_legal_moves())[11]]
-    possible_boards = []
-    for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(starter_board_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
-    
-    # Perform Alpha Beta Pruning on all of the possible boards
-    possible_board_values = []
-    depths = []
-    for idx, possible_board in enumerate(possible_boards):
-        game_is_done, reason = possible_board.game_is_done()
-        if game_is_done:
-            if reason == 'checkmate':
-                return str(legal_moves[idx]), (np.inf if turn == 'W' else (-1*np.inf))
-        _, this_val, depth_reached = ab_pruning(other_turn, possible_board, max_depth=3)
-        possible_board_values.append(this_val)
-        depths.append(depth_reached)
+    if search == 'mcts':
+        return _evaluate_board_mcts(board, model, print_boards, time_budget_ms, node_budget, stop_event, mcts)
+    if search not in SEARCH_ALGORITHMS:
+        raise ValueError(f'Unknown search {search}, expected one of {SEARCH_ALGORITHMS}')
+
+    # All of the searches below share one transposition table, so a position that can be reached
+    # from several of our moves is only searched once
+    if smp is not None:
+        tt = smp.tt
+    elif tt is None:
+        tt = TranspositionTable()
+    tt.new_search()
+    state = SearchState(tt)
+
+    if max_depth is None:
+        if time_budget_ms is None and node_budget is None and stop_event is None:
+            max_depth = DEFAULT_SEARCH_DEPTH
+        else:
+            max_depth = MAX_SEARCH_DEPTH
+
+    # Perform Alpha Beta Pruning on all of the possible moves, which come back sorted best first
+    run_search = smp.search if smp is not None else iterative_deepening
+    legal_moves, possible_board_values, depths, search_depth = run_search(
+        turn, board, state, max_depth=max_depth, time_budget_ms=time_budget_ms, node_budget=node_budget,
+        stop_event=stop_event, on_iteration=on_iteration)
+
+    # Checkmate or stalemate, there is nothing to play
+    if not legal_moves:
+        return None, search_game_over(board)[1]
 
     # Go over maximum boards and evaluate with model
-    contains_checkmate = False
-    if turn == 'W':
-        boards_to_eval = [(i,move, depth) for (i,j, move, depth) in zip(possible_boards, possible_board_values, legal_moves, depths) if j == np.max(possible_board_values)]
-        if np.inf in possible_board_values:
-            contains_checkmate = True
-    if turn == 'B':
-        boards_to_eval = [(i,move, depth) for (i,j,move, depth) in zip(possible_boards, possible_board_values, legal_moves, depths) if j == np.min(possible_board_values)]
-        if -1 * np.inf in possible_board_values:
-            contains_checkmate = True
-
-        
+    best_value = possible_board_values[0]
+    boards_to_eval = [(move, depth) for (move, value, depth) in zip(legal_moves, possible_board_values, depths) if value == best_value]
+    contains_checkmate = best_value == (np.inf if turn == 'W' else -1 * np.inf)
 
     if print_boards:
-        print('\n---FINAL PRINT BOARDS----')
-        for board,val,depth in zip(possible_boards, possible_board_values, depths):
+        nodes = smp.stats()['nodes'] if smp is not None else state.nodes
+        print(f'\n---FINAL PRINT BOARDS (depth {search_depth}, {nodes} nodes ({state.qnodes} in quiescence), '
+              f'{time.time() - start_time:.2f}s, '
+              f'{state.orderer.stats()["first_move_cutoff_pct"]:.1f}% of cutoffs on the first move)----')
+        for move, val, depth in zip(legal_moves, possible_board_values, depths):
+            board.push(move)
             board.print_board()
+            board.pop()
             print(f'ab pruning val: {val} - depth: {depth}\n\n')
 
-
     # If there is a checkmate possible, we choose the board with the min depth reached
     if contains_checkmate:
         # Sort boards to eval by their depths reached (we want the one that went the minimum depth)
-        boards_to_eval.sort(key=lambda x: x[2])
-        if turn == 'W':
-            return str(boards_to_eval[0][1]), np.inf
-        if turn == 'B':
-            return str(boards_to_eval[0][1]), -1 * np.inf
-
-    if len(boards_to_eval) == 1:
-        if turn == 'W':
-            return str(boards_to_eval[0][1]), np.max(possible_board_values)
-        if turn == 'B':
-            return str(boards_to_eval[0][1]), np.min(possible_board_values)
-
-    preds = [model.predict(np.array([i[0].positional_encode()]), verbose=0)[0][0] for i in boards_to_eval]
-
+        boards_to_eval.sort(key=lambda x: x[1])
+        return str(boards_to_eval[0][0]), best_value
+
+    if len(boards_to_eval) == 1 or model is None:
+        return str(boards_to_eval[0][0]), best_value
+
+    # Evaluate all of the tied boards with the model in one batch
+    evaluator = LeafEvaluator(model, max_batch_size=len(boards_to_eval))
+    pending_preds = []
+    for move, _ in boards_to_eval:
+        board.push(move)
+        pending_preds.append(evaluator.submit(board))
+        board.pop()
+    evaluator.flush()
+    preds = [pred.value for pred in pending_preds]
 
     if turn == 'W':
         best_pred_ind = np.argmax(preds)
-        return str(boards_to_eval[best_pred_ind][1]), np.max(preds) 
+        return str(boards_to_eval[best_pred_ind][0]), np.max(preds) 
     
     if turn == 'B':
         best_pred_ind = np.argmin(preds)
-        return str(boards_to_eval[best_pred_ind][1]), np.min(preds) 
-        
\ No newline at end of file
+        return str(boards_to_eval[best_pred_ind][0]), np.min(preds) 
+
+
+def _evaluate_board_mcts(board, model, print_boards, time_budget_ms, node_budget, stop_event, mcts):
+    """
+    Finds the best move with Monte Carlo Tree Search (see evaluate_board()).
+    """
+    if mcts is None:
+        mcts = MCTS(model)
+
+    best_move, value = mcts.search(board, num_playouts=node_budget, time_budget_ms=time_budget_ms, stop_event=stop_event)
+    if best_move is None:
+        # The game is over at the root, there is nothing to play
+        return None, value
+
+    if print_boards:
+        stats = mcts.stats()
+        print(f'\n---MCTS ({stats["playouts"]} playouts, {stats["playouts_per_s"]:.0f} playouts/s, '
+              f'{stats["nodes"]} nodes, {stats["reused_visits"]} visits reused)----')
+        for move, visits, move_value in mcts.root_moves()[:10]:
+            print(f'{move}: {visits} visits, value {move_value:+.4f}')
+
+    return str(best_move), value
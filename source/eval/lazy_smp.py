@@ -0,0 +1,270 @@
+"""
+This script implements Lazy SMP, the way most engines search on several cores. python-chess' move
+generation holds the GIL, so threads do not help our alpha-beta search, but processes do:
+
+    -> The main process runs the normal iterative deepening search (see alpha_beta.py).
+    -> num_workers - 1 helper processes search the same position (with the moves of the game
+        that led to it, so they see the same repetitions) at the same time. Each one starts at a
+        different depth (2, 3 or 1) and with the root moves in a different order than the main
+        process, so they spread out over the tree instead of all searching the same line.
+    -> All of them probe and store through one transposition table in shared memory (see
+        transposition_table.py), without a lock. What a helper finds out about a position is a
+        transposition table hit for the main process, which is where the speedup comes from.
+    -> When the main process is done (its budget ran out, or it reached max_depth), the helpers
+        are stopped, and the deepest iteration that any of the processes finished is played.
+
+The helper processes are started once and wait for the next position between searches, so a
+search does not pay for starting processes. Use it as:
+    smp = LazySMP(num_workers=8, tt_size_mb=256)
+    evaluate_board(board, model, turn, smp=smp, time_budget_ms=1000)
+    smp.close()
+
+Compare the time to depth and nodes per second of 1 to N processes with:
+    python eval/lazy_smp.py --workers 1 2 4 8 --depth 5
+"""
+
+# Imports
+import argparse
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import chess
+
+# Local imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from board import ChessBoard
+from eval.alpha_beta import SearchState, iterative_deepening, MAX_SEARCH_DEPTH
+from eval.transposition_table import TranspositionTable
+
+# The searches start at these depths in turn. The main process is number 0 and starts at depth 1,
+# so helper 0 starts at depth 2, helper 1 at depth 3, helper 2 at depth 1, ...
+HELPER_START_DEPTHS = (1, 2, 3)
+
+# How long the main process waits for a stopped helper before it gives up on it, in seconds
+HELPER_STOP_TIMEOUT = 10.
+
+
+def _helper_main(helper_index, tt_handle, tasks, results, stop_event):
+    """
+    The loop of a helper process: search every position that comes in on the task queue until it
+    is told to stop, and report every finished iteration to the main process.
+    """
+    tt = TranspositionTable.attach(*tt_handle)
+    board = ChessBoard()
+    # Counting the main process as number 0, so that no helper repeats its search
+    search_index = helper_index + 1
+    start_depth = HELPER_START_DEPTHS[search_index % len(HELPER_START_DEPTHS)]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        search_id, root_fen, moves, max_depth, age = task
+
+        # Replaying the game keeps its move stack, which the repetition checks of the search need
+        board.set_fen(root_fen)
+        for move in moves:
+            board.push(chess.Move.from_uci(move))
+        tt.new_search(age)
+        # The stop event is checked from the first node on, so a helper stops right away
+        state = SearchState(tt, stop_event=stop_event)
+
+        # Every helper starts with a different root move
+        root_moves = list(board.get_legal_moves())
+        shift = search_index % len(root_moves) if root_moves else 0
+        root_moves = root_moves[shift:] + root_moves[:shift]
+
+        def on_iteration(depth, moves, values, depths_reached, state):
+            results.put(('iteration', search_id, helper_index, depth, [move.uci() for move in moves],
+                         values, depths_reached))
+
+        iterative_deepening(board.get_turn(), board, state, max_depth=max_depth, on_iteration=on_iteration,
+                            start_depth=min(start_depth, max_depth), root_moves=root_moves)
+        results.put(('done', search_id, helper_index, state.nodes))
+
+    tt.close()
+
+
+class LazySMP:
+    """
+    An alpha-beta search on several processes that share one transposition table.
+
+    Arguments:
+        num_workers (int): The number of processes that search, including the main one. With 1,
+            this is the normal single-process search.
+        tt_size_mb (float): The memory budget of the shared transposition table in MB
+        replacement (str): The replacement policy of the table (see transposition_table.py)
+    """
+    def __init__(self, num_workers=None, tt_size_mb=64, replacement='depth'):
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1')
+        self.num_workers = num_workers
+        self.tt = TranspositionTable(tt_size_mb, replacement, shared=True)
+
+        # Spawned (instead of forked) helpers do not inherit the threads of the main process
+        context = multiprocessing.get_context('spawn')
+        self._stop_event = context.Event()
+        self._results = context.Queue()
+        self._tasks = []
+        self._helpers = []
+        for helper_index in range(num_workers - 1):
+            tasks = context.Queue()
+            helper = context.Process(target=_helper_main, daemon=True,
+                                     args=(helper_index, self.tt.shared_handle(), tasks, self._results,
+                                           self._stop_event))
+            helper.start()
+            self._tasks.append(tasks)
+            self._helpers.append(helper)
+
+        self._search_id = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.main_nodes = 0
+        self.helper_nodes = [0] * len(self._helpers)
+        self.helper_depths = [0] * len(self._helpers)
+        self.main_depth = 0
+        self.best_source = 'main'
+        self.search_time = 0.
+
+    def search(self, turn, board, state, max_depth=None, time_budget_ms=None, node_budget=None, stop_event=None,
+               on_iteration=None):
+        """
+        Searches the board with every process, and returns the results of the deepest iteration
+        that finished. This takes the same arguments and returns the same thing as
+        alpha_beta.iterative_deepening(). The budgets and the stop event are those of the main
+        process, and the helpers are stopped when it is done.
+
+        Arguments:
+            state (SearchState): The book-keeping of the main process, which must search through
+                this object's transposition table (LazySMP.tt)
+        """
+        if state.tt is not self.tt:
+            raise ValueError('The search state has to use the shared transposition table')
+        if max_depth is None:
+            max_depth = MAX_SEARCH_DEPTH
+
+        self.reset_stats()
+        start_time = time.time()
+        start_nodes = state.nodes
+        self._search_id += 1
+        self._stop_event.clear()
+        root_fen = board.board.root().fen()
+        moves = [move.uci() for move in board.board.move_stack]
+        for tasks in self._tasks:
+            tasks.put((self._search_id, root_fen, moves, max_depth, self.tt.age))
+
+        try:
+            root_moves, values, depths_reached, depth = iterative_deepening(
+                turn, board, state, max_depth=max_depth, time_budget_ms=time_budget_ms, node_budget=node_budget,
+                stop_event=stop_event, on_iteration=on_iteration)
+        finally:
+            self._stop_event.set()
+            helper_results = self._collect_helpers()
+
+        self.main_nodes = state.nodes - start_nodes
+        self.main_depth = depth
+        for helper_index, (helper_depth, moves, helper_values, helper_depths_reached) in helper_results.items():
+            if helper_depth > depth:
+                root_moves = [chess.Move.from_uci(move) for move in moves]
+                values, depths_reached, depth = helper_values, helper_depths_reached, helper_depth
+                self.best_source = f'helper {helper_index}'
+        self.search_time = time.time() - start_time
+
+        return root_moves, values, depths_reached, depth
+
+    def _collect_helpers(self):
+        """
+        Waits until every helper stopped searching, and returns the deepest iteration each of them
+        finished as {helper_index: (depth, moves, values, depths_reached)}.
+        """
+        best_iterations = {}
+        running = set(range(len(self._helpers)))
+        deadline = time.time() + HELPER_STOP_TIMEOUT
+        while running and time.time() < deadline:
+            try:
+                message = self._results.get(timeout=0.1)
+            except queue.Empty:
+                # A helper that died is left out of the search
+                running = {helper_index for helper_index in running if self._helpers[helper_index].is_alive()}
+                continue
+            if message[1] != self._search_id:
+                continue
+            helper_index = message[2]
+            if message[0] == 'iteration':
+                best_iterations[helper_index] = message[3:]
+                self.helper_depths[helper_index] = message[3]
+            else:
+                self.helper_nodes[helper_index] = message[3]
+                running.discard(helper_index)
+        return best_iterations
+
+    def stats(self):
+        """
+        Returns the counters of the last search.
+        """
+        nodes = self.main_nodes + sum(self.helper_nodes)
+        return {
+            'workers': self.num_workers,
+            'nodes': nodes,
+            'nodes_per_s': nodes / self.search_time if self.search_time else 0.,
+            'main_nodes': self.main_nodes,
+            'helper_nodes': list(self.helper_nodes),
+            'main_depth': self.main_depth,
+            'helper_depths': list(self.helper_depths),
+            'best_source': self.best_source,
+            'search_time': self.search_time,
+        }
+
+    def close(self):
+        """
+        Stops the helper processes and frees the shared transposition table.
+        """
+        self._stop_event.set()
+        for tasks in self._tasks:
+            tasks.put(None)
+        for helper in self._helpers:
+            helper.join(HELPER_STOP_TIMEOUT)
+            if helper.is_alive():
+                helper.terminate()
+        self._helpers, self._tasks = [], []
+        self.tt.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the Lazy SMP search on different numbers of processes.')
+    parser.add_argument('--fen', type=str, default=chess.STARTING_FEN)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--depth', type=int, default=5, help='The depth to time the search to')
+    parser.add_argument('--tt-size-mb', type=float, default=64)
+
+    args = parser.parse_args()
+
+    board = ChessBoard()
+    board.set_fen(args.fen)
+    base_time = None
+    for num_workers in args.workers:
+        with LazySMP(num_workers, args.tt_size_mb) as smp:
+            # A first search waits for the helpers to start, so the timed one does not
+            smp.search(board.get_turn(), board, SearchState(smp.tt), max_depth=1)
+            smp.tt.clear()
+            smp.tt.new_search()
+            state = SearchState(smp.tt)
+            moves, values, _, depth = smp.search(board.get_turn(), board, state, max_depth=args.depth)
+            stats = smp.stats()
+
+        base_time = base_time or stats['search_time']
+        print(f'{num_workers} processes: {moves[0]} ({values[0]:+.1f}) at depth {depth} in {stats["search_time"]:.2f}s '
+              f'(x{base_time / stats["search_time"]:.2f}), {stats["nodes"]} nodes, {stats["nodes_per_s"]:.0f} nodes/s, '
+              f'helper depths {stats["helper_depths"]}, best result from {stats["best_source"]}')
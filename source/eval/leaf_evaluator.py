@@ -0,0 +1,170 @@
+"""
+This script implements batched neural network evaluation for our searches. Calling
+model.predict() on a single position pays the whole Keras overhead for one row of 776 numbers, so
+instead the searches queue up the positions they want evaluated and the queue runs them through the
+model in one batch.
+
+The LeafEvaluator is the queue. submit() encodes a board right away (so the board can be changed
+again afterwards) and gives back a PendingEval, whose value is filled in when the queue is flushed.
+The queue flushes by itself when it holds max_batch_size positions, or when its oldest position has
+been waiting for longer than flush_deadline_ms.
+"""
+
+# Imports
+import time
+
+import numpy as np
+
+# Local imports
+from board import ENCODING_SIZE
+
+
+class PendingEval:
+    """
+    The evaluation of one position that was submitted to a LeafEvaluator.
+    """
+    __slots__ = ('evaluator', 'value')
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.value = None
+
+    def result(self):
+        """
+        Returns the evaluation, flushing the queue first if it was not evaluated yet.
+        """
+        if self.value is None:
+            self.evaluator.flush()
+        return self.value
+
+
+class LeafEvaluator:
+    """
+    Collects positions and evaluates them with the model in batches.
+
+    Arguments:
+        model: The model that evaluates positions. Anything with a Keras-style predict_on_batch().
+        max_batch_size (int): The most positions that go through the model in one batch
+        flush_deadline_ms (float): The longest a position waits in the queue before the queue is
+            flushed. This is checked whenever a position is submitted or poll() is called.
+    """
+    def __init__(self, model, max_batch_size=256, flush_deadline_ms=10.):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.flush_deadline_ms = flush_deadline_ms
+
+        self._inputs = np.zeros((max_batch_size, ENCODING_SIZE), dtype=np.float32)
+        self._pending = []
+        self._oldest_time = None
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Sets the counters back to zero.
+        """
+        self.num_batches = 0
+        self.num_positions = 0
+        self.predict_time = 0.
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, board):
+        """
+        Queues a board for evaluation.
+
+        Arguments:
+            board (ChessBoard): Our ChessBoard object. It is encoded right away, so it can be
+                changed (e.g. the move popped) as soon as this returns.
+
+        Output:
+            PendingEval: The evaluation of the board, once the queue is flushed
+        """
+        if self._oldest_time is None:
+            self._oldest_time = time.time()
+
+        pending = PendingEval(self)
+        board.positional_encode(out=self._inputs[len(self._pending)])
+        self._pending.append(pending)
+
+        if len(self._pending) == self.max_batch_size:
+            self.flush()
+        else:
+            self.poll()
+        return pending
+
+    def poll(self):
+        """
+        Flushes the queue if its oldest position waited for longer than the flush deadline.
+        """
+        if self._oldest_time is not None and (time.time() - self._oldest_time) * 1000 >= self.flush_deadline_ms:
+            self.flush()
+
+    def flush(self):
+        """
+        Evaluates every queued position in one batch.
+        """
+        num_pending = len(self._pending)
+        if num_pending == 0:
+            return
+
+        start_time = time.time()
+        preds = np.asarray(self.model.predict_on_batch(self._inputs[:num_pending])).reshape(-1)
+        self.predict_time += time.time() - start_time
+        self.num_batches += 1
+        self.num_positions += num_pending
+
+        for pending, pred in zip(self._pending, preds):
+            pending.value = pred
+        self._pending = []
+        self._oldest_time = None
+
+    def evaluate(self, boards):
+        """
+        Evaluates a list of boards in as few batches as possible.
+
+        Output:
+            np.ndarray: The evaluation of every board
+        """
+        pendings = [self.submit(board) for board in boards]
+        self.flush()
+        return np.array([pending.value for pending in pendings])
+
+    def stats(self):
+        """
+        Returns the counters of the evaluator.
+        """
+        return {
+            'batches': self.num_batches,
+            'positions': self.num_positions,
+            'avg_batch_size': self.num_positions / self.num_batches if self.num_batches else 0.,
+            'predict_time': self.predict_time,
+        }
+
+
+def expand_tree(board, evaluator, current_depth, max_depth):
+    """
+    Submits the board and every board below it (down to max_depth) to the evaluator, so that the
+    whole tree is evaluated in a few big batches instead of one model call per board. The moves are
+    pushed and popped on the board, so it is back in its original position when this returns.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object
+        evaluator (LeafEvaluator): The evaluator the boards are submitted to
+        current_depth (int): The depth of this board
+        max_depth (int): The depth of the deepest boards
+
+    Output:
+        (PendingEval, list): The evaluation of this board, and the subtrees of its legal moves
+    """
+    pending = evaluator.submit(board)
+    if current_depth >= max_depth:
+        return pending, []
+
+    children = []
+    for legal_move in list(board.get_legal_moves()):
+        board.push(legal_move)
+        children.append(expand_tree(board, evaluator, current_depth + 1, max_depth))
+        board.pop()
+    return pending, children
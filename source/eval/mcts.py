@@ -0,0 +1,560 @@
+"""
+This script implements Monte Carlo Tree Search (MCTS). Instead of searching every move to a fixed
+depth like alpha-beta, every playout walks down the tree from the root along the most promising
+moves, adds one new position to the tree, evaluates it with the model and backs the value up the
+path. So the tree grows where the good moves are, and the move that was visited the most is played.
+
+    -> Selection: PUCT (the AlphaZero formula, Q + c * P * sqrt(N) / (1 + n)) or UCT
+        (Q + c * sqrt(ln(N) / n)). Our models only predict a value, so every move gets the same prior
+        P, and a move that was not visited yet starts with the value of its parent.
+    -> Evaluation: the model's prediction for the new position (or the material balance without a
+        model), scaled to [-1, 1] like our training evals. Checkmate is worth -1 to the side that
+        is mated, stalemate and the fifty move rule 0.
+    -> Tree reuse: the tree is kept between moves. When the next search starts from a position
+        that is already in the tree (after our move and the opponent's reply), the subtree below it
+        is kept and everything else is dropped.
+    -> Parallel search: with num_workers threads and a batch_size above 1, every thread walks down
+        to batch_size leaves and evaluates them with one call of the model. A virtual loss on the
+        nodes of a walk sends the next walks down other paths until the real value is backed up.
+
+The statistics of the nodes are stored in flat numpy arrays (see MCTS.__init__), and the children
+of a node are stored next to each other, so selecting a child is a few numpy operations on a slice.
+"""
+
+# Imports
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+
+import chess
+import numpy as np
+
+# Local imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from board import ChessBoard, ENCODING_SIZE
+from eval.alpha_beta import search_game_over
+from eval.count_material import material_balance
+from eval.transposition_table import decode_move, encode_move, zobrist_hash
+
+SELECTION_RULES = ('puct', 'uct')
+
+# The default exploration constants of the two selection rules
+DEFAULT_C_PUCT = 1.5
+DEFAULT_C_UCT = math.sqrt(2)
+
+# How many playouts a search does when it has no time budget
+DEFAULT_NUM_PLAYOUTS = 800
+
+# Material is scaled like the training evals (see data_handler.scale_evals) when there is no model
+EVAL_SCALE = 15.
+
+# The number of nodes the arrays start with (they double when they are full)
+INITIAL_CAPACITY = 4096
+
+# A node whose children were not generated yet
+UNEXPANDED = -1
+
+# The virtual loss of the parallel search (a lost game, see MCTS.__init__)
+DEFAULT_VIRTUAL_LOSS = 1.
+
+# What _descend() returns when the tree is too full to expand a leaf
+TREE_FULL = 'tree_full'
+
+
+class MCTS:
+    """
+    A Monte Carlo search tree, which is kept between the moves of a game.
+
+    Arguments:
+        model: The model that evaluates positions (anything with a Keras-style predict_on_batch()),
+            or None to evaluate with the material balance
+        selection (str): 'puct' or 'uct'
+        c (float): The exploration constant. Defaults to DEFAULT_C_PUCT or DEFAULT_C_UCT.
+        max_nodes (int): The most nodes the tree holds. The search stops when the tree is full.
+        num_workers (int): How many threads search the tree at the same time
+        batch_size (int): How many leaves a worker collects before it evaluates them with one call
+            of the model
+        virtual_loss (float): The loss a worker adds to every node on its way down, so that the
+            other workers (and its own next walks in the same batch) take other paths
+    """
+    def __init__(self, model=None, selection='puct', c=None, max_nodes=2_000_000, num_workers=1, batch_size=1,
+                 virtual_loss=DEFAULT_VIRTUAL_LOSS):
+        if selection not in SELECTION_RULES:
+            raise ValueError(f'Unknown selection rule {selection}, expected one of {SELECTION_RULES}')
+        if num_workers < 1 or batch_size < 1:
+            raise ValueError('num_workers and batch_size must be at least 1')
+        if max_nodes < 1:
+            raise ValueError('max_nodes must be at least 1')
+        self.model = model
+        self.selection = selection
+        self.c = c if c is not None else (DEFAULT_C_PUCT if selection == 'puct' else DEFAULT_C_UCT)
+        self.max_nodes = max_nodes
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+
+        self._input = np.zeros((1, ENCODING_SIZE), dtype=np.float32)
+        self._allocate(min(INITIAL_CAPACITY, max_nodes))
+        self.root_board = None
+        self.root_key = None
+        self.reset_stats()
+
+    def _allocate(self, capacity):
+        """
+        (Re)allocates the node arrays, keeping the nodes that are already in them:
+            -> parent: The index of the parent node (-1 for the root)
+            -> first_child, num_children: The children are the nodes first_child to
+                first_child + num_children - 1. num_children is UNEXPANDED until they are generated.
+            -> move: The move that leads to the node (see transposition_table.encode_move)
+            -> visits: How many playouts went through the node
+            -> value_sum: The sum of their values, for the player who made the move into the node
+            -> prior: The prior probability of the move
+            -> terminal: The value of a finished game for the side to move, and NaN otherwise
+        """
+        old_size = getattr(self, 'size', 0)
+        arrays = {
+            'parent': np.int32, 'first_child': np.int32, 'num_children': np.int32, 'move': np.uint16,
+            'visits': np.int32, 'value_sum': np.float64, 'prior': np.float32, 'terminal': np.float32,
+        }
+        for name, dtype in arrays.items():
+            new_array = np.zeros(capacity, dtype=dtype)
+            if old_size:
+                new_array[:old_size] = getattr(self, name)[:old_size]
+            setattr(self, name, new_array)
+        self.capacity = capacity
+        self.size = old_size
+
+    def clear(self):
+        """
+        Drops the whole tree.
+        """
+        self.size = 0
+        self.root_board = None
+        self.root_key = None
+
+    def reset_stats(self):
+        self.num_playouts = 0
+        self.search_time = 0.
+        self.reused_nodes = 0
+        self.worker_stats = []
+
+    def _new_nodes(self, count):
+        """
+        Returns the index of count new, consecutive nodes, or None if the tree is full.
+        """
+        if self.size + count > self.max_nodes:
+            return None
+        if self.size + count > self.capacity:
+            self._allocate(min(max(2 * self.capacity, self.size + count), self.max_nodes))
+        start = self.size
+        self.size += count
+        end = self.size
+        self.first_child[start:end] = -1
+        self.num_children[start:end] = UNEXPANDED
+        self.visits[start:end] = 0
+        self.value_sum[start:end] = 0.
+        self.terminal[start:end] = np.nan
+        return start
+
+    def _set_root(self, board):
+        """
+        Makes the position of the board the root of the tree, keeping the subtree below it if it is
+        already in the tree (e.g. after our move and the opponent's reply) and dropping the rest.
+        """
+        key = zobrist_hash(board)
+        if self.size and key != self.root_key:
+            node = self._find_descendant(key)
+            if node is None:
+                self.size = 0
+            else:
+                self._keep_subtree(node)
+
+        if self.size == 0:
+            root = self._new_nodes(1)
+            self.parent[root] = -1
+        elif self.num_children[0] == UNEXPANDED:
+            # A kept node that was a draw by repetition below the old root is not one as the root
+            self.terminal[0] = np.nan
+        self.reused_nodes = int(self.visits[0]) if self.size else 0
+
+        self.root_board = ChessBoard()
+        self.root_board.board = board.board.copy()
+        self.root_key = key
+
+    def _find_descendant(self, key, max_plies=2):
+        """
+        Returns the node of the position with the given hash, among the nodes up to max_plies below
+        the root, or None if it is not in the tree.
+        """
+        # The nodes of one ply, with the moves from the root to them
+        frontier = [(0, [])]
+        for _ in range(max_plies):
+            next_frontier = []
+            for node, moves in frontier:
+                if self.num_children[node] <= 0:
+                    continue
+                for child in range(self.first_child[node], self.first_child[node] + self.num_children[node]):
+                    child_moves = moves + [decode_move(int(self.move[child]))]
+                    for move in child_moves:
+                        self.root_board.push(move)
+                    found = zobrist_hash(self.root_board) == key
+                    for _ in child_moves:
+                        self.root_board.pop()
+                    if found:
+                        return child
+                    next_frontier.append((child, child_moves))
+            frontier = next_frontier
+        return None
+
+    def _keep_subtree(self, node):
+        """
+        Moves the subtree of a node to the front of the arrays, with the node as the new root. A
+        child always comes after its parent in the arrays, and the children of a node are either
+        all kept or all dropped, so the kept nodes stay in order and their children stay together.
+        """
+        size = self.size
+        parent = self.parent[:size]
+        keep = np.zeros(size, dtype=bool)
+        keep[node] = True
+        # Spread the keep flag down the tree, one level per pass
+        while True:
+            has_parent = parent >= 0
+            new_keep = keep.copy()
+            new_keep[has_parent] |= keep[parent[has_parent]]
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+
+        new_index = np.cumsum(keep) - 1
+        for name in ('parent', 'first_child', 'num_children', 'move', 'visits', 'value_sum', 'prior', 'terminal'):
+            array = getattr(self, name)
+            kept = array[:size][keep]
+            array[:len(kept)] = kept
+        self.size = int(keep.sum())
+
+        self.parent[0] = -1
+        self.parent[1:self.size] = new_index[self.parent[1:self.size]]
+        expanded = self.num_children[:self.size] > 0
+        self.first_child[:self.size][expanded] = new_index[self.first_child[:self.size][expanded]]
+
+    def _evaluate(self, board):
+        """
+        Returns the value of a position for the side to move, in [-1, 1].
+        """
+        if self.model is None:
+            value = np.clip(material_balance(board) / EVAL_SCALE, -1., 1.)
+        else:
+            board.positional_encode(out=self._input[0])
+            value = float(np.asarray(self.model.predict_on_batch(self._input)).reshape(-1)[0])
+        return value if board.board.turn == chess.WHITE else -value
+
+    def _expand(self, node, board):
+        """
+        Generates the children of a leaf node, or marks it as terminal if the game is over there.
+        Returns False if the tree is full.
+        """
+        # The root is a position of the real game, which is only drawn by a threefold repetition
+        game_over, value = search_game_over(board, repetitions=3 if node == 0 else 2)
+        if game_over:
+            # The side to move is checkmated (-1), or it is a draw
+            self.terminal[node] = -1. if np.isinf(value) else 0.
+            return True
+
+        legal_moves = list(board.get_legal_moves())
+        first = self._new_nodes(len(legal_moves))
+        if first is None:
+            return False
+        end = first + len(legal_moves)
+        self.parent[first:end] = node
+        self.move[first:end] = [encode_move(move) for move in legal_moves]
+        self.prior[first:end] = 1. / len(legal_moves)
+        self.first_child[node] = first
+        self.num_children[node] = len(legal_moves)
+        return True
+
+    def _select_child(self, node):
+        """
+        Returns the child of a node with the best PUCT or UCT score.
+        """
+        first = self.first_child[node]
+        children = slice(first, first + self.num_children[node])
+        visits = self.visits[children]
+        parent_visits = self.visits[node]
+
+        if self.selection == 'puct':
+            # A move that was not visited yet starts with the value of its parent (for its player)
+            first_play_value = -self.value_sum[node] / parent_visits if parent_visits else 0.
+            q = np.where(visits > 0, self.value_sum[children] / np.maximum(visits, 1), first_play_value)
+            scores = q + self.c * self.prior[children] * math.sqrt(parent_visits) / (1 + visits)
+        else:
+            unvisited = np.flatnonzero(visits == 0)
+            if len(unvisited):
+                return first + int(unvisited[0])
+            scores = self.value_sum[children] / visits + self.c * np.sqrt(math.log(parent_visits) / visits)
+        return first + int(np.argmax(scores))
+
+    def _descend(self, board, virtual_loss=0.):
+        """
+        Walks down from the root to a leaf along the best children, expanding the leaf, and leaves
+        the board at the leaf's position. With a virtual loss, every node on the way counts as
+        visited and lost (until _backup() takes it back), so the next walk prefers another path.
+
+        Output:
+            (list, float): The nodes from the root to the leaf, and the leaf's value for the side to
+                move if the game is over there. The value is None if the leaf has to be evaluated,
+                and TREE_FULL if the leaf could not be expanded.
+        """
+        node, path = 0, [0]
+        while True:
+            if virtual_loss:
+                self.visits[node] += 1
+                self.value_sum[node] -= virtual_loss
+            if self.num_children[node] == UNEXPANDED and np.isnan(self.terminal[node]):
+                if not self._expand(node, board):
+                    return path, TREE_FULL
+                return path, (None if np.isnan(self.terminal[node]) else float(self.terminal[node]))
+            if not np.isnan(self.terminal[node]):
+                return path, float(self.terminal[node])
+            node = self._select_child(node)
+            board.push(decode_move(int(self.move[node])))
+            path.append(node)
+
+    def _backup(self, path, value, virtual_loss=0.):
+        """
+        Adds the value of a leaf (for the side to move there) to the nodes on its path, taking back
+        the virtual loss that _descend() added.
+        """
+        # The value counts against the player who moved into the leaf, for the player before them,
+        # and so on up to the root
+        for node in reversed(path):
+            if virtual_loss:
+                self.value_sum[node] += virtual_loss
+            else:
+                self.visits[node] += 1
+            self.value_sum[node] -= value
+            value = -value
+
+    def _undo_virtual_loss(self, path, virtual_loss):
+        for node in path:
+            self.visits[node] -= 1
+            self.value_sum[node] += virtual_loss
+
+    def playout(self, board):
+        """
+        Runs one playout from the root. The board must be at the root position, and it is back
+        there when this returns.
+
+        Output:
+            bool: False if the tree is full and the playout could not add a node
+        """
+        path, value = self._descend(board)
+        if value is None:
+            value = self._evaluate(board)
+        for _ in range(len(path) - 1):
+            board.pop()
+        if value is TREE_FULL:
+            return False
+
+        self._backup(path, value)
+        self.num_playouts += 1
+        return True
+
+    def search(self, board, num_playouts=None, time_budget_ms=None, stop_event=None):
+        """
+        Searches a position and returns the best move and its value.
+
+        Arguments:
+            board (ChessBoard): Our ChessBoard object. The moves are pushed and popped on it, so it
+                is back in its original position when this returns.
+            num_playouts (int): Optional number of playouts
+            time_budget_ms (float): Optional time budget in milliseconds
+            stop_event (threading.Event): Optional event that stops the search when it is set
+            Without a number of playouts or a time budget, DEFAULT_NUM_PLAYOUTS playouts are run.
+
+        Output:
+            (chess.Move, float): The most visited move, and its value from White's point of view
+                (in the units of the model, e.g. the eval divided by 15). The move is None if the
+                game is already over.
+        """
+        if num_playouts is None and time_budget_ms is None and stop_event is None:
+            num_playouts = DEFAULT_NUM_PLAYOUTS
+
+        self.reset_stats()
+        start_time = time.time()
+        self._set_root(board)
+        deadline = start_time + time_budget_ms / 1000 if time_budget_ms is not None else None
+
+        def should_stop():
+            if num_playouts is not None and self.num_playouts >= num_playouts:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return True
+            return stop_event is not None and stop_event.is_set()
+
+        # The root is always expanded, so there is a move to play
+        while self.num_children[0] == UNEXPANDED and np.isnan(self.terminal[0]):
+            if not self.playout(board):
+                raise ValueError(f'A tree of max_nodes={self.max_nodes} can not hold the root and its moves')
+
+        if self.num_workers == 1 and self.batch_size == 1:
+            while not should_stop():
+                if not self.playout(board):
+                    break
+        else:
+            self._parallel_search(board, num_playouts, should_stop)
+
+        self.search_time = time.time() - start_time
+        moves = self.root_moves()
+        if not moves:
+            # The game is over, and terminal holds its value for the side to move
+            best_move, value = None, float(self.terminal[0])
+        else:
+            best_move, _, value = moves[0]
+        return best_move, value if board.board.turn == chess.WHITE else -value
+
+    def _parallel_search(self, board, num_playouts, should_stop):
+        """
+        Runs playouts on num_workers threads until should_stop() says so. Every worker walks down to
+        batch_size leaves (with a virtual loss on each path), evaluates them with one call of the
+        model and backs them up. The tree is only touched while holding the lock, and the model is
+        called without it, so one worker's forward pass overlaps with the others' walks.
+        """
+        lock = threading.Lock()
+        # The playouts that the workers walked down but did not back up yet
+        in_flight = 0
+        self.worker_stats = [{'playouts': 0, 'batches': 0, 'eval_time': 0., 'tree_time': 0.} for _ in range(self.num_workers)]
+
+        def worker(stats):
+            nonlocal in_flight
+            worker_board = ChessBoard()
+            worker_board.board = board.board.copy()
+            inputs = np.zeros((self.batch_size, ENCODING_SIZE), dtype=np.float32)
+
+            while True:
+                # Walk down to a batch of leaves
+                tree_start = time.time()
+                pending, finished = [], []
+                with lock:
+                    if should_stop():
+                        return
+                    batch_size = self.batch_size
+                    if num_playouts is not None:
+                        # The playouts that are left may already be running on the other workers
+                        batch_size = min(batch_size, num_playouts - self.num_playouts - in_flight)
+                        if batch_size <= 0:
+                            return
+                    for _ in range(batch_size):
+                        path, value = self._descend(worker_board, self.virtual_loss)
+                        if value is None:
+                            if self.model is None:
+                                finished.append((path, self._evaluate(worker_board)))
+                            else:
+                                # The sign turns the model's value (for White) into the side to move's
+                                worker_board.positional_encode(out=inputs[len(pending)])
+                                pending.append((path, 1. if worker_board.board.turn == chess.WHITE else -1.))
+                        elif value is TREE_FULL:
+                            self._undo_virtual_loss(path, self.virtual_loss)
+                        else:
+                            finished.append((path, value))
+                        for _ in range(len(path) - 1):
+                            worker_board.pop()
+                        if value is TREE_FULL:
+                            break
+                    in_flight += len(pending) + len(finished)
+                tree_time = time.time() - tree_start
+
+                # Evaluate the leaves in one batch, without the lock
+                if pending:
+                    eval_start = time.time()
+                    preds = np.asarray(self.model.predict_on_batch(inputs[:len(pending)])).reshape(-1)
+                    stats['eval_time'] += time.time() - eval_start
+                    stats['batches'] += 1
+                    finished.extend((path, sign * float(pred)) for (path, sign), pred in zip(pending, preds))
+
+                tree_start = time.time()
+                with lock:
+                    for path, value in finished:
+                        self._backup(path, value, self.virtual_loss)
+                    in_flight -= len(pending) + len(finished)
+                    self.num_playouts += len(finished)
+                    if not finished:
+                        # The tree is full
+                        return
+                stats['playouts'] += len(finished)
+                stats['tree_time'] += tree_time + time.time() - tree_start
+
+        threads = [threading.Thread(target=worker, args=(stats,), daemon=True) for stats in self.worker_stats]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def root_moves(self):
+        """
+        Returns (move, visits, value for the side to move) of every move at the root, most visited
+        first.
+        """
+        if self.num_children[0] <= 0:
+            return []
+        first = self.first_child[0]
+        children = range(first, first + self.num_children[0])
+        moves = [(decode_move(int(self.move[child])), int(self.visits[child]),
+                  float(self.value_sum[child] / self.visits[child]) if self.visits[child] else 0.) for child in children]
+        moves.sort(key=lambda item: (item[1], item[2]), reverse=True)
+        return moves
+
+    def stats(self):
+        """
+        Returns the counters of the last search.
+        """
+        return {
+            'playouts': self.num_playouts,
+            'playouts_per_s': self.num_playouts / self.search_time if self.search_time else 0.,
+            'nodes': self.size,
+            'reused_visits': self.reused_nodes,
+            'search_time': self.search_time,
+            'workers': [
+                {**stats, 'avg_batch_size': stats['playouts'] / stats['batches'] if stats['batches'] else 0.,
+                 'playouts_per_s': stats['playouts'] / self.search_time if self.search_time else 0.}
+                for stats in self.worker_stats
+            ],
+        }
+
+
+if __name__ == '__main__':
+    # Compares the speed of MCTS (playouts per second) with alpha-beta (nodes per second)
+    parser = argparse.ArgumentParser(description='Compares MCTS with the alpha-beta search on a position.')
+    parser.add_argument('--fen', type=str, default=chess.STARTING_FEN)
+    parser.add_argument('--model', type=str, default=None, help='Model to evaluate with (material only by default)')
+    parser.add_argument('--time-ms', type=float, default=2000)
+    parser.add_argument('--selection', type=str, default='puct', choices=SELECTION_RULES)
+    parser.add_argument('--workers', type=int, default=1, help='Number of threads of the MCTS')
+    parser.add_argument('--batch-size', type=int, default=1, help='Leaves every MCTS thread evaluates at a time')
+
+    args = parser.parse_args()
+
+    from eval.alpha_beta import SearchState, iterative_deepening
+    from eval.numpy_model import load_model
+    from eval.transposition_table import TranspositionTable
+
+    model = load_model(args.model) if args.model else None
+    board = ChessBoard()
+    board.set_fen(args.fen)
+
+    mcts = MCTS(model, selection=args.selection, num_workers=args.workers, batch_size=args.batch_size)
+    best_move, value = mcts.search(board, time_budget_ms=args.time_ms)
+    stats = mcts.stats()
+    print(f'MCTS: {best_move} ({value:+.3f}), {stats["playouts"]} playouts, {stats["playouts_per_s"]:.0f} playouts/s')
+    for idx, worker_stats in enumerate(stats['workers']):
+        print(f'    Worker {idx}: {worker_stats["playouts"]} playouts ({worker_stats["playouts_per_s"]:.0f}/s), '
+              f'{worker_stats["batches"]} batches of {worker_stats["avg_batch_size"]:.1f}, '
+              f'{worker_stats["eval_time"]:.2f}s evaluating, {worker_stats["tree_time"]:.2f}s in the tree')
+
+    state = SearchState(TranspositionTable())
+    start_time = time.time()
+    moves, values, _, depth = iterative_deepening(board.get_turn(), board, state, time_budget_ms=args.time_ms)
+    search_time = time.time() - start_time
+    print(f'Alpha-beta: {moves[0]} ({values[0]:+.1f}), depth {depth}, {state.nodes} nodes, {state.nodes / search_time:.0f} nodes/s')
@@ -15,6 +15,7 @@ import numpy as np
 
 # Local imports
 from board import ChessBoard
+from eval.leaf_evaluator import LeafEvaluator, expand_tree
 
 def example_use_of_model(model_path, board):
     # We will print out board to see what our board looks like
@@ -66,53 +67,54 @@ def example_use_of_model(model_path, board):
     print('The model predicts that the board evaluation is ', prediction)
     print('\n-------\n')
 
-def mm_eval_board(turn, board, model, current_depth, max_depth):
+def mm_eval_tree(turn, tree):
     """
-    This is the recursive function that will evaluate a board.
+    Computes the minimax value of a tree built by expand_tree(), once its evaluations are in.
     """
-    this_evaluation = model.predict(np.array([board.positional_encode()]), verbose=0)[0][0]
-    # print(f'This eval: {this_evaluation}')
+    this_evaluation, children = tree
+    this_evaluation = this_evaluation.result()
 
-    # Check if we are at the bottom - then, we are done
-    if current_depth >= max_depth:
+    # Check if we are at the bottom (or the game is over) - then, we are done
+    if not children:
         return this_evaluation
 
-    # Get all possible boards from this point
-    starter_board_fen = board.get_fen()
-    legal_moves = list(board.get_legal_moves())
-    possible_boards = []
-    for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(starter_board_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
-
     # Handle cases for either White or Black
     if turn == "W":
         other_turn = "B"
-        return this_evaluation + min([mm_eval_board(other_turn, sub_board, model, current_depth+1, max_depth) for sub_board in possible_boards])
+        return this_evaluation + min([mm_eval_tree(other_turn, sub_tree) for sub_tree in children])
 
     if turn == "B":
         other_turn = "W"
-        return this_evaluation + max([mm_eval_board(other_turn, sub_board, model, current_depth+1, max_depth) for sub_board in possible_boards])
+        return this_evaluation + max([mm_eval_tree(other_turn, sub_tree) for sub_tree in children])
+
+
+def mm_eval_board(turn, board, model, current_depth, max_depth):
+    """
+    This is the recursive function that will evaluate a board. Every board of the tree is
+    evaluated by the model in a few big batches (see leaf_evaluator.py).
+    """
+    evaluator = model if isinstance(model, LeafEvaluator) else LeafEvaluator(model)
+    tree = expand_tree(board, evaluator, current_depth, max_depth)
+    evaluator.flush()
+    return mm_eval_tree(turn, tree)
 
 
 def minimax(turn, board, model, max_depth):
-    # Get all possible boards from this point
-    original_fen = board.get_fen()
+    # Get the trees of all possible boards from this point; their evaluations are batched together
+    evaluator = LeafEvaluator(model)
     legal_moves = list(board.get_legal_moves())
-    possible_boards = []
+    trees = []
     for legal_move in legal_moves:
-        new_board = ChessBoard()
-        new_board.set_fen(original_fen)
-        new_board.make_move(str(legal_move))
-        possible_boards.append(new_board)
+        board.push(legal_move)
+        trees.append(expand_tree(board, evaluator, current_depth=1, max_depth=max_depth))
+        board.pop()
+    evaluator.flush()
 
     # Go through possibilities and do MCTS
     values = []
     # print(f'number of boards: {len(possible_boards)}')
-    for board in possible_boards:
-        this_value = mm_eval_board(turn, board, model, current_depth=1, max_depth=max_depth)
+    for tree in trees:
+        this_value = mm_eval_tree(turn, tree)
         # print(f'this val: {this_value}')
         values.append(this_value)
 
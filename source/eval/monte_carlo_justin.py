@@ -15,6 +15,7 @@ import numpy as np
 
 # Local imports
 from board import ChessBoard
+from eval.leaf_evaluator import LeafEvaluator, expand_tree
 
 def example_use_of_model(model_path, board):
     # We will print out board to see what our board looks like
@@ -67,88 +68,75 @@ def example_use_of_model(model_path, board):
     print('\n-------\n')
 
 
-def mc_eval_board(turn, board, current_depth, max_depth):
-    model_path = '../models/keon/saved_models/model_example.h5'
-    model = tf.keras.models.load_model(model_path)
-    def switch_turn(turn):
-        if turn == 'W':
-            return 'B'
-        else:
-            return 'W'
-
-    board_encoding = board.positional_encode
-    prediction = model.predict(np.array([board_encoding]), verbose=0)[0][0]
-
-    if max_depth == current_depth:
-        return prediction
-
-    possible_moves = board.
-    possible_boards =
+# The model is only loaded once, the first time it is needed
+MODEL_PATH = '../models/keon/saved_models/model_example.h5'
+_model = None
 
-    if turn == 'W':
-        other_turn = 'B'
-        return curr_eval + max([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+def load_model():
+    global _model
+    if _model is None:
+        _model = tf.keras.models.load_model(MODEL_PATH)
+    return _model
 
-    if turn == 'B':
-        other_turn = 'W'
-        return curr_eval + min([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
 
+def mc_eval_tree(turn, tree):
     """
-    this is the recursive function that will eval a board.
-    NOTE: this probably doesn't work but this is close i think hahah i did not test this sorry my kings
-
-    # Function for switching turns
-    def switch_turn(turn):
-        if turn == 'W':
-            return 'B'
-        else:
-            return 'W'
-
-    # Get current evaluation
-    curr_eval = evaluation of the "board" parameter
-
-
-
-    # CHECK IF WE ARE AT MAX DEPTH - IF WE DONT DO THIS, WE RECURSE FOREVER
-    if max_depth == current_depth:
-        return evaluation of our current board
-
-    # Get all possible boards
-    possible_boards = all possible boards from this board
+    Computes the value of a tree built by expand_tree(), once its evaluations are in.
+    """
+    curr_eval, children = tree
+    curr_eval = curr_eval.result()
 
-    # Handle cases differently for both teams ->
+    # CHECK IF WE ARE AT MAX DEPTH (OR THE GAME IS OVER) - IF WE DONT DO THIS, WE RECURSE FOREVER
+    if not children:
+        return curr_eval
 
     # If turn is W, we will return the max of the options (because white wants to maximize)
     if turn == 'W':
         other_turn = 'B'
-        return curr_eval + max([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + max([mc_eval_tree(other_turn, i) for i in children])
 
     # If turn is B, we will return the min of the options (because black wants to minimize)
     if turn == 'B':
         other_turn = 'W'
-        return curr_eval + min([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + min([mc_eval_tree(other_turn, i) for i in children])
+
 
+def mc_eval_board(turn, board, current_depth, max_depth, model=None):
     """
-    pass
+    this is the recursive function that will eval a board. Every board below it is evaluated by
+    the model in a few big batches (see leaf_evaluator.py).
+    """
+    if model is None:
+        model = load_model()
 
+    evaluator = LeafEvaluator(model)
+    tree = expand_tree(board, evaluator, current_depth, max_depth)
+    evaluator.flush()
+    return mc_eval_tree(turn, tree)
 
-def monte_carlo(board, max_depth):
-    """
-    turn = 'W' (if we are white, 'B' else)
 
-    # GO thru all the boards
-    possible_boards = all possible boards that we can move to
+def monte_carlo(board, max_depth):
+    # 'W' (if we are white, 'B' else)
+    turn = 'W'
+
+    # GO thru all the boards, queueing up the evaluations of everything below them
+    evaluator = LeafEvaluator(load_model())
+    trees = []
+    for move in list(board.get_legal_moves()):
+        board.push(move)
+        trees.append(expand_tree(board, evaluator, current_depth=0, max_depth=max_depth))
+        board.pop()
+    evaluator.flush()
 
     # GO through possibilities and do MCTS
     values = []
-    for board in possible_boards:
-        this_value = mc_eval_board(board, current_depth=0, max_depth=max_depth)
+    for tree in trees:
+        this_value = mc_eval_tree(turn, tree)
         values.append(this_value)
 
     # Choose the board that yields the highest value
     best_board = max(values)
-    """
-    pass
+    return best_board
 
 if __name__ == '__main__':
     board = ChessBoard()
@@ -15,6 +15,7 @@ import numpy as np
 
 # Local imports
 from board import ChessBoard
+from eval.leaf_evaluator import LeafEvaluator, expand_tree
 
 def example_use_of_model(model_path, board):
     # We will print out board to see what our board looks like
@@ -66,46 +67,38 @@ def example_use_of_model(model_path, board):
     print('The model predicts that the board evaluation is ', prediction)
     print('\n-------\n')
 
-def mc_eval_board(model, turn, board, current_depth, max_depth):
+def mc_eval_tree(turn, tree):
     """
-    this is the recursive function that will eval a board.
-    NOTE: this probably doesn't work but this is close i think hahah i did not test this sorry my kings"""
-
-    # Function for switching turns
-    def switch_turn(turn):
-        if turn == 'W':
-            return 'B'
-        else:
-            return 'W'
-
-    # Get current evaluation
-    board_encoding = board.positional_encode()
-    curr_eval = model.predict(np.array([board_encoding]), verbose=0)[0][0]
-    
+    Computes the value of a tree built by expand_tree(), once its evaluations are in.
+    """
+    curr_eval, children = tree
+    curr_eval = curr_eval.result()
 
-    # CHECK IF WE ARE AT MAX DEPTH - IF WE DONT DO THIS, WE RECURSE FOREVER
-    if max_depth == current_depth:
+    # CHECK IF WE ARE AT MAX DEPTH (OR THE GAME IS OVER) - IF WE DONT DO THIS, WE RECURSE FOREVER
+    if not children:
         return curr_eval
-    
-    # Get all possible boards
-    possible_moves = list(board.get_legal_moves())
-    possible_boards = []
-    start_fen = board.get_fen()
-    for move in possible_moves:
-        board.make_move(str(move))
-        possible_boards.append(board)
-        board.set_fen(start_fen)
+
     # Handle cases differently for both teams ->
 
     # If turn is W, we will return the max of the options (because white wants to maximize)
     if turn == 'W':
         other_turn = 'B'
-        return curr_eval + max([mc_eval_board(model, other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + max([mc_eval_tree(other_turn, i) for i in children])
     
     # If turn is B, we will return the min of the options (because black wants to minimize)
     if turn == 'B':
         other_turn = 'W'
-        return curr_eval + min([mc_eval_board(model, other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + min([mc_eval_tree(other_turn, i) for i in children])
+
+
+def mc_eval_board(model, turn, board, current_depth, max_depth):
+    """
+    this is the recursive function that will eval a board. All of the boards below it are 
+    evaluated by the model in a few big batches (see leaf_evaluator.py)."""
+    evaluator = LeafEvaluator(model)
+    tree = expand_tree(board, evaluator, current_depth, max_depth)
+    evaluator.flush()
+    return mc_eval_tree(turn, tree)
         
 
 
@@ -114,18 +107,20 @@ def monte_carlo(model, board, max_depth):
     #'W' (if we are white, 'B' else)
     turn = 'W'
 
-    # GO thru all the boards
+    # GO thru all the boards, queueing up the evaluations of everything below them
+    evaluator = LeafEvaluator(model)
     possible_moves = list(board.get_legal_moves())
-    possible_boards = []
-    start_fen = board.get_fen()
+    trees = []
     for move in possible_moves:
-        board.make_move(str(move))
-        possible_boards.append(board)
-        board.set_fen(start_fen)
+        board.push(move)
+        trees.append(expand_tree(board, evaluator, current_depth=0, max_depth=max_depth))
+        board.pop()
+    evaluator.flush()
+
     # GO through possibilities and do MCTS
     values = []
-    for b in possible_boards:
-        this_value = mc_eval_board(model, turn, b, current_depth=0, max_depth=max_depth)
+    for tree in trees:
+        this_value = mc_eval_tree(turn, tree)
         values.append(this_value)
 
     # Choose the board that yields the highest value
@@ -15,6 +15,7 @@ import numpy as np
 
 # Local imports
 from board import ChessBoard
+from eval.leaf_evaluator import LeafEvaluator, expand_tree
 
 
 def example_use_of_model(model_path, board):
@@ -66,39 +67,42 @@ def example_use_of_model(model_path, board):
     print('The model predicts that the board evaluation is ', prediction)
     print('\n-------\n')
 
-def white_monte(legal_moves, original_FEN, model):
-    curr_best_move_num = -100
-    curr_best_move = ""
+def predict_moves(legal_moves, original_FEN, model):
+    """
+    Predicts the board after every one of the legal moves, with a single batched model call.
+    """
+    board = ChessBoard()
+    board.set_fen(original_FEN)
 
+    evaluator = LeafEvaluator(model, max_batch_size=max(len(legal_moves), 1))
+    predictions = []
     for move in legal_moves:
-        board.make_move(str(move))
+        board.push(move)
+        predictions.append(evaluator.submit(board))
+        board.pop()
+    evaluator.flush()
 
-        board_encoding = board.positional_encode()
-        prediction = model.predict(np.array([board_encoding]), verbose=0)[0][0]
+    return [prediction.value for prediction in predictions]
 
+def white_monte(legal_moves, original_FEN, model):
+    curr_best_move_num = -100
+    curr_best_move = ""
+
+    for move, prediction in zip(legal_moves, predict_moves(legal_moves, original_FEN, model)):
         if (prediction > curr_best_move_num):
             curr_best_move_num = prediction
             curr_best_move = str(move)
 
-        board.set_fen(original_FEN)
-
     return curr_best_move, curr_best_move_num
 
 def black_monte(legal_moves, original_FEN, model):
     curr_best_move_num = 100
     curr_best_move = ""
-    for move in legal_moves:
-        board.make_move(str(move))
-
-        board_encoding = board.positional_encode()
-        prediction = model.predict(np.array([board_encoding]), verbose=0)[0][0]
-
+    for move, prediction in zip(legal_moves, predict_moves(legal_moves, original_FEN, model)):
         if (prediction < curr_best_move_num):
             curr_best_move_num = prediction
             curr_best_move = str(move)
 
-        board.set_fen(original_FEN)
-
     return curr_best_move, curr_best_move_num
 
 '''
@@ -131,70 +135,75 @@ def monte_carlo_two(model_path, board, turn):
 '''
 
 
-def mc_eval_board(turn, board, current_depth, max_depth):
-    """
-    this is the recursive function that will eval a board.
-    NOTE: this probably doesn't work but this is close I think haha I did not test this sorry my kings
-    """
-    model_path = '../models/keon/saved_models/model_example.h5'
-    model = tf.keras.models.load_model(model_path)
+# The model is only loaded once, the first time it is needed
+MODEL_PATH = '../models/keon/saved_models/model_example.h5'
+_model = None
 
-    # Function for switching turns
-    def switch_turn(turn):
-        if turn == 'W':
-            return 'B'
-        else:
-            return 'W'
+def load_model():
+    global _model
+    if _model is None:
+        _model = tf.keras.models.load_model(MODEL_PATH)
+    return _model
 
-    # Get current evaluation
-    board_encoding = board.positional_encode()
-    curr_eval = model.predict(np.array([board_encoding]), verbose=0)[0][0] # evaluation of the "board" parameter
 
-    # CHECK IF WE ARE AT MAX DEPTH - IF WE DON'T DO THIS, WE RECURSE FOREVER
-    if max_depth == current_depth:
-        return curr_eval # evaluation of our current board
+def mc_eval_tree(turn, tree):
+    """
+    Computes the value of a tree built by expand_tree(), once its evaluations are in.
+    """
+    curr_eval, children = tree
+    curr_eval = curr_eval.result() # evaluation of the "board" parameter
 
-    # Get all possible boards
-    legal_moves = list(board.get_legal_moves())
-    original_FEN = board.get_fen()
-    possible_boards = []  # list of all possible boards that can be made at moment
-    for move in legal_moves:
-        board.make_move(str(move))
-        possible_boards.append(board)
-        board.set_fen(original_FEN)
+    # CHECK IF WE ARE AT MAX DEPTH (OR THE GAME IS OVER) - IF WE DON'T DO THIS, WE RECURSE FOREVER
+    if not children:
+        return curr_eval # evaluation of our current board
 
     # Handle cases differently for both teams ->
 
     # If turn is W, we will return the max of the options (because white wants to maximize)
     if turn == 'W':
         other_turn = 'B'
-        return curr_eval + max([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + max([mc_eval_tree(other_turn, i) for i in children])
 
     # If turn is B, we will return the min of the options (because black wants to minimize)
     if turn == 'B':
         other_turn = 'W'
-        return curr_eval + min([mc_eval_board(other_turn, i, current_depth + 1, max_depth) for i in possible_boards])
+        return curr_eval + min([mc_eval_tree(other_turn, i) for i in children])
+
+
+def mc_eval_board(turn, board, current_depth, max_depth, model=None):
+    """
+    this is the recursive function that will eval a board. Every board below it is evaluated by
+    the model in a few big batches (see leaf_evaluator.py).
+    """
+    if model is None:
+        model = load_model()
+
+    evaluator = LeafEvaluator(model)
+    tree = expand_tree(board, evaluator, current_depth, max_depth)
+    evaluator.flush()
+    return mc_eval_tree(turn, tree)
 
 
 def monte_carlo(board, max_depth):
     turn = 'W'  # if we are white, 'B' else
 
-    # --- GO through all the boards ---
+    # --- GO through all the boards, queueing up the evaluations of everything below them ---
 
+    evaluator = LeafEvaluator(load_model())
     legal_moves = list(board.get_legal_moves())
-    original_FEN = board.get_fen()
 
-    possible_boards = []  # list of all possible boards that can be made at moment
+    trees = []  # one tree for every board that can be made at moment
     for move in legal_moves:
-        board.make_move(str(move))
-        possible_boards.append(board)
-        board.set_fen(original_FEN)
+        board.push(move)
+        trees.append(expand_tree(board, evaluator, current_depth=0, max_depth=max_depth))
+        board.pop()
+    evaluator.flush()
 
     # --- GO through possibilities and do MCTS ---
 
     values = []
-    for poss_board in possible_boards:
-        this_value = mc_eval_board(turn, poss_board, current_depth=0, max_depth=max_depth)
+    for tree in trees:
+        this_value = mc_eval_tree(turn, tree)
         values.append(this_value)
 
     # Choose the board that yields the highest value
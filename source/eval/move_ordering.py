@@ -0,0 +1,194 @@
+"""
+This script implements the move ordering of our alpha-beta search. Alpha-beta can only prune the
+rest of a node's moves once it found a move that is good enough, so the earlier the best move is
+tried, the fewer nodes the search has to look at.
+
+A move orderer hands the search the moves of a node one at a time, and is told about every cutoff
+so it can learn which moves are good. The search uses whichever orderer is in its SearchState:
+    -> MoveOrderer - The hash move first, then python-chess' generation order
+    -> HeuristicOrderer - The hash move first, then captures by MVV-LVA, then killer moves and then
+        the other quiet moves by their history score
+"""
+
+# Imports
+import chess
+
+# The most plies a search can go down (and so the number of killer move slots we keep)
+MAX_PLY = 128
+
+# Sort scores of quiet promotions and killer moves, far above any history score
+PROMOTION_SCORE = 1 << 50
+KILLER_SCORE = 1 << 40
+
+
+class MoveOrderer:
+    """
+    The simplest move orderer: it tries the hash move first (the best move the transposition table
+    has for this position, e.g. from the previous iteration), and then the rest of the moves in the
+    order python-chess generates them.
+
+    It also keeps track of how many cutoffs happened on the first move that was tried, which is
+    how we measure the quality of an ordering: with a perfect ordering, every cutoff happens on the
+    first move.
+    """
+    def __init__(self):
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Sets the cutoff counters back to zero.
+        """
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.cutoff_move_index_sum = 0
+
+    def new_search(self):
+        """
+        Called at the start of every search.
+        """
+        pass
+
+    def ordered_moves(self, board, ply, hash_move=None):
+        """
+        Yields the legal moves of the board in the order they should be searched. The search
+        plays each move (and takes it back) before asking for the next one, so moves after a
+        cutoff are never played.
+
+        Arguments:
+            board (ChessBoard): Our ChessBoard object
+            ply (int): How many plies below the root of the search this board is
+            hash_move (chess.Move): The best move the transposition table has for this board
+        """
+        chess_board = board.board
+        if hash_move is not None and chess_board.is_legal(hash_move):
+            yield hash_move
+        else:
+            hash_move = None
+
+        for move in chess_board.generate_legal_moves():
+            if move != hash_move:
+                yield move
+
+    def record_cutoff(self, board, move, ply, depth, move_index):
+        """
+        Called by the search when a move caused a cutoff.
+
+        Arguments:
+            board (ChessBoard): Our ChessBoard object, in the position the move was played from
+            move (chess.Move): The move that caused the cutoff
+            ply (int): How many plies below the root of the search this board is
+            depth (int): How many plies were left to search below this board
+            move_index (int): How many moves were searched before this one
+        """
+        self.cutoffs += 1
+        self.cutoff_move_index_sum += move_index
+        if move_index == 0:
+            self.first_move_cutoffs += 1
+
+    def stats(self):
+        """
+        Returns the cutoff counters, including the percentage of cutoffs on the first move.
+        """
+        return {
+            'cutoffs': self.cutoffs,
+            'first_move_cutoffs': self.first_move_cutoffs,
+            'first_move_cutoff_pct': 100 * self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.,
+            'avg_cutoff_move_index': self.cutoff_move_index_sum / self.cutoffs if self.cutoffs else 0.,
+        }
+
+
+class HeuristicOrderer(MoveOrderer):
+    """
+    Orders the moves in the order that most engines do:
+        1. The hash move
+        2. Captures, most valuable victim first and least valuable attacker second (MVV-LVA)
+        3. Promotions that do not capture
+        4. The killer moves of this ply: quiet moves that caused a cutoff in another node at the
+            same ply, which are often good here too
+        5. The remaining quiet moves, by their history score: how much they caused cutoffs anywhere
+            in the search so far, weighted by how deep the search was when they did
+
+    Moves are generated in stages, so if the hash move or a capture causes a cutoff, the quiet
+    moves are never generated.
+
+    Arguments:
+        use_killers (bool): If the killer move slots are used
+        use_history (bool): If the history table is used
+        num_killers (int): How many killer moves we keep per ply
+    """
+    def __init__(self, use_killers=True, use_history=True, num_killers=2):
+        super().__init__()
+        self.use_killers = use_killers
+        self.use_history = use_history
+        self.num_killers = num_killers
+        self.killers = [[] for _ in range(MAX_PLY)]
+
+        # History scores, by [color][from square][to square]
+        self.history = [0] * (2 * 64 * 64)
+
+    def new_search(self):
+        """
+        Forgets the killer moves (they belong to the plies of the last search), and halves the
+        history scores so that the current position matters more than older ones.
+        """
+        self.killers = [[] for _ in range(MAX_PLY)]
+        self.history = [score // 2 for score in self.history]
+
+    def ordered_moves(self, board, ply, hash_move=None):
+        chess_board = board.board
+        if hash_move is not None and chess_board.is_legal(hash_move):
+            yield hash_move
+        else:
+            hash_move = None
+
+        # Captures, by MVV-LVA
+        captures = []
+        for move in chess_board.generate_legal_captures():
+            if move == hash_move:
+                continue
+            victim = chess_board.piece_type_at(move.to_square) or chess.PAWN
+            attacker = chess_board.piece_type_at(move.from_square)
+            captures.append((10 * victim - attacker + 100 * (move.promotion or 0), move))
+        captures.sort(key=lambda x: x[0], reverse=True)
+        for _, move in captures:
+            yield move
+
+        # Quiet moves: promotions, then killers, then the rest by history score
+        killers = self.killers[ply] if self.use_killers and ply < MAX_PLY else []
+        history = self.history
+        color_offset = 4096 if chess_board.turn == chess.WHITE else 0
+        them = chess_board.occupied_co[not chess_board.turn]
+        quiet_moves = []
+        for move in chess_board.generate_legal_moves(chess.BB_ALL, chess.BB_ALL & ~them):
+            if move == hash_move or chess_board.is_en_passant(move):
+                continue
+            if move.promotion:
+                score = PROMOTION_SCORE * move.promotion
+            elif move in killers:
+                score = KILLER_SCORE * (self.num_killers - killers.index(move))
+            elif self.use_history:
+                score = history[color_offset + move.from_square * 64 + move.to_square]
+            else:
+                score = 0
+            quiet_moves.append((score, move))
+        quiet_moves.sort(key=lambda x: x[0], reverse=True)
+        for _, move in quiet_moves:
+            yield move
+
+    def record_cutoff(self, board, move, ply, depth, move_index):
+        super().record_cutoff(board, move, ply, depth, move_index)
+
+        # Killers and history are only about quiet moves, captures are already ordered by MVV-LVA
+        chess_board = board.board
+        if chess_board.is_capture(move) or move.promotion:
+            return
+
+        if self.use_killers and ply < MAX_PLY:
+            killers = self.killers[ply]
+            if move not in killers:
+                killers.insert(0, move)
+                del killers[self.num_killers:]
+
+        if self.use_history:
+            color_offset = 4096 if chess_board.turn == chess.WHITE else 0
+            self.history[color_offset + move.from_square * 64 + move.to_square] += depth * depth
@@ -0,0 +1,354 @@
+"""
+This script implements a NumPy-only runtime for our models. Importing TensorFlow and loading a .h5
+takes seconds, and every Keras call has its own overhead, which is a lot to pay for the small
+networks in models/*/model.py. So a trained model is exported once to a .npz file that holds its
+weights and its graph, and NumpyModel runs the same forward pass with nothing but NumPy. It loads
+in milliseconds and has the same predict_on_batch() as a Keras model, so the searches can use
+either one.
+
+The supported layers are the ones our models use: InputLayer, Dense, Conv2D (channels last),
+Reshape, Flatten, Concatenate, Activation, Dropout and slicing of a tensor (e.g. inputs[:, :768]),
+with linear, relu, tanh and sigmoid activations.
+
+Export a model (TensorFlow is only needed for this) with:
+    python eval/numpy_model.py <model>.h5 [--output <model>.npz]
+which also checks that the two give the same predictions.
+"""
+
+# Imports
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Local imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The version of the graph format in the exported files
+EXPORT_FORMAT_VERSION = 1
+
+# The key of the graph in the exported .npz
+GRAPH_KEY = '__graph__'
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+    'sigmoid': lambda x: np.divide(1, 1 + np.exp(-x), out=x),
+}
+
+
+def _activation_name(config):
+    activation = config.get('activation', 'linear')
+    # Newer Keras versions can serialize the activation as a dict
+    if isinstance(activation, dict):
+        activation = activation.get('config', {}).get('name', activation.get('class_name'))
+    if activation not in ACTIVATIONS:
+        raise NotImplementedError(f'The activation {activation} is not supported')
+    return activation
+
+
+def _slice_specs(spec):
+    """
+    Converts the serialized index of a slicing op into a list of [start, stop, step] per axis.
+    """
+    specs = []
+    for item in spec:
+        if isinstance(item, dict):
+            item = item.get('config', item)
+            specs.append([item.get('start'), item.get('stop'), item.get('step')])
+        else:
+            raise NotImplementedError(f'Only slices are supported when indexing a tensor, got {item}')
+    return specs
+
+
+def _inbound(layer_config):
+    """
+    Returns the names of the layers a layer is called on, and the extra arguments of the call. Both
+    the Keras 2 and the Keras 3 formats of the model config are read.
+    """
+    nodes = layer_config.get('inbound_nodes') or []
+    if not nodes:
+        return [], {}
+    node = nodes[0]
+
+    # Keras 3: {'args': [...], 'kwargs': {...}}, with the tensors as '__keras_tensor__' dicts
+    if isinstance(node, dict):
+        names = []
+
+        def find_tensors(obj):
+            if isinstance(obj, dict) and obj.get('class_name') == '__keras_tensor__':
+                names.append(obj['config']['keras_history'][0])
+            elif isinstance(obj, (list, tuple)):
+                for item in obj:
+                    find_tensors(item)
+
+        find_tensors(node['args'][:1])
+        extra = {'args': node['args'][1:], 'kwargs': node.get('kwargs', {})}
+        return names, extra
+
+    # Keras 2: a list of [layer_name, node_index, tensor_index, kwargs] (or a single one of them)
+    entries = [node] if isinstance(node[0], str) else node
+    kwargs = entries[0][3] if len(entries[0]) > 3 else {}
+    return [entry[0] for entry in entries], {'args': [], 'kwargs': kwargs}
+
+
+def _to_node(layer_config, inputs, extra):
+    """
+    Converts one layer of a model config to a node of our graph.
+    """
+    class_name = layer_config['class_name']
+    config = layer_config['config']
+    name = layer_config.get('name', config.get('name'))
+    node = {'name': name, 'inputs': inputs}
+
+    if class_name == 'InputLayer':
+        node['op'] = 'input'
+    elif class_name == 'Dense':
+        node.update(op='dense', activation=_activation_name(config))
+    elif class_name == 'Conv2D':
+        if config.get('data_format', 'channels_last') != 'channels_last':
+            raise NotImplementedError('Only channels_last convolutions are supported')
+        if tuple(config.get('dilation_rate', (1, 1))) != (1, 1) or config.get('groups', 1) != 1:
+            raise NotImplementedError('Dilated and grouped convolutions are not supported')
+        node.update(op='conv2d', strides=list(config['strides']), padding=config['padding'],
+                    activation=_activation_name(config))
+    elif class_name == 'Reshape':
+        node.update(op='reshape', target_shape=[int(dim) for dim in config['target_shape']])
+    elif class_name == 'Flatten':
+        node['op'] = 'flatten'
+    elif class_name == 'Concatenate':
+        node.update(op='concatenate', axis=config.get('axis', -1))
+    elif class_name == 'Activation':
+        node.update(op='activation', activation=_activation_name(config))
+    elif class_name == 'Dropout':
+        node['op'] = 'identity'
+    elif class_name == 'GetItem':
+        node.update(op='slice', slices=_slice_specs(extra['args'][0]))
+    elif class_name == 'TFOpLambda' and config.get('function') in ('__operators__.getitem', 'getitem'):
+        node.update(op='slice', slices=_slice_specs(extra['kwargs']['slice_spec']))
+    else:
+        raise NotImplementedError(f'The layer {name} ({class_name}) is not supported')
+    return node
+
+
+def export_model(model, output_path):
+    """
+    Exports a Keras model to a .npz file that NumpyModel can run.
+
+    Arguments:
+        model (tf.keras.Model or str): The model, or the path of its .h5/.keras file
+        output_path (str): The .npz file to write
+    """
+    if isinstance(model, str):
+        import tensorflow as tf
+        model = tf.keras.models.load_model(model, compile=False)
+
+    config = model.get_config()
+    # The layers of a Sequential model are a chain, and have no inbound nodes
+    sequential = 'input_layers' not in config
+
+    nodes, weights = [], {}
+    for layer_config in config['layers']:
+        if sequential:
+            inputs, extra = ([nodes[-1]['name']] if nodes else []), {'args': [], 'kwargs': {}}
+        else:
+            inputs, extra = _inbound(layer_config)
+        node = _to_node(layer_config, inputs, extra)
+        nodes.append(node)
+
+        if node['op'] in ('dense', 'conv2d'):
+            layer_weights = model.get_layer(node['name']).get_weights()
+            weights[f'{node["name"]}/kernel'] = np.asarray(layer_weights[0], dtype=np.float32)
+            if len(layer_weights) > 1:
+                weights[f'{node["name"]}/bias'] = np.asarray(layer_weights[1], dtype=np.float32)
+
+    # A Sequential model without an InputLayer starts with the input of its first layer
+    if nodes[0]['op'] != 'input':
+        nodes.insert(0, {'name': '__input__', 'inputs': [], 'op': 'input'})
+        nodes[1]['inputs'] = ['__input__']
+
+    if sequential:
+        input_names, output_names = [nodes[0]['name']], [nodes[-1]['name']]
+    else:
+        def layer_names(refs):
+            # A single [name, node, tensor] in Keras 3, a list of them in Keras 2
+            return [refs[0]] if isinstance(refs[0], str) else [ref[0] for ref in refs]
+        input_names, output_names = layer_names(config['input_layers']), layer_names(config['output_layers'])
+
+    graph = {'version': EXPORT_FORMAT_VERSION, 'inputs': input_names, 'outputs': output_names, 'nodes': nodes}
+    np.savez(output_path, **{GRAPH_KEY: np.array(json.dumps(graph))}, **weights)
+
+
+def _conv2d(x, kernel, bias, strides, padding):
+    """
+    A channels-last 2D convolution, as the product of every (kernel-sized) window of the input with
+    the kernel.
+    """
+    kernel_h, kernel_w = kernel.shape[:2]
+    stride_h, stride_w = strides
+    if padding == 'same':
+        pads = []
+        for size, kernel_size, stride in ((x.shape[1], kernel_h, stride_h), (x.shape[2], kernel_w, stride_w)):
+            total = max((-(-size // stride) - 1) * stride + kernel_size - size, 0)
+            pads.append((total // 2, total - total // 2))
+        x = np.pad(x, [(0, 0), pads[0], pads[1], (0, 0)])
+
+    windows = np.lib.stride_tricks.sliding_window_view(x, (kernel_h, kernel_w), axis=(1, 2))[:, ::stride_h, ::stride_w]
+    # windows is (batch, out_h, out_w, channels, kernel_h, kernel_w), the kernel is (kernel_h, kernel_w, channels, filters)
+    out = np.tensordot(windows, kernel, axes=([4, 5, 3], [0, 1, 2]))
+    if bias is not None:
+        out += bias
+    return out
+
+
+class NumpyModel:
+    """
+    Runs a model exported by export_model() with NumPy.
+
+    Arguments:
+        path (str): The exported .npz file
+    """
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            graph = json.loads(str(data[GRAPH_KEY]))
+            self.weights = {key: data[key] for key in data.files if key != GRAPH_KEY}
+
+        if graph['version'] != EXPORT_FORMAT_VERSION:
+            raise ValueError(f'{path} has version {graph["version"]} of the export format, expected {EXPORT_FORMAT_VERSION}')
+        self.path = path
+        self.nodes = graph['nodes']
+        self.inputs = graph['inputs']
+        self.outputs = graph['outputs']
+
+    def _run_node(self, node, args):
+        op = node['op']
+        if op == 'dense':
+            out = args[0] @ self.weights[f'{node["name"]}/kernel']
+            bias = self.weights.get(f'{node["name"]}/bias')
+            if bias is not None:
+                out += bias
+            return ACTIVATIONS[node['activation']](out)
+        if op == 'conv2d':
+            out = _conv2d(args[0], self.weights[f'{node["name"]}/kernel'], self.weights.get(f'{node["name"]}/bias'),
+                          node['strides'], node['padding'])
+            return ACTIVATIONS[node['activation']](out)
+        if op == 'slice':
+            return args[0][tuple(slice(*spec) for spec in node['slices'])]
+        if op == 'reshape':
+            return args[0].reshape((args[0].shape[0], *node['target_shape']))
+        if op == 'flatten':
+            return args[0].reshape(args[0].shape[0], -1)
+        if op == 'concatenate':
+            return np.concatenate(args, axis=node['axis'])
+        if op == 'activation':
+            return ACTIVATIONS[node['activation']](args[0].copy())
+        if op == 'identity':
+            return args[0]
+        raise NotImplementedError(f'Unknown op {op}')
+
+    def predict_on_batch(self, x):
+        """
+        Runs a batch through the model.
+
+        Arguments:
+            x (np.ndarray): The (batch_size, 776) encodings
+
+        Output:
+            np.ndarray: The (batch_size, 1) predictions
+        """
+        tensors = {self.inputs[0]: np.asarray(x, dtype=np.float32)}
+        for node in self.nodes:
+            if node['op'] == 'input':
+                continue
+            tensors[node['name']] = self._run_node(node, [tensors[name] for name in node['inputs']])
+        return tensors[self.outputs[0]]
+
+    def predict(self, x, batch_size=32, verbose=0):
+        """
+        Runs the inputs through the model in batches, like Keras' predict().
+        """
+        x = np.asarray(x, dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+    def __call__(self, x, training=False):
+        return self.predict_on_batch(x)
+
+
+def load_model(path, quantization=None):
+    """
+    Loads a model for the searches: an exported .npz as a NumpyModel, a .tflite with TensorFlow
+    Lite, and anything else with Keras (so TensorFlow is only imported when it is needed).
+
+    Arguments:
+        path (str): The model file
+        quantization (str): Optional 'int8' or 'float16', to load the quantized version of the model
+            instead (see eval/quantize.py)
+    """
+    if quantization is not None:
+        from eval.quantize import quantized_model_path
+        path = quantized_model_path(path, quantization)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'There is no {quantization} model at {path}, create it with eval/quantize.py')
+    if path.endswith('.npz'):
+        return NumpyModel(path)
+    if path.endswith('.tflite'):
+        from eval.quantize import TFLiteModel
+        return TFLiteModel(path)
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
+
+
+def _random_encodings(num_positions, seed=0):
+    """
+    Returns the encodings of positions from random games, to compare the two models on.
+    """
+    import chess
+    from board import positional_encode_many
+
+    rng = np.random.default_rng(seed)
+    boards, board = [], chess.Board()
+    while len(boards) < num_positions:
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            board = chess.Board()
+            continue
+        board.push(legal_moves[rng.integers(len(legal_moves))])
+        boards.append(board.copy())
+    return positional_encode_many(boards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a Keras model to the NumPy-only runtime.')
+    parser.add_argument('model', type=str, help='The .h5 (or .keras) model')
+    parser.add_argument('--output', type=str, default=None, help='The .npz to write (next to the model by default)')
+    parser.add_argument('--check-positions', type=int, default=1000, help='How many positions the two models are compared on')
+
+    args = parser.parse_args()
+    output_path = args.output or os.path.splitext(args.model)[0] + '.npz'
+
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    import tensorflow as tf
+
+    keras_model = tf.keras.models.load_model(args.model, compile=False)
+    export_model(keras_model, output_path)
+    print(f'Exported {args.model} to {output_path}')
+
+    start_time = time.time()
+    numpy_model = NumpyModel(output_path)
+    print(f'Loaded the NumPy model in {(time.time() - start_time) * 1000:.1f}ms')
+
+    x = _random_encodings(args.check_positions)
+    keras_preds = np.asarray(keras_model.predict_on_batch(x))
+    numpy_preds = numpy_model.predict_on_batch(x)
+    print(f'Largest difference over {len(x)} positions: {np.abs(keras_preds - numpy_preds).max():.2e}')
+
+    for name, model in (('Keras', keras_model), ('NumPy', numpy_model)):
+        model.predict_on_batch(x[:1])
+        start_time = time.time()
+        for row in x[:100]:
+            model.predict_on_batch(row[np.newaxis])
+        print(f'{name}: {(time.time() - start_time) * 10:.2f}ms per single-position call')
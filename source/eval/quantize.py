@@ -0,0 +1,274 @@
+"""
+This script implements post-training quantization of our models with TensorFlow Lite. The
+searches evaluate one small batch at a time on the CPU, where an int8 model runs several times
+faster than the float one (and a float16 model is half the size), for a small error in the evals.
+
+    -> int8: The weights and the activations are stored as 8-bit integers. The ranges of the
+        activations are calibrated on positions from the training data (a games file or a folder
+        of shards, see input_pipeline.py), so the model is quantized for the positions it sees.
+        Every HELD_OUT_EVERY-th game is left out of the calibration, and the quantized model is
+        tested on those games.
+    -> float16: The weights are stored as 16-bit floats, which needs no calibration.
+
+The quantized model is written next to the original one (model_example.h5 becomes
+model_example.int8.tflite), and is picked with the quantization argument of
+numpy_model.load_model() and find_move.find_best_move(), the AI_CHESS_QUANTIZATION environment
+variable of find_move.py, or --quantization of the engine daemon and uci.py.
+
+Quantize a model and compare it with the float one on held-out positions with:
+    python eval/quantize.py <model>.h5 --data <games file or shard folder> [--mode int8]
+"""
+
+# Imports
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+# Local imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from board import ENCODING_SIZE
+
+QUANTIZATION_MODES = ('int8', 'float16')
+
+# How many games are encoded at a time when the calibration positions come from a games file
+CALIBRATION_GAMES_PER_BATCH = 64
+
+# The positions are split by game: every HELD_OUT_EVERY-th game is held out to test the quantized
+# model on, and the int8 ranges are calibrated on the other games
+DATA_SPLITS = ('calibration', 'test')
+HELD_OUT_EVERY = 5
+
+
+def quantized_model_path(model_path, mode='int8'):
+    """
+    Returns where the quantized version of a model is saved, e.g. model_example.int8.tflite.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f'Unknown quantization {mode}, expected one of {QUANTIZATION_MODES}')
+    return f'{os.path.splitext(model_path)[0]}.{mode}.tflite'
+
+
+def split_games(num_games, split='calibration'):
+    """
+    Returns the numbers of the games of a split, so that no game is in both.
+    """
+    if split not in DATA_SPLITS:
+        raise ValueError(f'Unknown split {split}, expected one of {DATA_SPLITS}')
+    games = np.arange(num_games)
+    held_out = games % HELD_OUT_EVERY == 0
+    return games[held_out] if split == 'test' else games[~held_out]
+
+
+def _split_encodings(num_games, read_games, num_positions, rng, split):
+    """
+    Reads the games of a split in a random order (one pass at most) until there are num_positions
+    positions, and returns their encodings in chunks.
+    """
+    encodings, count = [], 0
+    games = rng.permutation(split_games(num_games, split))
+    for start in range(0, len(games), CALIBRATION_GAMES_PER_BATCH):
+        x = read_games(games[start:start + CALIBRATION_GAMES_PER_BATCH])
+        encodings.append(x)
+        count += len(x)
+        if count >= num_positions:
+            break
+    return encodings
+
+
+def calibration_encodings(data_path, num_positions=2000, seed=0, split='calibration'):
+    """
+    Returns the encodings of num_positions random positions from the games of one split of the
+    training data (see split_games()). There are fewer if the split does not have that many.
+
+    Arguments:
+        data_path (str): A file of games (one game per line) or a folder of shards
+        num_positions (int): How many positions to return
+        seed (int): The seed of the random positions
+        split (str): 'calibration' for the positions the int8 ranges are calibrated on, or 'test'
+            for the held-out positions the quantized model is compared on
+
+    Raises:
+        ValueError: If none of the games of the split has a position that can be read
+    """
+    rng = np.random.RandomState(seed)
+    if os.path.isdir(data_path):
+        from dataset_shards import ShardDataset
+        dataset = ShardDataset(data_path)
+        encodings = _split_encodings(dataset.num_games, lambda games: dataset.get_games(games)[0], num_positions,
+                                     rng, split)
+    else:
+        from data_handler import GameFileReader, games_to_arrays
+        with GameFileReader(data_path) as game_reader:
+            encodings = _split_encodings(len(game_reader), lambda games: games_to_arrays(game_reader.get_games(games))[0],
+                                         num_positions, rng, split)
+
+    if sum(len(x) for x in encodings) == 0:
+        raise ValueError(f'No positions could be read from the {split} games of {data_path}')
+    x = np.concatenate(encodings)
+    return x[rng.permutation(len(x))[:num_positions]]
+
+
+def quantize_model(model, output_path, mode='int8', calibration_x=None):
+    """
+    Quantizes a Keras model to a TensorFlow Lite file. The inputs and the outputs of the quantized
+    model stay float32, so it is used like the float model.
+
+    Arguments:
+        model (tf.keras.Model or str): The model, or the path of its .h5/.keras file
+        output_path (str): The .tflite file to write
+        mode (str): 'int8' or 'float16'
+        calibration_x (np.ndarray): The (n, 776) encodings the int8 ranges are calibrated on
+    """
+    import tensorflow as tf
+
+    if isinstance(model, str):
+        model = tf.keras.models.load_model(model, compile=False)
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        if calibration_x is None:
+            raise ValueError('int8 quantization needs calibration positions')
+
+        def representative_dataset():
+            for row in calibration_x:
+                yield [row[np.newaxis].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+    elif mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        raise ValueError(f'Unknown quantization {mode}, expected one of {QUANTIZATION_MODES}')
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def _interpreter_class():
+    # The standalone LiteRT / tflite-runtime interpreters are much lighter to import than TensorFlow
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel:
+    """
+    Runs a TensorFlow Lite model, with the same predict_on_batch() as a Keras model.
+
+    Arguments:
+        path (str): The .tflite file
+        num_threads (int): Optional number of threads of the interpreter
+    """
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.interpreter = _interpreter_class()(model_path=path, num_threads=num_threads)
+        self._input_index = self.interpreter.get_input_details()[0]['index']
+        self._output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        # An interpreter runs one call at a time, and the parallel MCTS calls it from several threads
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, x):
+        """
+        Runs a batch through the model.
+
+        Arguments:
+            x (np.ndarray): The (batch_size, 776) encodings
+
+        Output:
+            np.ndarray: The (batch_size, 1) predictions
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self._lock:
+            # The interpreter is only resized (and its memory planned again) when the batch size changes
+            if len(x) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input_index, list(x.shape))
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(x)
+            self.interpreter.set_tensor(self._input_index, x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output_index).copy()
+
+    def predict(self, x, batch_size=256, verbose=0):
+        """
+        Runs the inputs through the model in batches, like Keras' predict().
+        """
+        x = np.asarray(x, dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def _time_per_call_ms(model, x, num_calls=200):
+    model.predict_on_batch(x)
+    start_time = time.time()
+    for _ in range(num_calls):
+        model.predict_on_batch(x)
+    return (time.time() - start_time) * 1000 / num_calls
+
+
+def compare_models(float_model, quantized_model, x):
+    """
+    Compares a quantized model with the float model on some positions.
+
+    Output:
+        dict: The mean, root mean square and largest absolute error of the quantized evals (in the
+            units of the model's output, which is the eval divided by 15 for our models), how often
+            the two agree on who is better, and how long a single position and a batch of 256 take
+    """
+    float_preds = np.asarray(float_model.predict(x, batch_size=256, verbose=0)).reshape(-1)
+    quantized_preds = np.asarray(quantized_model.predict(x, batch_size=256, verbose=0)).reshape(-1)
+    errors = np.abs(quantized_preds - float_preds)
+
+    batch = x[:256]
+    return {
+        'positions': len(x),
+        'mae': float(errors.mean()),
+        'rmse': float(np.sqrt((errors ** 2).mean())),
+        'max_error': float(errors.max()),
+        'sign_agreement_pct': float(100 * np.mean(np.sign(quantized_preds) == np.sign(float_preds))),
+        'float_ms_per_position': _time_per_call_ms(float_model, x[:1]),
+        'quantized_ms_per_position': _time_per_call_ms(quantized_model, x[:1]),
+        'float_ms_per_batch': _time_per_call_ms(float_model, batch, num_calls=20),
+        'quantized_ms_per_batch': _time_per_call_ms(quantized_model, batch, num_calls=20),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantizes a model and compares it with the float model.')
+    parser.add_argument('model', type=str, help='The .h5 (or .keras) model')
+    parser.add_argument('--data', type=str, required=True, help='Games file or shard folder to calibrate and test on')
+    parser.add_argument('--mode', type=str, default='int8', choices=QUANTIZATION_MODES)
+    parser.add_argument('--output', type=str, default=None, help='The .tflite to write (next to the model by default)')
+    parser.add_argument('--calibration-positions', type=int, default=2000)
+    parser.add_argument('--test-positions', type=int, default=5000)
+
+    args = parser.parse_args()
+    output_path = args.output or quantized_model_path(args.model, args.mode)
+
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    import tensorflow as tf
+
+    keras_model = tf.keras.models.load_model(args.model, compile=False)
+    calibration_x = calibration_encodings(args.data, args.calibration_positions, seed=0) if args.mode == 'int8' else None
+    quantize_model(keras_model, output_path, args.mode, calibration_x)
+
+    # The models are compared on held-out games, none of which the ranges were calibrated on
+    test_x = calibration_encodings(args.data, args.test_positions, seed=1, split='test')
+    report = compare_models(keras_model, TFLiteModel(output_path), test_x)
+
+    print(f'\nQuantized {args.model} to {output_path} ({args.mode})')
+    print(f'Size: {os.path.getsize(args.model) / 1e6:.1f}MB -> {os.path.getsize(output_path) / 1e6:.1f}MB')
+    print(f'Eval error over {report["positions"]} positions: mean {report["mae"]:.5f}, rms {report["rmse"]:.5f}, '
+          f'max {report["max_error"]:.5f} ({15 * report["mae"]:.3f} pawns on average)')
+    print(f'Same sign as the float model: {report["sign_agreement_pct"]:.1f}%')
+    print(f'One position: {report["float_ms_per_position"]:.3f}ms -> {report["quantized_ms_per_position"]:.3f}ms')
+    print(f'Batch of 256: {report["float_ms_per_batch"]:.2f}ms -> {report["quantized_ms_per_batch"]:.2f}ms')
@@ -0,0 +1,129 @@
+"""
+This script measures what the selective parts of the alpha-beta search (null-move pruning,
+late-move reductions and principal variation search, see alpha_beta.py) are worth. Every
+configuration searches the same positions, and for each one it prints:
+    -> The nodes and the time it took to finish the target depth
+    -> How often its best move is the same as the one of the full-width search at that depth
+    -> How deep it got within a time budget per move
+
+Null-move pruning needs a beta bound and NULL_MOVE_MIN_DEPTH plies left, and the root searches
+every move with a full window, so it only prunes anything from depth NULL_MOVE_MIN_DEPTH + 2 on.
+
+Run it with:
+    python eval/search_benchmark.py [--depth 5] [--time-ms 2000] [--fens <file with one FEN per line>]
+"""
+
+# Imports
+import argparse
+import os
+import sys
+import time
+
+# Local imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from board import ChessBoard
+from eval.alpha_beta import SearchState, iterative_deepening, NULL_MOVE_MIN_DEPTH
+from eval.transposition_table import TranspositionTable
+
+# Opening, middlegame and endgame positions, including a few tactics
+BENCHMARK_FENS = [
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'r1bqkbnr/pppp1ppp/2n5/4p3/3PP3/8/PPP2PPP/RNBQKBNR b KQkq - 0 3',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8',
+    'r2q1rk1/ppp2ppp/2np1n2/2b1p1B1/2B1P1b1/2NP1N2/PPP2PPP/R2Q1RK1 w - - 0 8',
+    '2r3k1/pp3ppp/2n5/3p4/3P4/2P2N2/P4PPP/2R3K1 w - - 0 20',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    '6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1',
+]
+
+# The configurations that are compared, from the full-width search to all of the selective parts
+CONFIGURATIONS = {
+    'full width': {'null_move': False, 'lmr': False, 'pvs': False},
+    'pvs': {'null_move': False, 'lmr': False, 'pvs': True},
+    'null move': {'null_move': True, 'lmr': False, 'pvs': False},
+    'lmr': {'null_move': False, 'lmr': True, 'pvs': False},
+    'all': {'null_move': True, 'lmr': True, 'pvs': True},
+}
+
+
+def search_position(fen, depth=None, time_budget_ms=None, tt_size_mb=16, **options):
+    """
+    Searches a position with a fresh transposition table and move orderer.
+
+    Arguments:
+        fen (str): The position
+        depth (int): The depth to search to
+        time_budget_ms (float): Optional time budget instead of a fixed depth
+        options: The switches of the search (see SearchState), e.g. null_move=False
+
+    Output:
+        dict: The best move, the depth that was finished, the nodes and the time it took
+    """
+    board = ChessBoard()
+    board.set_fen(fen)
+    state = SearchState(TranspositionTable(tt_size_mb), **options)
+
+    start_time = time.time()
+    moves, _, _, completed_depth = iterative_deepening(board.get_turn(), board, state, max_depth=depth,
+                                                       time_budget_ms=time_budget_ms)
+    return {
+        'move': moves[0] if moves else None,
+        'depth': completed_depth,
+        'nodes': state.nodes,
+        'time': time.time() - start_time,
+    }
+
+
+def run_benchmark(fens, depth, time_budget_ms=None, configurations=CONFIGURATIONS):
+    """
+    Runs every configuration on every position.
+
+    Output:
+        dict: For every configuration, its total nodes and time to the depth, the fraction of the
+            positions where it agreed with the first configuration on the best move, and the
+            average depth it finished within the time budget (if there is one)
+    """
+    results = {}
+    reference_moves = None
+    for name, options in configurations.items():
+        to_depth = [search_position(fen, depth, **options) for fen in fens]
+        moves = [result['move'] for result in to_depth]
+        if reference_moves is None:
+            reference_moves = moves
+
+        results[name] = {
+            'nodes': sum(result['nodes'] for result in to_depth),
+            'time': sum(result['time'] for result in to_depth),
+            'agreement': sum(move == reference for move, reference in zip(moves, reference_moves)) / len(fens),
+        }
+        if time_budget_ms is not None:
+            in_budget = [search_position(fen, time_budget_ms=time_budget_ms, **options) for fen in fens]
+            results[name]['budget_depth'] = sum(result['depth'] for result in in_budget) / len(fens)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares null-move pruning, LMR and PVS in the alpha-beta search.')
+    parser.add_argument('--depth', type=int, default=5, help='The depth every configuration searches to')
+    parser.add_argument('--time-ms', type=float, default=None, help='Also report the depth reached in this budget')
+    parser.add_argument('--fens', type=str, default=None, help='File with one FEN per line (built-in positions by default)')
+
+    args = parser.parse_args()
+
+    fens = BENCHMARK_FENS
+    if args.fens is not None:
+        with open(args.fens) as f:
+            fens = [line.strip() for line in f if line.strip()]
+
+    results = run_benchmark(fens, args.depth, args.time_ms)
+    base_nodes = results['full width']['nodes']
+    print(f'{len(fens)} positions, depth {args.depth}')
+    if args.depth <= NULL_MOVE_MIN_DEPTH + 1:
+        print(f'Note: null-move pruning only starts to prune at depth {NULL_MOVE_MIN_DEPTH + 2}')
+    for name, result in results.items():
+        line = (f'{name:>10}: {result["nodes"]:>9} nodes (x{base_nodes / result["nodes"]:.2f} fewer), '
+                f'{result["time"]:.2f}s, same best move {100 * result["agreement"]:.0f}%')
+        if 'budget_depth' in result:
+            line += f', depth {result["budget_depth"]:.1f} in {args.time_ms:.0f}ms'
+        print(line)
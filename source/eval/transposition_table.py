@@ -0,0 +1,389 @@
+"""
+This script implements the transposition table for our alpha-beta search. A transposition table is
+a fixed-size hash table that remembers what the search already found out about a position, so that
+a position reached through a different move order is not searched from scratch again.
+
+Positions are keyed by a 64-bit Zobrist hash (the same numbers as python-chess' polyglot hash), and
+the hash is updated move by move while the search pushes moves instead of being recomputed from the
+whole board at every node.
+
+Every entry is two 64-bit words: the key XOR'd with the data, and the data itself. The data packs
+the score, best move, depth, bound type and how deep the line went below this position. An entry
+is only used if the key matches.
+
+The table can live in shared memory, so that the processes of a parallel search (see lazy_smp.py)
+probe and store through the same entries without a lock. Two processes writing the same slot at
+the same time can leave the words of two different entries in it, but then the key XOR'd with the
+data does not match any position anymore, so the torn entry is never used (the "lockless hashing"
+trick).
+"""
+
+# Imports
+from multiprocessing import shared_memory
+
+import chess
+import chess.polyglot
+
+# Bound types of an entry
+EXACT = 0   # The score is the exact value of the position
+LOWER = 1   # The search failed high, so the value is at least the score
+UPPER = 2   # The search failed low, so the value is at most the score
+
+# Supported replacement policies
+#   -> 'depth' - Only replace an entry from this search with an entry that searched at least as deep
+#   -> 'always' - Always replace the entry in the slot
+REPLACEMENT_POLICIES = ('depth', 'always')
+
+# Size of one entry in bytes (two 64-bit words, plus one byte for the age of the entry)
+ENTRY_SIZE = 2 * 8 + 1
+
+ZOBRIST_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+ZOBRIST_HASHER = chess.polyglot.ZobristHasher(ZOBRIST_ARRAY)
+TURN_KEY = ZOBRIST_ARRAY[780]
+
+# Scores are stored as signed hundredths in 32 bits, with the ends reserved for the checkmate scores
+SCORE_SCALE = 100
+SCORE_INF = 2 ** 31 - 1
+
+# Depth is stored in 7 bits, and the bit above it marks the slot as used
+MAX_STORED_DEPTH = 127
+_USED_BIT = 1 << 55
+
+_MASK_32 = 2 ** 32 - 1
+
+# Castling rights only take a handful of values, so their keys are cached by the rights bitmask
+_castling_keys = {}
+
+
+def zobrist_hash(board):
+    """
+    Computes the 64-bit Zobrist hash of a board from scratch. The search only does this at its
+    root, and uses push_hashed() to keep the hash up to date below that.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object
+    """
+    return ZOBRIST_HASHER(board.board)
+
+
+def _castling_key(castling_rights):
+    key = _castling_keys.get(castling_rights)
+    if key is None:
+        key = 0
+        for idx, square in enumerate([chess.H1, chess.A1, chess.H8, chess.A8]):
+            if castling_rights & chess.BB_SQUARES[square]:
+                key ^= ZOBRIST_ARRAY[768 + idx]
+        _castling_keys[castling_rights] = key
+    return key
+
+
+def _piece_key(piece_type, color, square):
+    return ZOBRIST_ARRAY[64 * ((piece_type - 1) * 2 + color) + square]
+
+
+def push_hashed(board, move, key):
+    """
+    Plays a move on the board and returns the Zobrist hash of the new position, updating the hash
+    of the old position with only the squares that changed.
+
+    Arguments:
+        board (ChessBoard): Our ChessBoard object, in the position before the move
+        move (chess.Move): The move to play
+        key (int): The Zobrist hash of the position before the move
+
+    Output:
+        int: The Zobrist hash of the position after the move
+    """
+    chess_board = board.board
+    color = chess_board.turn
+    from_square = move.from_square
+    to_square = move.to_square
+
+    # Take out the castling rights and en passant file of the old position, and flip the turn
+    key ^= _castling_key(chess_board.castling_rights) ^ TURN_KEY
+    if chess_board.ep_square is not None:
+        key ^= ZOBRIST_HASHER.hash_ep_square(chess_board)
+
+    # Move the piece, promoting it if needed
+    piece_type = chess_board.piece_type_at(from_square)
+    key ^= _piece_key(piece_type, color, from_square)
+    key ^= _piece_key(move.promotion or piece_type, color, to_square)
+
+    # Take out a captured piece (which is behind the target square for en passant)
+    captured_piece_type = chess_board.piece_type_at(to_square)
+    if captured_piece_type:
+        key ^= _piece_key(captured_piece_type, not color, to_square)
+    elif piece_type == chess.PAWN and to_square == chess_board.ep_square:
+        captured_square = to_square - 8 if color == chess.WHITE else to_square + 8
+        key ^= _piece_key(chess.PAWN, not color, captured_square)
+
+    # Castling also moves the rook
+    if piece_type == chess.KING and abs(to_square - from_square) == 2:
+        if to_square > from_square:
+            rook_from, rook_to = from_square + 3, from_square + 1
+        else:
+            rook_from, rook_to = from_square - 4, from_square - 1
+        key ^= _piece_key(chess.ROOK, color, rook_from) ^ _piece_key(chess.ROOK, color, rook_to)
+
+    board.push(move)
+
+    # Put in the castling rights and en passant file of the new position
+    key ^= _castling_key(chess_board.castling_rights)
+    if chess_board.ep_square is not None:
+        key ^= ZOBRIST_HASHER.hash_ep_square(chess_board)
+
+    return key
+
+
+def push_null_hashed(board, key):
+    """
+    Passes the turn (plays a null move) on the board and returns the Zobrist hash of the new
+    position. Only the turn and the en passant square change.
+    """
+    chess_board = board.board
+    key ^= TURN_KEY
+    if chess_board.ep_square is not None:
+        key ^= ZOBRIST_HASHER.hash_ep_square(chess_board)
+    board.push(chess.Move.null())
+    return key
+
+
+def encode_move(move):
+    """
+    Packs a move into 16 bits. 0 means that there is no move.
+    """
+    if move is None:
+        return 0
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def decode_move(bits):
+    """
+    Unpacks a move that was packed with encode_move().
+    """
+    if bits == 0:
+        return None
+    return chess.Move(bits & 63, (bits >> 6) & 63, (bits >> 12) or None)
+
+
+def encode_score(score):
+    """
+    Converts a score to the signed integer stored in an entry.
+    """
+    if score == float('inf'):
+        return SCORE_INF
+    if score == -float('inf'):
+        return -SCORE_INF
+    return max(-SCORE_INF + 1, min(SCORE_INF - 1, int(round(score * SCORE_SCALE))))
+
+
+def decode_score(value):
+    """
+    Converts the signed integer stored in an entry back to a score.
+    """
+    if value == SCORE_INF:
+        return float('inf')
+    if value == -SCORE_INF:
+        return -float('inf')
+    if value % SCORE_SCALE == 0:
+        return value // SCORE_SCALE
+    return value / SCORE_SCALE
+
+
+class TranspositionTable:
+    """
+    A fixed-size transposition table, with one entry per slot. The slot of a position is picked
+    with the low bits of its Zobrist hash.
+
+    Arguments:
+        size_mb (float): The memory budget of the table in MB. The number of entries is the largest
+            power of two that fits in the budget.
+        replacement (str): The replacement policy, one of REPLACEMENT_POLICIES
+        shared (bool): If the entries are put in shared memory, so that other processes can use the
+            table with TranspositionTable.attach(*table.shared_handle())
+    """
+    def __init__(self, size_mb=16, replacement='depth', shared=False):
+        if replacement not in REPLACEMENT_POLICIES:
+            raise ValueError(f'Unknown replacement policy {replacement}, expected one of {REPLACEMENT_POLICIES}')
+
+        max_entries = int(size_mb * 1024 * 1024) // ENTRY_SIZE
+        if max_entries < 1:
+            raise ValueError(f'A transposition table of {size_mb} MB can not hold a single entry')
+        self.num_entries = 1 << (max_entries.bit_length() - 1)
+        self.replacement = replacement
+        self._mask = self.num_entries - 1
+
+        if shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=ENTRY_SIZE * self.num_entries)
+            self._owner = True
+            self._map_shared_memory()
+        else:
+            self._shm = None
+            self._words = memoryview(bytearray(16 * self.num_entries)).cast('Q')
+            self._ages = bytearray(self.num_entries)
+        self._age = 1
+
+        self.reset_stats()
+
+    @classmethod
+    def attach(cls, name, num_entries, replacement='depth'):
+        """
+        Opens a table that another process put in shared memory (see shared_handle()).
+        """
+        tt = cls.__new__(cls)
+        tt.num_entries = num_entries
+        tt.replacement = replacement
+        tt._mask = num_entries - 1
+        tt._shm = shared_memory.SharedMemory(name=name)
+        tt._owner = False
+        tt._map_shared_memory()
+        tt._age = 1
+        tt.reset_stats()
+        return tt
+
+    def _map_shared_memory(self):
+        # The words of all of the entries come first, then their ages
+        words_size = 16 * self.num_entries
+        self._words = self._shm.buf[:words_size].cast('Q')
+        self._ages = self._shm.buf[words_size:words_size + self.num_entries]
+
+    def shared_handle(self):
+        """
+        Returns what another process needs to open this table with TranspositionTable.attach().
+        """
+        if self._shm is None:
+            raise ValueError('The table is not in shared memory')
+        return self._shm.name, self.num_entries, self.replacement
+
+    def close(self):
+        """
+        Lets go of the shared memory of the table, and frees it if this process created it. The
+        table can not be used anymore afterwards.
+        """
+        if self._shm is None:
+            return
+        self._words.release()
+        self._ages.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def reset_stats(self):
+        """
+        Sets all of the counters back to zero.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def clear(self):
+        """
+        Removes every entry from the table.
+        """
+        self._words[:] = memoryview(bytes(16 * self.num_entries)).cast('Q')
+        self._ages[:] = bytes(self.num_entries)
+        self._age = 1
+
+    def new_search(self, age=None):
+        """
+        Marks the start of a new search, so that the entries of older searches are replaced first.
+
+        Arguments:
+            age (int): Optional age of the new search, for the processes that share a table to use
+                the same age as the one that started the search (see the age attribute)
+        """
+        self._age = self._age % 255 + 1 if age is None else age
+
+    @property
+    def age(self):
+        return self._age
+
+    def probe(self, key):
+        """
+        Looks up a position in the table.
+
+        Arguments:
+            key (int): The Zobrist hash of the position
+
+        Output:
+            tuple or None: (depth, bound, score, move, depth_below) if the position is in the table,
+                where depth_below is how many plies below this position the stored line ended
+        """
+        idx = key & self._mask
+        data = self._words[2 * idx + 1]
+        if data == 0 or self._words[2 * idx] ^ data != key:
+            self.misses += 1
+            if data != 0:
+                self.collisions += 1
+            return None
+
+        self.hits += 1
+        score = data & _MASK_32
+        if score > SCORE_INF:
+            score -= 2 ** 32
+        return (
+            (data >> 48) & MAX_STORED_DEPTH,
+            (data >> 56) & 3,
+            decode_score(score),
+            decode_move((data >> 32) & 0xFFFF),
+            data >> 58,
+        )
+
+    def store(self, key, depth, bound, score, move, depth_below=0):
+        """
+        Stores the result of searching a position, if the replacement policy allows it.
+
+        Arguments:
+            key (int): The Zobrist hash of the position
+            depth (int): How many plies were searched below this position
+            bound (int): EXACT, LOWER or UPPER
+            score (float): The score the search returned
+            move (chess.Move): The best move found, or None
+            depth_below (int): How many plies below this position the best line ended
+        """
+        idx = key & self._mask
+        old_data = self._words[2 * idx + 1]
+        if old_data != 0:
+            same_position = self._words[2 * idx] ^ old_data == key
+            if self.replacement == 'depth' and self._ages[idx] == self._age and depth < (old_data >> 48) & MAX_STORED_DEPTH:
+                return
+            if not same_position:
+                self.overwrites += 1
+
+            # Keep the best move we already had if this result did not find one
+            if move is None and same_position:
+                move = decode_move((old_data >> 32) & 0xFFFF)
+
+        data = (
+            (encode_score(score) & _MASK_32)
+            | (encode_move(move) << 32)
+            | (min(depth, MAX_STORED_DEPTH) << 48)
+            | _USED_BIT
+            | (bound << 56)
+            | (min(depth_below, 63) << 58)
+        )
+        self._words[2 * idx] = key ^ data
+        self._words[2 * idx + 1] = data
+        self._ages[idx] = self._age
+        self.stores += 1
+
+    def stats(self):
+        """
+        Returns the counters of the table, so it can be sized for a machine.
+        """
+        probes = self.hits + self.misses
+        used = sum(1 for idx in range(0, min(self.num_entries, 1000)) if self._words[2 * idx + 1] != 0)
+        return {
+            'size_mb': self.num_entries * ENTRY_SIZE / (1024 * 1024),
+            'entries': self.num_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'collisions': self.collisions,
+            'stores': self.stores,
+            'overwrites': self.overwrites,
+            'hit_rate': self.hits / probes if probes else 0.,
+            'fill': used / min(self.num_entries, 1000),
+        }
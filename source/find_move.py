@@ -7,6 +7,10 @@ For example, if the find_best_move() function determines that the pawn on c2 goi
 is the best move in this position, it will return the string "c2c4" which is chess' 
 notation for that pawn move.
 
+The search itself runs in the engine daemon (see engine_server.py), which keeps TensorFlow and the
+model loaded between moves. This script only sends it the FEN, and starts the daemon in the
+background the first time it is needed, so only the first move pays for loading the model.
+
 Just make sure your python environment has the appropriate packages installed (should be 
 found in requirements.txt and can be insalled wiht the command `pip install -r requirements.txt`).
 
@@ -14,23 +18,85 @@ found in requirements.txt and can be insalled wiht the command `pip install -r r
 
 # Python Imports
 import os
+import subprocess
 import sys
 import time
-import tensorflow as tf
 
 # Local imports
 from board import ChessBoard
-from eval.eval_board import evaluate_board
-
-# Set tf logs
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
-
-# Dynamically get path to our trained neural network
-MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
-                            'models', 
-                            'keon', 
-                            'saved_models', 
-                            'model_example.h5')
+from engine_server import DEFAULT_SOCKET_PATH, lock_file, send_request, ping
+
+# The daemon's socket can be moved with this environment variable
+SOCKET_PATH = os.environ.get('AI_CHESS_ENGINE_SOCKET', DEFAULT_SOCKET_PATH)
+
+# Set this environment variable to 'int8' or 'float16' to search with a quantized model (see
+# eval/quantize.py)
+QUANTIZATION = os.environ.get('AI_CHESS_QUANTIZATION') or None
+
+# Set this environment variable to 'mcts' to search with Monte Carlo Tree Search instead of
+# alpha-beta (see eval/mcts.py)
+SEARCH = os.environ.get('AI_CHESS_SEARCH') or None
+
+# How long we wait for a daemon we started to load the model, in seconds
+DAEMON_START_TIMEOUT = 120
+
+def _daemon_is_running(socket_path):
+    """
+    Returns True if a daemon holds the lock of the socket, e.g. one that is still loading the model.
+    """
+    daemon_lock = lock_file(socket_path + '.lock', blocking=False)
+    if daemon_lock is None:
+        return True
+    daemon_lock.close()
+    return False
+
+def start_engine_daemon(socket_path=SOCKET_PATH):
+    """
+    Starts the engine daemon in the background and waits until it answers. Clients that need the
+    daemon at the same time take turns, so only the first one starts it.
+    """
+    with lock_file(socket_path + '.start.lock'):
+        # Another client may have started the daemon while we waited for the lock
+        if ping(socket_path=socket_path):
+            return
+
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'engine_server.py')
+        process = subprocess.Popen([sys.executable, server_script, '--socket', socket_path],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        deadline = time.time() + DAEMON_START_TIMEOUT
+        while time.time() < deadline:
+            if ping(socket_path=socket_path):
+                return
+            if process.poll() is not None and not _daemon_is_running(socket_path):
+                raise RuntimeError(f'The engine daemon exited with code {process.returncode} while starting')
+            time.sleep(0.1)
+        raise TimeoutError(f'The engine daemon did not start within {DAEMON_START_TIMEOUT}s')
+
+def find_best_move(fen, time_budget_ms=None, socket_path=SOCKET_PATH, quantization=QUANTIZATION, search=SEARCH):
+    """
+    Returns the best move of the position (e.g. 'c2c4'), asking the engine daemon for it and
+    starting the daemon if it is not running yet.
+
+    Arguments:
+        fen (str): The FEN of the position
+        time_budget_ms (float): Optional time budget of the search in milliseconds
+        socket_path (str): The Unix socket of the daemon
+        quantization (str): 'int8' or 'float16' to search with a quantized model (by default, the
+            daemon's model is used)
+        search (str): 'alpha_beta' (the default) or 'mcts'
+    """
+    request = {'cmd': 'find_best_move', 'fen': fen, 'time_budget_ms': time_budget_ms}
+    if quantization is not None:
+        request['quantization'] = quantization
+    if search is not None:
+        request['search'] = search
+    try:
+        response = send_request(request, socket_path=socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        start_engine_daemon(socket_path)
+        response = send_request(request, socket_path=socket_path)
+    return response['move']
 
 def main():
     # Make sure the user passed in a fen string and nothing else
@@ -48,12 +114,9 @@ def main():
     if not validity:
         exit()
 
-    # Load in model
-    model = tf.keras.models.load_model(MODEL_PATH)
-
     # Get best move
     start_time = time.time()
-    best_move, _ = evaluate_board(board, model, board.get_turn())
+    best_move = find_best_move(fen)
     end_time = time.time()
 
     print(f'Best move: {best_move}')
@@ -68,4 +131,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,411 @@
+"""
+This script implements our inference server: a long-lived process that loads every model under
+models/*/saved_models once, and evaluates positions for any number of searches and games at the
+same time. Instead of every consumer loading its own copy of a model and calling it one position at
+a time, the requests of all the connections are collected by a DynamicBatcher and go through the
+model together, in one forward pass.
+
+A batch is run as soon as it holds max_batch_size positions, or when its first request has waited
+for max_wait_ms, whichever comes first. So under load the batches are big, and a lone request only
+waits max_wait_ms for company.
+
+The server uses the same line-JSON protocol as the engine daemon (see engine_server.py):
+    -> {"cmd": "predict", "model": "keon/model_example", "rows": 2, "x": "<base64 of float32 rows>"}
+        <- {"values": [0.1, -0.3]}
+    -> {"cmd": "models"}     <- {"models": ["keon/model_example", "quinn/model0"]}
+    -> {"cmd": "metrics"}    <- {"keon/model_example": {"queue_depth": 0, "batch_sizes": {...}, ...}}
+    -> {"cmd": "ping"}       <- {"ok": true}
+    -> {"cmd": "shutdown"}   <- {"ok": true}
+A model is named after its folder and file ("keon/model_example"), and can also be asked for by the
+path of its file.
+
+RemoteModel is the client. It has a Keras-style predict_on_batch(), so it can be handed to
+evaluate_board() (or a LeafEvaluator) in place of a loaded model.
+
+Run it with:
+    python inference_server.py [--socket /tmp/ai_chess_inference.sock | --port 5006] [--max-batch 256] [--max-wait-ms 2]
+    python inference_server.py --metrics
+"""
+
+# Python Imports
+import argparse
+import base64
+import collections
+import glob
+import json
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+# Local imports
+from board import ENCODING_SIZE
+from engine_server import EngineRequestHandler, _connect, ping, send_request
+
+# Set tf logs
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+# Default Unix socket of the server, which can be moved with this environment variable
+DEFAULT_SOCKET_PATH = os.environ.get('AI_CHESS_INFERENCE_SOCKET', os.path.join('/tmp', 'ai_chess_inference.sock'))
+
+# The folder with one subfolder of models per person
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+# How many of the latest requests the latency percentiles are computed over
+LATENCY_WINDOW = 10_000
+
+
+def find_models(models_dir=MODELS_DIR):
+    """
+    Returns the saved models under models_dir, as a dict from their names ('keon/model_example') to
+    their paths.
+    """
+    models = {}
+    for extension in ('h5', 'keras', 'npz'):
+        for path in sorted(glob.glob(os.path.join(models_dir, '*', 'saved_models', f'*.{extension}'))):
+            owner = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            name = f'{owner}/{os.path.splitext(os.path.basename(path))[0]}'
+            models.setdefault(name, path)
+    return models
+
+
+class DynamicBatcher:
+    """
+    Runs the prediction requests of many threads through one model in batches. The batches are run
+    on a thread of their own.
+
+    Arguments:
+        model: The model. Anything with a Keras-style predict_on_batch().
+        max_batch_size (int): The most positions in one batch. A request with more positions than
+            this is run as a batch of its own.
+        max_wait_ms (float): The longest the first request of a batch waits for more requests
+    """
+    def __init__(self, model, max_batch_size=256, max_wait_ms=2.):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self._inputs = np.zeros((max_batch_size, ENCODING_SIZE), dtype=np.float32)
+        self._queue = collections.deque()
+        self._queued_rows = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._metrics_lock = threading.Lock()
+        self.reset_metrics()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset_metrics(self):
+        """
+        Sets the counters back to zero.
+        """
+        with self._metrics_lock:
+            self.num_requests = 0
+            self.num_positions = 0
+            self.num_batches = 0
+            self.predict_time = 0.
+            self.batch_sizes = collections.Counter()
+            self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def submit(self, x):
+        """
+        Queues positions for evaluation.
+
+        Arguments:
+            x (np.ndarray): The (n, 776) encodings of the positions
+
+        Output:
+            concurrent.futures.Future: The (n,) evaluations of the positions, once their batch ran
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The batcher is closed')
+            self._queue.append((x, future, time.time()))
+            self._queued_rows += len(x)
+            self._condition.notify()
+        return future
+
+    def predict(self, x):
+        """
+        Evaluates positions and waits for the result (see submit()).
+        """
+        return self.submit(x).result()
+
+    def queue_depth(self):
+        """
+        Returns how many positions are waiting for a batch.
+        """
+        with self._condition:
+            return self._queued_rows
+
+    def close(self):
+        """
+        Runs the requests that are still queued and stops the batching thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        """
+        Waits for the first request, then collects requests until the batch is full or the first
+        request waited for max_wait_ms. Returns None once the batcher is closed and empty.
+        """
+        with self._condition:
+            while not self._queue:
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+            deadline = self._queue[0][2] + self.max_wait_ms / 1000
+            while self._queued_rows < self.max_batch_size and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = [self._queue.popleft()]
+            num_rows = len(batch[0][0])
+            while self._queue and num_rows + len(self._queue[0][0]) <= self.max_batch_size:
+                request = self._queue.popleft()
+                batch.append(request)
+                num_rows += len(request[0])
+            self._queued_rows -= num_rows
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            num_rows = sum(len(x) for x, _, _ in batch)
+            if num_rows <= self.max_batch_size:
+                inputs = self._inputs[:num_rows]
+                np.concatenate([x for x, _, _ in batch], out=inputs)
+            else:
+                inputs = batch[0][0]
+
+            start_time = time.time()
+            try:
+                preds = np.asarray(self.model.predict_on_batch(inputs), dtype=np.float32).reshape(-1)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.time()
+
+            offset = 0
+            for x, future, _ in batch:
+                future.set_result(preds[offset:offset + len(x)].copy())
+                offset += len(x)
+
+            with self._metrics_lock:
+                self.num_requests += len(batch)
+                self.num_positions += num_rows
+                self.num_batches += 1
+                self.predict_time += end_time - start_time
+                self.batch_sizes[num_rows] += 1
+                self.latencies.extend(end_time - submit_time for _, _, submit_time in batch)
+
+    def metrics(self):
+        """
+        Returns the metrics of the batcher: the queue depth, a histogram of the batch sizes (in
+        powers of two, e.g. '9-16': 3 batches of 9 to 16 positions) and the median and 99th
+        percentile latency (from submit() to the result) of the latest requests, in milliseconds.
+        """
+        with self._metrics_lock:
+            histogram = collections.Counter()
+            for batch_size, count in self.batch_sizes.items():
+                upper = 1 << max(batch_size - 1, 0).bit_length()
+                histogram[f'{upper // 2 + 1}-{upper}' if upper > 2 else str(upper)] += count
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'queue_depth': self.queue_depth(),
+                'requests': self.num_requests,
+                'positions': self.num_positions,
+                'batches': self.num_batches,
+                'avg_batch_size': self.num_positions / self.num_batches if self.num_batches else 0.,
+                'batch_sizes': dict(sorted(histogram.items(), key=lambda item: int(item[0].split('-')[-1]))),
+                'p50_latency_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_latency_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'predict_time': self.predict_time,
+            }
+
+
+class _InferenceServerMixin:
+    """
+    The request handling that the Unix and TCP servers share. Every connection is answered on its
+    own thread, and the threads meet in the batchers.
+    """
+    daemon_threads = True
+
+    def handle_request_json(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'predict':
+            batcher = self.get_batcher(request['model'])
+            x = np.frombuffer(base64.b64decode(request['x']), dtype=np.float32).reshape(request['rows'], ENCODING_SIZE)
+            return {'values': batcher.predict(x).tolist()}
+        if cmd == 'models':
+            return {'models': sorted(self.batchers)}
+        if cmd == 'metrics':
+            return {name: batcher.metrics() for name, batcher in self.batchers.items()}
+        if cmd == 'ping':
+            return {'ok': True}
+        if cmd == 'shutdown':
+            # shutdown() waits for serve_forever() to return, so it can not be called from its thread
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {'ok': True, 'shutdown': True}
+        raise ValueError(f'Unknown command {cmd}')
+
+    def get_batcher(self, model):
+        if model in self.batchers:
+            return self.batchers[model]
+        path = os.path.realpath(model)
+        for name, model_path in self.model_paths.items():
+            if os.path.realpath(model_path) == path:
+                return self.batchers[name]
+        raise ValueError(f'Unknown model {model}')
+
+
+class UnixInferenceServer(_InferenceServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, socket_path, batchers, model_paths):
+        self.batchers = batchers
+        self.model_paths = model_paths
+        super().__init__(socket_path, EngineRequestHandler)
+
+
+class TCPInferenceServer(_InferenceServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, host, port, batchers, model_paths):
+        self.batchers = batchers
+        self.model_paths = model_paths
+        super().__init__((host, port), EngineRequestHandler)
+
+
+def load_batchers(model_paths, max_batch_size=256, max_wait_ms=2.):
+    """
+    Loads and warms up every model, and gives each of them a DynamicBatcher.
+    """
+    from eval.numpy_model import load_model
+
+    batchers = {}
+    for name, path in model_paths.items():
+        model = load_model(path)
+        # The first prediction traces the model, so do it now instead of on the first request
+        model.predict_on_batch(np.zeros((1, ENCODING_SIZE), dtype=np.float32))
+        batchers[name] = DynamicBatcher(model, max_batch_size, max_wait_ms)
+    return batchers
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1', models_dir=MODELS_DIR, max_batch_size=256,
+          max_wait_ms=2.):
+    """
+    Loads the models and answers requests until a shutdown request comes in.
+
+    Arguments:
+        socket_path (str): The Unix socket to listen on (when port is None)
+        port (int): The TCP port to listen on instead of a Unix socket
+        host (str): The address the TCP port is opened on
+        models_dir (str): The folder whose */saved_models/ models are served
+        max_batch_size (int): The most positions in one batch
+        max_wait_ms (float): The longest the first request of a batch waits for more requests
+    """
+    model_paths = find_models(models_dir)
+    if not model_paths:
+        exit(f'Error - There are no models in {models_dir}/*/saved_models')
+
+    start_time = time.time()
+    batchers = load_batchers(model_paths, max_batch_size, max_wait_ms)
+    print(f'Loaded {", ".join(batchers)} in {time.time() - start_time:.1f}s', flush=True)
+
+    if port is not None:
+        server = TCPInferenceServer(host, port, batchers, model_paths)
+        print(f'Listening on {host}:{port}', flush=True)
+    else:
+        # A socket file left behind by a server that died is removed, a live server is not touched
+        if os.path.exists(socket_path):
+            if ping(socket_path=socket_path):
+                exit(f'Error - A server is already listening on {socket_path}')
+            os.remove(socket_path)
+        server = UnixInferenceServer(socket_path, batchers, model_paths)
+        print(f'Listening on {socket_path}', flush=True)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for batcher in batchers.values():
+            batcher.close()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class RemoteModel:
+    """
+    A model that lives in the inference server. It keeps one connection open, and can be shared by
+    the threads of a process (their requests take turns on the connection).
+
+    Arguments:
+        model (str): The name of the model ('keon/model_example') or the path of its file
+        socket_path (str): The Unix socket of the server
+        port (int): The TCP port of the server, instead of a Unix socket
+        host (str): The address of the server's TCP port
+    """
+    def __init__(self, model, socket_path=DEFAULT_SOCKET_PATH, port=None, host='127.0.0.1'):
+        # Paths are sent as absolute paths, since the server runs in another folder
+        self.model = os.path.abspath(model) if os.path.exists(model) else model
+        self._sock = _connect(socket_path, port, host)
+        self._file = self._sock.makefile('rwb')
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, x):
+        """
+        Evaluates a batch of encodings.
+
+        Output:
+            np.ndarray: The (n, 1) evaluations, like a Keras model's
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        request = {'cmd': 'predict', 'model': self.model, 'rows': len(x), 'x': base64.b64encode(x.tobytes()).decode('ascii')}
+        with self._lock:
+            self._file.write((json.dumps(request) + '\n').encode('utf-8'))
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('The inference server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return np.array(response['values'], dtype=np.float32).reshape(-1, 1)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the saved models and batches the requests of all of their users.')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH, help='Unix socket to listen on')
+    parser.add_argument('--port', type=int, default=None, help='TCP port to listen on instead of a Unix socket')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--models-dir', type=str, default=MODELS_DIR)
+    parser.add_argument('--max-batch', type=int, default=256, help='Most positions in one batch')
+    parser.add_argument('--max-wait-ms', type=float, default=2., help='Longest a request waits for a batch to fill')
+    parser.add_argument('--metrics', action='store_true', help='Print the metrics of a running server and exit')
+
+    args = parser.parse_args()
+
+    if args.metrics:
+        print(json.dumps(send_request({'cmd': 'metrics'}, args.socket, args.port, args.host), indent=4))
+    else:
+        serve(args.socket, args.port, args.host, args.models_dir, args.max_batch, args.max_wait_ms)
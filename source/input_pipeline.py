@@ -0,0 +1,176 @@
+"""
+This script implements the tf.data input pipeline of our training. Instead of building every batch
+in Python and handing it to model.fit(), the training data is a tf.data.Dataset that TensorFlow
+reads, decodes, shuffles and batches on its own threads while the model trains, so the model never
+has to wait for its next batch.
+
+There are two sources of data:
+    -> A folder of binary shards (see dataset_shards.py). The shards are read with
+        tf.data.FixedLengthRecordDataset, several of them at a time, and the records are decoded
+        with TensorFlow ops, so no Python runs per batch at all.
+    -> A file of games, with one game per line. Random games are read through the byte-offset index
+        of data_handler.GameFileReader and encoded with data_handler.games_to_arrays() in parallel.
+
+The iterators of both datasets can be saved in a tf.train.Checkpoint, so a training run that is
+resumed continues with the batches it would have seen next.
+
+Either way, the dataset yields (features, evals) batches of shape (batch_size, 776) and
+(batch_size, 1), with the evals clipped and scaled to [-1, 1] like data_handler.scale_evals().
+"""
+
+# Python imports
+import json
+import os
+
+import tensorflow as tf
+
+# Local Imports
+from board import ENCODING_SIZE
+from data_handler import GameFileReader, games_to_arrays
+from dataset_shards import HEADER_SIZE, INDEX_FILENAME, read_shard_header, record_dtype
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# How many shards are read at the same time
+SHARD_CYCLE_LENGTH = 8
+
+# How many games are encoded by one call of games_to_arrays()
+GAMES_PER_DECODE = 16
+
+# Bit masks of the flags byte of a shard record, in the order of the encoding (turn, K, Q, k, q)
+_FLAG_BITS = [1, 2, 4, 8, 16]
+
+
+def _scale_evals(evals):
+    # The same clipping and scaling as data_handler.scale_evals()
+    return tf.clip_by_value(evals, -15., 15.) / 15.
+
+
+def decode_shard_records(records, eval_dtype='float16'):
+    """
+    Decodes a batch of raw shard records (see dataset_shards.record_dtype()) with TensorFlow ops.
+
+    Arguments:
+        records (tf.Tensor): A string tensor of shape (batch_size,) with one record per string
+        eval_dtype (str): The type the evaluations were stored as
+
+    Output:
+        (tf.Tensor, tf.Tensor): The float32 (batch_size, 776) encodings and (batch_size, 1) evals
+    """
+    eval_tf_dtype = tf.float16 if eval_dtype == 'float16' else tf.float32
+    eval_size = 2 if eval_dtype == 'float16' else 4
+    raw = tf.io.decode_raw(records, tf.uint8)
+
+    # The pieces were packed with np.packbits, so the first bit of each byte is its highest bit
+    pieces = tf.cast(raw[:, :96], tf.int32)
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.int32)
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(pieces[:, :, None], shifts), 1)
+    bits = tf.reshape(bits, [-1, 768])
+
+    flags = tf.cast(raw[:, 96:97], tf.int32)
+    flag_values = tf.cast(tf.bitwise.bitwise_and(flags, tf.constant(_FLAG_BITS, dtype=tf.int32)) > 0, tf.int32)
+    ep_square = tf.cast(raw[:, 97:98], tf.int32)
+    counters = tf.cast(raw[:, 98:102], tf.int32)
+    halfmove_clock = counters[:, 0:1] + 256 * counters[:, 1:2]
+    fullmove_number = counters[:, 2:3] + 256 * counters[:, 3:4]
+
+    x = tf.cast(tf.concat([bits, flag_values, ep_square, halfmove_clock, fullmove_number], axis=1), tf.float32)
+    evals = tf.io.decode_raw(tf.strings.substr(records, 102, eval_size), eval_tf_dtype)
+    y = _scale_evals(tf.cast(evals, tf.float32))
+    return x, y
+
+
+def shard_dataset(directory, batch_size=64, shuffle_buffer=100_000, seed=None, repeat=True):
+    """
+    Builds a dataset of (features, evals) batches from a folder of binary shards.
+
+    Arguments:
+        directory (str): The dataset folder written by dataset_shards.convert_games()
+        batch_size (int): How many positions are in a batch
+        shuffle_buffer (int): How many positions are shuffled together. The order of the shards is
+            shuffled too, and SHARD_CYCLE_LENGTH shards are read at the same time.
+        seed (int): Optional seed of the shuffles. With a seed, the order of the batches is the same
+            on every run (at the cost of some parallelism).
+        repeat (bool): If the dataset goes over the shards forever (in a new order every time)
+    """
+    with open(os.path.join(directory, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+
+    eval_dtype = index['eval_dtype']
+    record_size = record_dtype(eval_dtype).itemsize
+    filepaths, footer_sizes = [], []
+    for shard in index['shards']:
+        filepath = os.path.join(directory, shard['file'])
+        filepaths.append(filepath)
+        footer_sizes.append(8 * read_shard_header(filepath)['games'])
+
+    files = tf.data.Dataset.from_tensor_slices((filepaths, tf.constant(footer_sizes, dtype=tf.int64)))
+    files = files.shuffle(len(filepaths), seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        files = files.repeat()
+
+    records = files.interleave(
+        lambda filepath, footer_size: tf.data.FixedLengthRecordDataset(
+            filepath, record_size, header_bytes=HEADER_SIZE, footer_bytes=footer_size, buffer_size=1 << 20),
+        cycle_length=min(SHARD_CYCLE_LENGTH, len(filepaths)),
+        num_parallel_calls=AUTOTUNE,
+        deterministic=seed is not None,
+    )
+
+    return (records
+            .shuffle(shuffle_buffer, seed=seed)
+            .batch(batch_size, drop_remainder=True)
+            .map(lambda batch: decode_shard_records(batch, eval_dtype), num_parallel_calls=AUTOTUNE)
+            .prefetch(AUTOTUNE))
+
+
+def games_file_dataset(filepath, batch_size=64, shuffle_buffer=20_000, seed=None):
+    """
+    Builds a never-ending dataset of (features, evals) batches from a file of games, by encoding
+    random games (picked through the file's byte-offset index) on several threads.
+
+    Arguments:
+        filepath (str): The file of games, with one game per line (not compressed)
+        batch_size (int): How many positions are in a batch
+        shuffle_buffer (int): How many positions are shuffled together, so that the positions of one
+            game are spread over many batches
+        seed (int): Optional seed of the random games and of the shuffle. With a seed, the order of
+            the batches is the same on every run (at the cost of some parallelism).
+    """
+    # The reader stays open as long as the dataset reads from it, and closes its file when the
+    # dataset is garbage collected
+    game_reader = GameFileReader(filepath)
+    num_games = len(game_reader)
+
+    def encode_games(game_indices):
+        return games_to_arrays(game_reader.get_games(game_indices))
+
+    def encode_batch(game_indices):
+        x, y = tf.numpy_function(encode_games, [game_indices], [tf.float32, tf.float32])
+        x.set_shape([None, ENCODING_SIZE])
+        y.set_shape([None])
+        return x, _scale_evals(y)[:, None]
+
+    # The random game numbers come from tf.data itself, so the position in the stream can be saved
+    # in a checkpoint (encode_games() has no state of its own to save)
+    game_indices = tf.data.Dataset.random(seed=seed).map(lambda value: value % num_games)
+    dataset = (game_indices
+               .batch(GAMES_PER_DECODE)
+               .map(encode_batch, num_parallel_calls=AUTOTUNE, deterministic=seed is not None)
+               .unbatch()
+               .shuffle(shuffle_buffer, seed=seed)
+               .batch(batch_size, drop_remainder=True)
+               .prefetch(AUTOTUNE))
+
+    options = tf.data.Options()
+    options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+    return dataset.with_options(options)
+
+
+def make_training_dataset(path, batch_size=64, seed=None):
+    """
+    Builds the training dataset of a folder of shards or a file of games (see the functions above).
+    """
+    if os.path.isdir(path):
+        return shard_dataset(path, batch_size=batch_size, seed=seed)
+    return games_file_dataset(path, batch_size=batch_size, seed=seed)
@@ -13,14 +13,15 @@ import os
 import argparse
 import time
 
-import tensorflow as tf
 import numpy as np
 
 # Local Imports
 from board import ChessBoard
 from eval.eval_board import evaluate_board
+from eval.numpy_model import load_model
+from eval.transposition_table import TranspositionTable
 
-def play_game(board, model1, model2, print_board):
+def play_game(board, model1, model2, print_board, tt_size_mb=16, time_budget_ms=None):
     """
     The main driver function that simulates games and prints them to Standard Output.
 
@@ -29,10 +30,16 @@ def play_game(board, model1, model2, print_board):
         model1 (tf.keras.Model): A Model instance that will play as White
         model2 (tf.keras.Model): A Model instance that will play as Black
         print_board (bool): If we want to print the board to Standard Output
+        tt_size_mb (float): The memory budget (in MB) of each player's transposition table
+        time_budget_ms (float): Optional time budget of every move in milliseconds (otherwise the 
+            search goes to a fixed depth)
 
     """
     turn = 'W'
 
+    # Each player keeps its own transposition table for the whole game
+    tts = {'W': TranspositionTable(tt_size_mb), 'B': TranspositionTable(tt_size_mb)}
+
     # Keep track of move list
     move_list = []
 
@@ -46,9 +53,11 @@ def play_game(board, model1, model2, print_board):
         model_to_move = model1 if turn == 'W' else model2
 
         start_time = time.time()
-        best_move_prediction, new_eval = evaluate_board(board, model_to_move, turn, False)
+        best_move_prediction, new_eval = evaluate_board(board, model_to_move, turn, False, tt=tts[turn], time_budget_ms=time_budget_ms)
         end_time = time.time()
         print(f'Move time: {end_time - start_time}')
+        if print_board:
+            print(f'Transposition table: {tts[turn].stats()}')
 
         move_list.append(str(best_move_prediction))
 
@@ -68,16 +77,26 @@ def play_game(board, model1, model2, print_board):
 
     return winning_color, move_list
 
-def main(model1_path, model2_path, starting_fen=None, print_board=False):
-    model1 = tf.keras.models.load_model(model1_path)
-    model2 = tf.keras.models.load_model(model2_path) 
+def main(model1_path, model2_path, starting_fen=None, print_board=False, time_budget_ms=None, inference_socket=None,
+         quantization=None):
+    if inference_socket is not None:
+        # The models are evaluated by the inference server (see inference_server.py), which batches
+        # them with the requests of every other game it is serving
+        from inference_server import RemoteModel
+        model1 = RemoteModel(model1_path, socket_path=inference_socket)
+        model2 = RemoteModel(model2_path, socket_path=inference_socket)
+    else:
+        # An exported .npz (see eval/numpy_model.py) is run without TensorFlow, and quantization picks
+        # the quantized versions of the models (see eval/quantize.py)
+        model1 = load_model(model1_path, quantization)
+        model2 = load_model(model2_path, quantization)
 
     board = ChessBoard()
 
     if starting_fen:
         board.set_fen(starting_fen)
     
-    play_game(board, model1, model2, print_board)
+    play_game(board, model1, model2, print_board, time_budget_ms=time_budget_ms)
 
 if __name__ == '__main__':
     # For hard coding model paths for testing
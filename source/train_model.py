@@ -15,7 +15,6 @@ import sys
 import os
 import importlib
 import argparse
-import linecache
 from datetime import datetime
 
 logging.basicConfig()
@@ -30,10 +29,10 @@ import keras
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 
-from data_handler import game_to_data
+from input_pipeline import make_training_dataset
+from trainer import Trainer
 
 # # Checks to see if running on GPU
 # tf.debugging.set_log_device_placement(True)
@@ -124,102 +123,72 @@ def save_model(model, model_dir, user):
     path_to_save = os.path.join(user_dir, 'saved_models')
     dirs_in_path = os.listdir(user_dir)
     if 'saved_models' not in dirs_in_path:
-        os.makedirs(path_to_save)
-
-    name_of_model = 'model' + str(len(os.listdir(path_to_save))) + '.h5'
-
-    model.save(os.path.join(path_to_save, name_of_model))
-
-def train_model(training_csv, user):
+        os.makedirs(path_to_save, exist_ok=True)
+
+    # The name is unique to this run (two runs can share a user folder), and the model is written
+    # under a temporary name first so that a crash never leaves half a model behind
+    name_of_model = 'model_' + datetime.now().strftime("%Y%m%d-%H%M%S") + f'_{os.getpid()}.h5'
+    tmp_path = os.path.join(path_to_save, '.tmp_' + name_of_model)
+    model.save(tmp_path)
+    os.replace(tmp_path, os.path.join(path_to_save, name_of_model))
+    return os.path.join(path_to_save, name_of_model)
+
+def train_model(training_csv, user, total_steps=10000, accumulation_steps=1, eval_path=None, resume=False, seed=0,
+                checkpoint_dir=None):
     """
     This is the big function that will train our neural network. 
 
     Argument:
         training_csv (filepath): The location of where our trainng fata is that we preprocessed
-            in our data_handler.py file.
+            in our data_handler.py file, or a folder of shards made by dataset_shards.py.
         user (str): your name - make sure a folder with your name exists in the models/ directory. For example, if
             you pass in 'keon' as the user parameter, then make sure a keon/ folder exists in models/.
+        total_steps (int): How many optimizer steps to train for
+        accumulation_steps (int): How many batches are added up into every optimizer step
+        eval_path (filepath): Optional games file or shard folder that the model is evaluated on
+            every EVAL_EVERY steps
+        resume (bool): If training continues from the latest checkpoint in checkpoint_dir (which
+            needs the same training data and seed as the run that saved it)
+        seed (int): The seed of the order the training data is read in
+        checkpoint_dir (str): Where the checkpoints of this run are kept. Defaults to a folder of
+            its own, models/<user>/checkpoints/<date>-<time>_<pid>/, so that two runs of the same
+            user never write to (or resume from) each other's checkpoints. Resuming needs the folder
+            of the run to continue.
     """
     # HYPERPARAMETERS
-    NUM_BATCHES_TO_TRAIN = 100
-    NUM_GAMES_PER_BATCH = 10
+    BATCH_SIZE = 64
+    LOG_EVERY = 100
+    EVAL_EVERY = 1000
+    EVAL_STEPS = 50
+    CHECKPOINT_EVERY = 1000
+    MAX_CHECKPOINTS = 3
     MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
-    
-    # Create log dir and callback
-    LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models', user, 'logs/') + datetime.now().strftime("%Y%m%d-%H%M%S")
-    tensorboard_callback = keras.callbacks.TensorBoard(log_dir=LOG_DIR)
-    
 
-    with open(training_csv, 'r') as f:
-        total_number_of_games = sum(1 for _ in f)
+    if resume and checkpoint_dir is None:
+        raise ValueError('Resuming needs the checkpoint_dir of the run to continue')
+
+    # Create log dir. The logs and checkpoints of every run go in their own folders, since two runs
+    # can share a user folder
+    RUN_NAME = datetime.now().strftime("%Y%m%d-%H%M%S") + f'_{os.getpid()}'
+    LOG_DIR = os.path.join(MODEL_DIR, user, 'logs', RUN_NAME)
+    CHECKPOINT_DIR = checkpoint_dir or os.path.join(MODEL_DIR, user, 'checkpoints', RUN_NAME)
+
+    # The batches are streamed from a folder of binary shards (see dataset_shards.py) or a games
+    # file, and prepared by tf.data while the model trains (see input_pipeline.py)
+    root.info('Building the input pipeline...')
+    dataset = make_training_dataset(training_csv, batch_size=BATCH_SIZE, seed=seed)
+    eval_dataset = make_training_dataset(eval_path, batch_size=BATCH_SIZE, seed=0) if eval_path else None
 
     # Retrieve model
     root.info('Retrieving model...')
     model = get_model(user)
 
-    with tqdm(range(NUM_BATCHES_TO_TRAIN), unit='batch') as progress_bar:
-        progress_bar.set_description('Training the Model')
-        for game_ind in progress_bar:
-            this_batch_x, this_batch_y = None, None
-
-            for _ in range(NUM_GAMES_PER_BATCH):
-                # Random select game index 
-                chosen_game_index = np.random.randint(0, total_number_of_games)
-
-                # Pull the game at the specified random index 
-                chosen_game = linecache.getline(training_csv, chosen_game_index, module_globals=None)
-
-                # Get all of the data from this game
-                this_game_x, this_game_y = game_to_data(chosen_game)
-
-                if this_batch_x is None or this_batch_y is None:
-                    this_batch_x = this_game_x
-                    this_batch_y = this_game_y
-
-                # Append this game's information to our batches TODO
-                this_batch_x = pd.concat([this_batch_x, this_game_x], ignore_index=True)
-                this_batch_y = pd.concat([this_batch_y, this_game_y], ignore_index=True)
-
-            if game_ind == 0:
-                print(this_batch_x)
-                print('----\n')
-                print(this_batch_y)
-                print(f'y min and max: {this_batch_y.min()} $ {this_batch_y.max()}')
-
-            # Train Model
-            try:
-                if game_ind % 50 == 0:
-                    hist = model.fit(
-                        x=this_batch_x, 
-                        y=this_batch_y,
-                        epochs=100,
-                        batch_size=64,
-                        verbose=1,
-                        callbacks=[tensorboard_callback]
-                    )
-                else:
-                    hist = model.fit(
-                        x=this_batch_x, 
-                        y=this_batch_y,
-                        epochs=5,
-                        batch_size=64,
-                        verbose=0
-                    )
-
-
-            except:
-                root.error(f'Error with the following data')
-                print(f'Game number: {chosen_game_index}')
-                print(f'game line: {chosen_game}')
-                print(this_game_x)
-                print(this_game_y)
-                exit()
-
-            # Get loss and log it
-            if game_ind == 0:
-                print(hist.history['loss'])
-            loss = hist.history['loss'][-1]
-            progress_bar.set_postfix(loss=loss)
+    # One training session over the stream of batches (see trainer.py)
+    trainer = Trainer(model, accumulation_steps=accumulation_steps, log_dir=LOG_DIR)
+    history = trainer.fit(dataset, total_steps, eval_dataset=eval_dataset, eval_every=EVAL_EVERY,
+                          eval_steps=EVAL_STEPS, log_every=LOG_EVERY, checkpoint_dir=CHECKPOINT_DIR,
+                          checkpoint_every=CHECKPOINT_EVERY, max_checkpoints=MAX_CHECKPOINTS, resume=resume)
+    root.info(f'Finished training: {history}')
 
     SAVE_MODEL = True
     if SAVE_MODEL:
@@ -229,10 +198,21 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('csv_location', type=str)
     parser.add_argument('model_dir', type=str)
+    parser.add_argument('--steps', type=int, default=10000, help='Number of optimizer steps to train for')
+    parser.add_argument('--accumulation-steps', type=int, default=1, help='Number of batches per optimizer step')
+    parser.add_argument('--eval-data', type=str, default=None, help='Games file or shard folder to evaluate on')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the latest checkpoint in --checkpoint-dir (which is then required)')
+    parser.add_argument('--checkpoint-dir', type=str, default=None,
+                        help='Where checkpoints are kept (default: a new folder in models/<user>/checkpoints/ for this run)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the order the training data is read in')
 
     args = parser.parse_args()
 
-    if not args.csv_location or (not os.path.isfile(args.csv_location)):
+    if args.resume and args.checkpoint_dir is None:
+        parser.error('--resume needs the --checkpoint-dir of the run to continue')
+
+    if not args.csv_location or (not os.path.isfile(args.csv_location) and not os.path.isdir(args.csv_location)):
         print('ERROR - Did not provide a correct location to the training .csv file.')
         exit(-1)
 
@@ -240,4 +220,6 @@ if __name__ == '__main__':
         print('ERROR - Did not provide a correct location to the model directory.')
         exit(-1)
 
-    train_model(args.csv_location, args.model_dir)
+    train_model(args.csv_location, args.model_dir, total_steps=args.steps, accumulation_steps=args.accumulation_steps,
+                eval_path=args.eval_data, resume=args.resume, seed=args.seed,
+                checkpoint_dir=args.checkpoint_dir)
@@ -0,0 +1,193 @@
+"""
+This script implements our training loop. Calling model.fit() over and over builds new Keras
+iterators, callbacks and traced functions every time, so instead the Trainer traces one train step
+with tf.function and runs it for as many steps as we want over a never-ending dataset (see
+input_pipeline.py).
+
+The Trainer supports:
+    -> Gradient accumulation: the gradients of several batches are added up before the optimizer
+        is applied, to train with bigger batches than fit in memory
+    -> Periodic evaluation on a separate dataset
+    -> Logging the loss and the throughput (samples per second) to the progress bar and TensorBoard
+    -> Checkpoints of the model, the optimizer, the step counter and the position in the dataset
+        (including its shuffle buffers and random state), so a run that stopped can be resumed
+        exactly where it was
+"""
+
+# Python imports
+import time
+
+import tensorflow as tf
+import keras
+from tqdm import tqdm
+
+
+class Trainer:
+    """
+    Trains a compiled Keras model with a custom training loop.
+
+    Arguments:
+        model (keras.Model): The model. Its optimizer is used, and its loss if it has one (otherwise
+            the mean squared error).
+        accumulation_steps (int): How many batches the gradients are added up over before every
+            optimizer step
+        log_dir (str): Optional folder that the TensorBoard summaries are written to
+    """
+    def __init__(self, model, accumulation_steps=1, log_dir=None):
+        if accumulation_steps < 1:
+            raise ValueError(f'accumulation_steps must be at least 1, got {accumulation_steps}')
+
+        self.model = model
+        self.optimizer = model.optimizer
+        self.loss_fn = keras.losses.get(model.loss) if getattr(model, 'loss', None) else keras.losses.MeanSquaredError()
+        self.accumulation_steps = accumulation_steps
+        self.summary_writer = tf.summary.create_file_writer(log_dir) if log_dir else None
+
+        # The number of optimizer steps taken so far
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False, name='step')
+
+        # Build the optimizer's variables before the train step is traced
+        self.optimizer.build(model.trainable_variables)
+        self._accumulated = [tf.Variable(tf.zeros_like(var), trainable=False) for var in model.trainable_variables]
+
+    @tf.function
+    def _train_step(self, x, y):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(self.loss_fn(y, self.model(x, training=True)))
+        grads = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+        return loss
+
+    @tf.function
+    def _accumulate_step(self, x, y):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(self.loss_fn(y, self.model(x, training=True)))
+        grads = tape.gradient(loss, self.model.trainable_variables)
+        for accumulated, grad in zip(self._accumulated, grads):
+            accumulated.assign_add(grad / self.accumulation_steps)
+        return loss
+
+    @tf.function
+    def _apply_accumulated(self):
+        self.optimizer.apply_gradients(zip([tf.identity(var) for var in self._accumulated], self.model.trainable_variables))
+        for accumulated in self._accumulated:
+            accumulated.assign(tf.zeros_like(accumulated))
+
+    @tf.function
+    def _eval_step(self, x, y):
+        return tf.reduce_mean(self.loss_fn(y, self.model(x, training=False)))
+
+    def train_step(self, batches):
+        """
+        Takes one optimizer step on the next accumulation_steps batches of an iterator.
+
+        Output:
+            (tf.Tensor, int): The mean loss of the batches, and how many samples they had. The loss is
+                left as a tensor so that the loop does not wait for the step to finish.
+        """
+        total_loss, num_samples = 0., 0
+        if self.accumulation_steps == 1:
+            x, y = next(batches)
+            total_loss = self._train_step(x, y)
+            num_samples = int(x.shape[0])
+        else:
+            for _ in range(self.accumulation_steps):
+                x, y = next(batches)
+                total_loss += self._accumulate_step(x, y)
+                num_samples += int(x.shape[0])
+            self._apply_accumulated()
+            total_loss /= self.accumulation_steps
+
+        self.step.assign_add(1)
+        return total_loss, num_samples
+
+    def evaluate(self, dataset, num_steps):
+        """
+        Returns the mean loss of the model over num_steps batches of a dataset.
+        """
+        losses = [float(self._eval_step(x, y)) for x, y in dataset.take(num_steps)]
+        return sum(losses) / len(losses) if losses else float('nan')
+
+    def fit(self, dataset, total_steps, eval_dataset=None, eval_every=1000, eval_steps=50, log_every=100,
+            checkpoint_dir=None, checkpoint_every=1000, max_checkpoints=3, resume=False):
+        """
+        Trains until total_steps optimizer steps were taken (counting the steps of earlier calls).
+
+        Arguments:
+            dataset (tf.data.Dataset): The never-ending dataset of (features, evals) batches
+            total_steps (int): How many optimizer steps to train for in total
+            eval_dataset (tf.data.Dataset): Optional dataset the model is evaluated on
+            eval_every (int): How many steps there are between evaluations
+            eval_steps (int): How many batches of eval_dataset an evaluation uses
+            log_every (int): How many steps there are between updates of the logs
+            checkpoint_dir (str): Optional folder that checkpoints are saved to
+            checkpoint_every (int): How many steps there are between checkpoints
+            max_checkpoints (int): How many of the latest checkpoints are kept
+            resume (bool): If training continues from the latest checkpoint in checkpoint_dir
+
+        Output:
+            dict: The last training loss, evaluation loss and samples per second
+        """
+        batches = iter(dataset)
+        manager = self._checkpoint_manager(batches, checkpoint_dir, max_checkpoints, resume)
+        history = {'loss': None, 'eval_loss': None, 'samples_per_s': None}
+
+        window_loss, window_steps, window_samples = 0., 0, 0
+        window_start = time.time()
+        with tqdm(total=total_steps, initial=int(self.step.numpy()), unit='step') as progress_bar:
+            progress_bar.set_description('Training the Model')
+            while int(self.step.numpy()) < total_steps:
+                loss, num_samples = self.train_step(batches)
+                step = int(self.step.numpy())
+                window_loss += loss
+                window_steps += 1
+                window_samples += num_samples
+                progress_bar.update(1)
+
+                if step % log_every == 0 or step == total_steps:
+                    history['loss'] = float(window_loss) / window_steps
+                    history['samples_per_s'] = window_samples / max(time.time() - window_start, 1e-9)
+                    progress_bar.set_postfix(loss=history['loss'], samples_per_s=f'{history["samples_per_s"]:.0f}')
+                    self._write_summaries(step, loss=history['loss'], samples_per_s=history['samples_per_s'])
+                    window_loss, window_steps, window_samples = 0., 0, 0
+                    window_start = time.time()
+
+                if eval_dataset is not None and (step % eval_every == 0 or step == total_steps):
+                    # The evaluation time does not count against the training throughput
+                    eval_start = time.time()
+                    history['eval_loss'] = self.evaluate(eval_dataset, eval_steps)
+                    window_start += time.time() - eval_start
+                    progress_bar.write(f'Step {step}: eval loss {history["eval_loss"]:.5f}')
+                    self._write_summaries(step, eval_loss=history['eval_loss'])
+
+                if manager is not None and (step % checkpoint_every == 0 or step == total_steps):
+                    manager.save(checkpoint_number=step)
+
+        return history
+
+    def _checkpoint_manager(self, batches, checkpoint_dir, max_checkpoints, resume):
+        """
+        Returns the manager of the checkpoints of this run, after restoring the latest checkpoint
+        if the run is resumed. The checkpoint files are written under temporary names and then
+        renamed, so a run that is killed while saving never leaves a broken latest checkpoint.
+        """
+        if checkpoint_dir is None:
+            if resume:
+                raise ValueError('Can not resume training without a checkpoint_dir')
+            return None
+
+        checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer, step=self.step, data=batches)
+        manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=max_checkpoints)
+        if resume:
+            if manager.latest_checkpoint is None:
+                raise FileNotFoundError(f'There is no checkpoint to resume from in {checkpoint_dir}')
+            checkpoint.restore(manager.latest_checkpoint).assert_existing_objects_matched()
+            print(f'Resumed from {manager.latest_checkpoint} at step {int(self.step.numpy())}')
+        return manager
+
+    def _write_summaries(self, step, **values):
+        if self.summary_writer is None:
+            return
+        with self.summary_writer.as_default():
+            for name, value in values.items():
+                tf.summary.scalar(name, value, step=step)
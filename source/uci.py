@@ -0,0 +1,332 @@
+"""
+This script speaks the UCI protocol (the one chess GUIs, cutechess-cli and lichess-bot use to talk
+to engines) on standard input and output, so our engine can be run under standard tooling:
+    python uci.py [--model <path>] [--no-model] [--quantization int8]
+A model exported to a .npz (see eval/numpy_model.py) is run without TensorFlow.
+
+Supported commands:
+    -> uci, isready, ucinewgame, quit
+    -> setoption name Hash value <MB>
+    -> setoption name Threads value <n> (the number of processes of the search, see eval/lazy_smp.py)
+    -> position [startpos | fen <fen>] [moves <move1> ...]
+    -> go [wtime <ms>] [btime <ms>] [winc <ms>] [binc <ms>] [movestogo <n>] [movetime <ms>]
+          [depth <n>] [nodes <n>] [infinite] [ponder]
+    -> stop, ponderhit
+
+The search runs on its own thread, so "stop" and "isready" are answered while it runs. After
+every finished iteration it prints an "info depth ... nodes ... nps ... score ... pv ..." line,
+and it ends with "bestmove <move>".
+
+"go ponder" searches the move the GUI expects the opponent to play, without a time limit, until the
+GUI sends "ponderhit" (the opponent played it, so the time control of the go command starts now)
+or "stop" (the opponent played something else). The best move is only sent after one of them.
+"""
+
+# Python Imports
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+# Set tf logs
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+# Local imports
+from board import ChessBoard
+from eval.alpha_beta import MAX_SEARCH_DEPTH, principal_variation
+from eval.eval_board import evaluate_board
+from eval.lazy_smp import LazySMP
+from eval.numpy_model import load_model
+from eval.transposition_table import TranspositionTable
+
+ENGINE_NAME = 'AI_ChessEngine'
+ENGINE_AUTHOR = 'Keon Roohparvar'
+
+# Dynamically get path to our trained neural network
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'models',
+                            'keon',
+                            'saved_models',
+                            'model_example.h5')
+
+DEFAULT_HASH_MB = 64
+
+MAX_THREADS = 256
+
+# Time we keep back from every move for the GUI and the communication, in milliseconds
+MOVE_OVERHEAD_MS = 50
+
+# Number of moves we plan for when the time control does not say how many are left
+DEFAULT_MOVES_TO_GO = 30
+
+
+def allocate_time_ms(turn, params):
+    """
+    Decides how long to search from the time control of a "go" command.
+
+    Arguments:
+        turn (str): 'W' or 'B', the side to move
+        params (dict): The parameters of the "go" command
+
+    Output:
+        float or None: The time budget in milliseconds, or None if the search has no time limit
+    """
+    if 'movetime' in params:
+        return max(1., params['movetime'] - MOVE_OVERHEAD_MS)
+
+    time_left = params.get('wtime' if turn == 'W' else 'btime')
+    if time_left is None:
+        return None
+    increment = params.get('winc' if turn == 'W' else 'binc', 0)
+    moves_to_go = params.get('movestogo', DEFAULT_MOVES_TO_GO)
+
+    budget = time_left / max(moves_to_go, 1) + 0.8 * increment
+    return max(1., min(budget, time_left / 2) - MOVE_OVERHEAD_MS)
+
+
+def format_score(value, depth_reached, turn):
+    """
+    Formats a search value (in pawns, from White's point of view) as a UCI score, which is in
+    centipawns from the point of view of the side to move.
+    """
+    sign = 1 if turn == 'W' else -1
+    if np.isinf(value):
+        moves_to_mate = (depth_reached + 1) // 2
+        return f'mate {moves_to_mate if value * sign > 0 else -moves_to_mate}'
+    return f'cp {int(round(100 * sign * value))}'
+
+
+def parse_go(tokens):
+    """
+    Reads the parameters of a "go" command into a dict, e.g. {'wtime': 60000, 'infinite': True}.
+    """
+    params = {}
+    idx = 0
+    while idx < len(tokens):
+        token = tokens[idx]
+        if token in ('infinite', 'ponder'):
+            params[token] = True
+            idx += 1
+        elif token in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'depth', 'nodes') and idx + 1 < len(tokens):
+            params[token] = int(tokens[idx + 1])
+            idx += 2
+        else:
+            idx += 1
+    return params
+
+
+class UCIEngine:
+    """
+    The state of the engine between UCI commands.
+
+    Arguments:
+        model: The model that breaks ties between the best moves, or None to play without one
+        output: Where the responses are written (standard output by default)
+    """
+    def __init__(self, model=None, output=sys.stdout):
+        self.model = model
+        self.output = output
+        self.board = ChessBoard()
+        self.hash_mb = DEFAULT_HASH_MB
+        self.tt = TranspositionTable(DEFAULT_HASH_MB)
+        # The Lazy SMP search, with "setoption name Threads" above 1
+        self.smp = None
+
+        self._output_lock = threading.Lock()
+        self._search_thread = None
+        self._stop_event = threading.Event()
+        # Set once a search is allowed to send its best move (see go())
+        self._release_event = threading.Event()
+        self._ponder_params = None
+        self._ponder_timer = None
+
+    def send(self, line):
+        with self._output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def handle(self, line):
+        """
+        Handles one line of input. Returns False once the engine should quit.
+        """
+        tokens = line.split()
+        if not tokens:
+            return True
+        cmd = tokens[0]
+
+        if cmd == 'uci':
+            self.send(f'id name {ENGINE_NAME}')
+            self.send(f'id author {ENGINE_AUTHOR}')
+            self.send(f'option name Hash type spin default {DEFAULT_HASH_MB} min 1 max 4096')
+            self.send(f'option name Threads type spin default 1 min 1 max {MAX_THREADS}')
+            self.send('option name Ponder type check default false')
+            self.send('uciok')
+        elif cmd == 'isready':
+            self.send('readyok')
+        elif cmd == 'ucinewgame':
+            self.stop()
+            self.tt.clear()
+            self.board = ChessBoard()
+        elif cmd == 'setoption':
+            self.set_option(tokens[1:])
+        elif cmd == 'position':
+            self.stop()
+            self.set_position(tokens[1:])
+        elif cmd == 'go':
+            self.stop()
+            self.go(parse_go(tokens[1:]))
+        elif cmd == 'stop':
+            self.stop()
+        elif cmd == 'ponderhit':
+            self.ponderhit()
+        elif cmd == 'quit':
+            self.stop()
+            self.close_smp()
+            return False
+        return True
+
+    def set_option(self, tokens):
+        if 'name' not in tokens or 'value' not in tokens:
+            return
+        name = ' '.join(tokens[tokens.index('name') + 1:tokens.index('value')]).lower()
+        value = ' '.join(tokens[tokens.index('value') + 1:])
+        if name == 'hash':
+            self.stop()
+            self.hash_mb = max(1, int(value))
+            self.set_threads(self.smp.num_workers if self.smp is not None else 1)
+        elif name == 'threads':
+            self.stop()
+            self.set_threads(min(max(1, int(value)), MAX_THREADS))
+
+    def set_threads(self, num_threads):
+        """
+        Makes a new transposition table, shared between num_threads search processes if there are
+        more than one.
+        """
+        self.close_smp()
+        if num_threads > 1:
+            self.smp = LazySMP(num_threads, self.hash_mb)
+            self.tt = self.smp.tt
+        else:
+            self.tt = TranspositionTable(self.hash_mb)
+
+    def close_smp(self):
+        if self.smp is not None:
+            self.smp.close()
+            self.smp = None
+
+    def set_position(self, tokens):
+        board = ChessBoard()
+        if tokens and tokens[0] == 'fen':
+            fen_end = tokens.index('moves') if 'moves' in tokens else len(tokens)
+            board.set_fen(' '.join(tokens[1:fen_end]))
+            tokens = tokens[fen_end:]
+        elif tokens and tokens[0] == 'startpos':
+            tokens = tokens[1:]
+
+        if tokens and tokens[0] == 'moves':
+            for move in tokens[1:]:
+                board.board.push_uci(move)
+        self.board = board
+
+    def go(self, params):
+        """
+        Starts a search on the current position, on its own thread. A normal search sends its best
+        move as soon as it is done, an infinite one or a ponder search only once it is released by
+        "stop" (or "ponderhit").
+        """
+        self._stop_event = threading.Event()
+        self._release_event = threading.Event()
+        if not params.get('infinite') and not params.get('ponder'):
+            self._release_event.set()
+        self._ponder_params = params if params.get('ponder') else None
+
+        board = ChessBoard()
+        board.board = self.board.board.copy()
+        self._search_thread = threading.Thread(target=self._search, daemon=True,
+                                               args=(board, params, self._stop_event, self._release_event))
+        self._search_thread.start()
+
+    def ponderhit(self):
+        """
+        The opponent played the move we were pondering on: the search goes on as a normal search,
+        with the time control of the "go ponder" command counted from now.
+        """
+        if self._search_thread is None or self._ponder_params is None:
+            return
+        params, self._ponder_params = self._ponder_params, None
+        time_budget_ms = allocate_time_ms(self.board.get_turn(), params)
+        if time_budget_ms is not None:
+            self._ponder_timer = threading.Timer(time_budget_ms / 1000, self._stop_event.set)
+            self._ponder_timer.daemon = True
+            self._ponder_timer.start()
+        self._release_event.set()
+
+    def stop(self):
+        """
+        Stops the running search (if there is one) and waits for it to print its best move.
+        """
+        if self._search_thread is not None:
+            self._stop_event.set()
+            self._release_event.set()
+            self._search_thread.join()
+            self._search_thread = None
+        if self._ponder_timer is not None:
+            self._ponder_timer.cancel()
+            self._ponder_timer = None
+        self._ponder_params = None
+
+    def _search(self, board, params, stop_event, release_event):
+        turn = board.get_turn()
+        if not any(board.board.generate_legal_moves()):
+            # Checkmate or stalemate, there is nothing to play
+            release_event.wait()
+            self.send('bestmove 0000')
+            return
+
+        # A ponder search has no time limit of its own, ponderhit() stops it on time
+        start_time = time.time()
+        time_budget_ms = None if params.get('infinite') or params.get('ponder') else allocate_time_ms(turn, params)
+        max_depth = params.get('depth', MAX_SEARCH_DEPTH)
+
+        def on_iteration(depth, root_moves, values, depths_reached, state):
+            elapsed = max(time.time() - start_time, 1e-6)
+            pv = principal_variation(board, state, root_moves[0], max_length=depth)
+            self.send(f'info depth {depth} seldepth {max(depths_reached[0], depth)} nodes {state.nodes} '
+                      f'nps {int(state.nodes / elapsed)} time {int(elapsed * 1000)} '
+                      f'score {format_score(values[0], depths_reached[0], turn)} pv {" ".join(str(move) for move in pv)}')
+
+        best_move, _ = evaluate_board(board, self.model, turn, tt=self.tt, time_budget_ms=time_budget_ms,
+                                      node_budget=params.get('nodes'), max_depth=max_depth, stop_event=stop_event,
+                                      on_iteration=on_iteration, smp=self.smp)
+
+        # With "go infinite" or "go ponder" the best move is only sent once the GUI says "stop" (or
+        # "ponderhit")
+        release_event.wait()
+        self.send(f'bestmove {best_move}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the engine as a UCI engine on standard input and output.')
+    parser.add_argument('--model', type=str, default=MODEL_PATH)
+    parser.add_argument('--no-model', action='store_true', help='Play without the neural network (material only)')
+    parser.add_argument('--quantization', type=str, default=None, choices=['int8', 'float16'],
+                        help='Use the quantized version of the model (see eval/quantize.py)')
+    args = parser.parse_args()
+
+    model = None if args.no_model else load_model(args.model, args.quantization)
+    engine = UCIEngine(model)
+    for line in sys.stdin:
+        if not engine.handle(line.strip()):
+            break
+    else:
+        # The input was closed without a "quit", so finish the search like "quit" would
+        engine.stop()
+        engine.close_smp()
+
+
+if __name__ == '__main__':
+    main()